@@ -18,6 +18,11 @@ import hashlib
 import json
 import os
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 def dummySetproctitle(title):
     """ Inactive version of setproctitle when the package is not installed """
     pass
@@ -53,6 +58,24 @@ def md5sum(filename):
             md5.update(chunk)
     return md5.hexdigest()
 
+class FileLock:
+    """
+        Lock shared between processes, based on a lock file.
+        Only effective where fcntl is available, elsewhere it doesn't lock anything.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__file = None
+
+    def acquire(self):
+        self.__file = open(self.path, 'a')
+        if fcntl: fcntl.flock(self.__file.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        if fcntl: fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+        self.__file.close()
+        self.__file = None
+
 def searchFiles (fsElements, acceptCb=None):
     if type(fsElements) is not list:
         fsElements = [ fsElements ]
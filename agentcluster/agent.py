@@ -13,27 +13,35 @@
 # GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
-from agentcluster import AnyJsonDecoder, makeAppName, setProcTitle
+from agentcluster import AnyJsonDecoder, confdir, makeAppName, setProcTitle
 from agentcluster.database import Database
 from agentcluster.exception import ClusterException
+from agentcluster.metrics import Metrics, processMetrics, publish
+from agentcluster.profiler import Profiler
+from agentcluster.responder import GetCommandResponder, SetCommandResponder, NextCommandResponder, BulkCommandResponder
+from agentcluster.snapshot import SnapshotFile, SnapshotFileController
 from agentcluster.snmpsetup import *
-from agentcluster.transport import SocketHelper
+from agentcluster.transport import ConnectionChannel, SocketHelper, countDrops
+from agentcluster.watcher import FileWatcher
 from datetime import datetime, timedelta
-from multiprocessing import Process
+from multiprocessing import Pipe, Process
 from multiprocessing.queues import JoinableQueue
 from pysnmp import debug
 from pysnmp.entity import engine, config
-from pysnmp.entity.rfc3413 import cmdrsp, context
+from pysnmp.entity.rfc3413 import context
+import hashlib
 import logging.config
 import os
 import signal
 import sys
 import threading
-import time
 
-__all__ = ["Agent"]
+__all__ = ["Agent", "AgentWorker", "HostedAgent", "ReplicatedAgent", "SharedDispatcher"]
 logger = logging.getLogger('agentcluster.agent')
 
+# Engine ID format of pysnmp (enterprise 20408, octets), followed by a hash of the agent name for replicated agents
+REPLICA_ENGINEID_PREFIX = "\x80\x00\x4f\xb8\x05"
+
 class Agent(Process):
     """
         Agent entry point.
@@ -44,22 +52,37 @@ class Agent(Process):
         in a single wait which could give a solution to this lack.
     """
 
-    def __init__(self, confFile, tokens_start, parent_pid, monitoring_period):
+    def __init__(self, confFile, readiness, parent_pid, monitoring_period, replica=None):
         Process.__init__(self)
+        self.confFile = confFile
+        # Index of this process among the replicas of the agent, None if the agent is not replicated
+        self.replica = replica
         self.monitoring_period = monitoring_period
         self.parent_pid = parent_pid
-        self.tokens_start = tokens_start
+        # Queue where the agent reports the end of its configuration: tuple (conf file, started)
+        self.readiness = readiness
+        self.reported = False
         self.socketHelper = SocketHelper()
+        # SNMP engine and context, transport domains and metrics, set when the agent is configured
+        self.snmpEngine = None
+        self.snmpContext = None
+        self.domains = []
+        self.metrics = None
 
         # The following parameters are intended to be set after JSON conf file has been read in method parse
 
         # Name of this virtual agent
         self.name = "";
         self.engineID = None;
+        self.active = None;
         # Listen parameters
         self.listen = None;
         # Parameters for variations used by this agent
         self.variation = None;
+        # Max number of snapshots kept opened, default to the one of the process
+        self.openSnapshots = None;
+        # Number of processes serving this agent
+        self.replicas = None;
         # Parameters for each snmp version
         self.snmpv1  = None;
         self.snmpv2c = None;
@@ -68,13 +91,157 @@ class Agent(Process):
         # Set configuration from file
         self.parse (confFile)
 
+    def isActive(self):
+        return self.active is None or self.active.lower()!="false"
+
+    def replicaCount(self):
+        """ Number of processes serving this agent, 1 if it is not replicated """
+        if self.replicas is None:
+            return 1
+        try:
+            count = int(self.replicas)
+        except ValueError:
+            count = 0
+        if count < 1:
+            msg = 'Agent "%s": invalid number of replicas: %s' % (self.name, self.replicas);
+            logger.error ( msg );
+            raise ClusterException(msg);
+        return count
+
+    def snapshots(self):
+        """ Full paths of the snapshot files referenced by this agent """
+        snapshots = set()
+        for params in [ self.snmpv1, self.snmpv2c, self.snmpv3 ]:
+            if params is None or getattr(params, "mib", None) is None:
+                continue
+            for snapshotPath in params.mib.__dict__.values():
+                snapshots.add( os.path.abspath ( params.confPath + os.path.sep + snapshotPath ) )
+        return snapshots
+
+    def passwords(self):
+        """ Passwords of the SNMPv3 users of this agent, as entries of the USM key cache """
+        if self.snmpv3 is None or getattr(self.snmpv3, "users", None) is None:
+            return []
+        return SnmpConfHelperV3().passwords(self.snmpv3)
+
+    def ready(self, started):
+        """ Reports to the parent process that this agent is configured, or that it failed to start """
+        if self.readiness is not None and not self.reported:
+            self.readiness.put( (self.confFile, started) )
+        self.reported = True
+
+    def setup(self, transportDispatcher=None):
+        """
+            Configures the SNMP engine of this agent.
+            If a transport dispatcher is given, the engine is attached to it through a SharedDispatcher
+            so that multiple agents can share the same dispatcher.
+        """
+        if self.replica is not None:
+            logger.info ( 'Agent "%s": run replica %d', self.name, self.replica );
+        else:
+            logger.info ( 'Agent "%s": run', self.name );
+        logger.debug ( 'EngineID="%s"', self.engineID );
+
+        engineID_bin=None;
+        if self.engineID!=None:
+            try:
+                engineID_bin = self.engineID.decode("hex");
+            except Exception:
+                logger.warn ( 'Cannot convert configured engine ID to byte array, engine ID ignored: %s', self.engineID );
+                logger.debug ( "", exc_info=True );
+        elif self.replica is not None:
+            # The replicas must answer as a single engine
+            engineID_bin = REPLICA_ENGINEID_PREFIX + hashlib.md5(self.name).digest()[:12]
+            logger.debug ( 'Engine ID of the replicas: %s', engineID_bin.encode("hex") );
+        else:
+            logger.debug ( "No context engineID specified, let pysnmp generate one" );
+
+        self.configureHandles(transportDispatcher is not None)
+        if self.replica is not None:
+            self.metrics = Metrics(agent=self.name, replica=str(self.replica))
+        else:
+            self.metrics = Metrics(agent=self.name)
+
+        snmpEngine = engine.SnmpEngine(snmpEngineID=engineID_bin);
+        self.snmpEngine = snmpEngine
+        dispatcher = getattr(self.listen, "dispatcher", None)
+        if transportDispatcher is not None:
+            if dispatcher is not None:
+                logger.info ( 'Agent "%s": hosted by a worker, dispatcher %s ignored', self.name, dispatcher );
+            snmpEngine.registerTransportDispatcher(SharedDispatcher(transportDispatcher))
+        else:
+            snmpEngine.registerTransportDispatcher(self.socketHelper.openDispatcher(dispatcher))
+
+        logger.debug ( 'Agent "%s": Configure transport layer', self.name );
+        for protocol, params in self.listen.__dict__.items():
+            if protocol == "dispatcher":
+                continue
+            if type(params) is not list:
+                params = [ params ]
+            for param in params:
+                (domain, socket) = self.socketHelper.openSocket( protocol, param.encode('ascii'), self.replica is not None, self.metrics);
+                config.addSocketTransport( snmpEngine, domain, socket )
+                self.domains.append(domain)
+
+        logger.debug ( 'Agent "%s": Configure application layer', self.name );
+        snmpContext = context.SnmpContext(snmpEngine)
+        self.snmpContext = snmpContext
+        if self.snmpv1  is not None: SnmpConfHelperV1(self.metrics).configure(snmpEngine, snmpContext, self.snmpv1);
+        if self.snmpv2c is not None: SnmpConfHelperV2(self.metrics).configure(snmpEngine, snmpContext, self.snmpv2c);
+        if self.snmpv3  is not None: SnmpConfHelperV3(self.metrics).configure(snmpEngine, snmpContext, self.snmpv3);
+
+        GetCommandResponder(snmpEngine, snmpContext, self.metrics)
+        SetCommandResponder(snmpEngine, snmpContext, self.metrics)
+        NextCommandResponder(snmpEngine, snmpContext, self.metrics)
+        BulkCommandResponder(snmpEngine, snmpContext, self.metrics)
+
+        logger.debug ( 'Agent "%s": Configured', self.name );
+        return snmpEngine
+
+    def configureHandles(self, shared):
+        """
+            Applies the max number of opened snapshots configured for this agent.
+            Agents sharing a process share the same snapshots cache: the largest size configured wins.
+        """
+        if self.openSnapshots is None:
+            return
+        try:
+            size = int(self.openSnapshots)
+        except ValueError:
+            msg = 'Agent "%s": invalid number of opened snapshots: %s' % (self.name, self.openSnapshots);
+            logger.error ( msg );
+            raise ClusterException(msg);
+        if shared:
+            size = max(size, SnapshotFile.handles.maxEntries)
+        SnapshotFile.handles.resize(size)
+
+    def teardown(self):
+        """ Detaches this agent from a shared transport dispatcher and closes its sockets """
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.snmpEngine is None or self.snmpEngine.transportDispatcher is None:
+            return
+        transportDispatcher = self.snmpEngine.transportDispatcher
+        for domain in self.domains:
+            transport = transportDispatcher.getTransport(domain)
+            transportDispatcher.unregisterTransport(domain)
+            transport.closeTransport()
+        self.domains = []
+        self.snmpEngine.unregisterTransportDispatcher()
+        self.snmpEngine = None
+        self.snmpContext = None
+        logger.info ( 'Agent "%s": end', self.name );
+
     def run(self):
 
         transportDispatcher = None;
         try:
+            # SIGUSR1 switches profiling on and off
+            profiler = Profiler(self.name, os.path.join(confdir.cache, 'profiles'))
+            signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle([self]))
+
             # Initialize the engine
-            self.tokens_start.get();
-            if self.active is not None and self.active.lower()=="false":
+            if not self.isActive():
 
                 # Changes the process name shown by ps for instance
                 setProcTitle ("agentcluster agent  [active: False]  [name: %s]" % self.name);
@@ -82,52 +249,19 @@ class Agent(Process):
                 logger.info ( 'Agent "%s": inactive', self.name );
                 # Generates a deadlock to enter in sleep mode
                 # Only an external signal can break this deadlock
-                self.tokens_start.task_done();
+                self.ready(True);
                 queue = JoinableQueue()
                 queue.put(object());
                 queue.join();
 
             # Changes the process name shown by ps for instance
-            setProcTitle ("agentcluster agent  [active: True ]  [name: %s]" % self.name);
-
-            logger.info ( 'Agent "%s": run', self.name );
-            logger.debug ( 'EngineID="%s"', self.engineID );
-
-            engineID_bin=None;
-            if self.engineID!=None:
-                try:
-                    engineID_bin = self.engineID.decode("hex");
-                except Exception:
-                    logger.warn ( 'Cannot convert configured engine ID to byte array, engine ID ignored: %s', self.engineID );
-                    logger.debug ( "", exc_info=True );
+            if self.replica is not None:
+                setProcTitle ("agentcluster agent  [active: True ]  [name: %s] [replica: %d]" % (self.name, self.replica));
             else:
-                logger.debug ( "No context engineID specified, let pysnmp generate one" );
-
-            snmpEngine = engine.SnmpEngine(snmpEngineID=engineID_bin);
-
-            logger.debug ( 'Agent "%s": Configure transport layer', self.name );
-            for protocol, params in self.listen.__dict__.items():
-                if type(params) is list:
-                    for param in params:
-                        (domain, socket) = self.socketHelper.openSocket( protocol, param.encode('ascii'));
-                        config.addSocketTransport( snmpEngine, domain, socket )
-                else:
-                    (domain, socket) = self.socketHelper.openSocket( protocol, params.encode('ascii'));
-                    config.addSocketTransport( snmpEngine, domain, socket )
-
-            logger.debug ( 'Agent "%s": Configure application layer', self.name );
-            snmpContext = context.SnmpContext(snmpEngine)
-            if self.snmpv1  is not None: SnmpConfHelperV1().configure(snmpEngine, snmpContext, self.snmpv1);
-            if self.snmpv2c is not None: SnmpConfHelperV2().configure(snmpEngine, snmpContext, self.snmpv2c);
-            if self.snmpv3  is not None: SnmpConfHelperV3().configure(snmpEngine, snmpContext, self.snmpv3);
-
-            cmdrsp.GetCommandResponder(snmpEngine, snmpContext)
-            cmdrsp.SetCommandResponder(snmpEngine, snmpContext)
-            cmdrsp.NextCommandResponder(snmpEngine, snmpContext)
-            cmdrsp.BulkCommandResponder(snmpEngine, snmpContext)
-
-            logger.debug ( 'Agent "%s": Configured', self.name );
-            self.tokens_start.task_done();
+                setProcTitle ("agentcluster agent  [active: True ]  [name: %s]" % self.name);
+
+            snmpEngine = self.setup()
+            self.ready(True);
 
             logger.debug ( 'Starting parent and database watchdog' );
             self.monitor = Watchdog(self.parent_pid, self.monitoring_period)
@@ -150,9 +284,8 @@ class Agent(Process):
             logger.info ( 'Agent "%s": end', self.name );
             logging.shutdown()
             try:
-                # Issue #3: Python 2.7.6 releases the parent process if children is killed
-                # not Python 2.6.6 so we must still release the token. 
-                self.tokens_start.task_done();
+                # Issue #3: The parent must not wait for an agent that will never start
+                self.ready(False);
             except:
                 pass;
             # Issue #3: This agent is no longer usable so commit suicide to be sure
@@ -178,38 +311,323 @@ class Agent(Process):
         if self.snmpv2c is not None: self.snmpv2c.confPath = confPath;
         if self.snmpv3  is not None: self.snmpv3.confPath  = confPath;
 
+class SharedDispatcher:
+    """
+        View given to one SNMP engine on a transport dispatcher shared by several engines.
+
+        pysnmp dispatchers deliver incoming messages to a single receive callback: the view keeps the
+        callback of its engine for the worker to route messages by transport domain. Everything else
+        is delegated to the shared dispatcher.
+    """
+
+    def __init__(self, transportDispatcher):
+        self.transportDispatcher = transportDispatcher
+        self.recvCbFun  = None
+        self.timerCbFun = None
+
+    def __getattr__(self, name):
+        return getattr(self.transportDispatcher, name)
+
+    def registerRecvCbFun(self, recvCbFun):
+        self.recvCbFun = recvCbFun
+
+    def unregisterRecvCbFun(self):
+        self.recvCbFun = None
+
+    def registerTimerCbFun(self, timerCbFun, tickInterval=None):
+        self.timerCbFun = timerCbFun
+        self.transportDispatcher.registerTimerCbFun(timerCbFun, tickInterval)
+
+    def unregisterTimerCbFun(self, timerCbFun=None):
+        # Only the timer of this engine is removed, not those of the other agents
+        if self.timerCbFun is not None:
+            self.transportDispatcher.unregisterTimerCbFun(self.timerCbFun)
+            self.timerCbFun = None
+
+class AgentWorker(Process):
+    """
+        Worker process hosting many agents.
+
+        All the agents of a worker share the same transport dispatcher, each agent keeps its own
+        SNMP engine so that engine ID, users and contexts stay isolated between agents.
+        Agents are added and removed at runtime with commands sent by the parent process through a pipe,
+        the dispatcher waits for them with its sockets and runs them as soon as they arrive.
+    """
+
+    def __init__(self, workerId, readiness, parent_pid, monitoring_period):
+        Process.__init__(self)
+        self.name = "worker%d" % workerId
+        self.workerId = workerId
+        self.monitoring_period = monitoring_period
+        self.parent_pid = parent_pid
+        self.readiness = readiness
+        # Commands are sent synchronously: a command sent is readable in the worker
+        self.commands, self.commandsSender = Pipe(duplex=False)
+        # Agent conf files hosted by this worker, as seen by the parent process
+        self.confs = set()
+        # Agents configured in this worker indexed by their conf file, only used in the worker process
+        self.agents = {}
+
+    def addAgent(self, confFile):
+        """ Asks the worker to start the agent, its readiness is reported in the readiness queue """
+        self.confs.add(confFile)
+        self.commandsSender.send( ("add", confFile) )
+
+    def removeAgent(self, confFile):
+        """ Asks the worker to stop the agent """
+        self.confs.discard(confFile)
+        try:
+            self.commandsSender.send( ("remove", confFile) )
+        except IOError:
+            # The worker is gone, with its agents
+            pass;
+
+    def start(self):
+        Process.start(self)
+        # Only the worker reads the commands, sending to a dead worker fails
+        self.commands.close()
+
+    def hosts(self, confFile):
+        return confFile in self.confs and self.is_alive()
+
+    def __add(self, transportDispatcher, confFile):
+        agent = None
+        try:
+            agent = Agent(confFile, self.readiness, self.parent_pid, self.monitoring_period)
+            if agent.isActive():
+                agent.setup(transportDispatcher)
+            else:
+                logger.info ( 'Agent "%s": inactive', agent.name );
+            self.agents[confFile] = agent
+            for domain in agent.domains:
+                self.routes[domain] = agent.snmpEngine.transportDispatcher
+            agent.ready(True)
+        except Exception:
+            logger.error ( 'Cannot start agent %s: %s', confFile, sys.exc_info()[1] );
+            logger.debug ( "", exc_info=True );
+            if agent is not None:
+                agent.teardown()
+            self.readiness.put( (confFile, False) )
+
+    def __remove(self, confFile):
+        agent = self.agents.pop(confFile, None)
+        if agent is None:
+            return
+        for domain in agent.domains:
+            self.routes.pop(domain, None)
+        try:
+            agent.teardown()
+        except Exception:
+            logger.error ( 'Cannot stop agent %s: %s', confFile, sys.exc_info()[1] );
+            logger.debug ( "", exc_info=True );
+
+    def __route(self, transportDispatcher, transportDomain, transportAddress, incomingMessage):
+        sharedDispatcher = self.routes.get(transportDomain)
+        if sharedDispatcher is None or sharedDispatcher.recvCbFun is None:
+            logger.debug ( 'Worker %d: message dropped, no agent on domain %s', self.workerId, transportDomain );
+            return
+        sharedDispatcher.recvCbFun(sharedDispatcher, transportDomain, transportAddress, incomingMessage)
+
+    def __processCommand(self, transportDispatcher, command):
+        command, confFile = command
+        # A restarted agent is stopped first
+        self.__remove(confFile)
+        if command == "add":
+            self.__add(transportDispatcher, confFile)
+        setProcTitle ("agentcluster worker [id: %d] [agents: %d]" % (self.workerId, len(self.agents)));
+
+    def run(self):
+        transportDispatcher = None;
+        try:
+            setProcTitle ("agentcluster worker [id: %d] [agents: 0]" % self.workerId);
+            logger.info ( 'Worker %d: run', self.workerId );
+
+            # SIGUSR1 switches profiling of the hosted agents on and off
+            profiler = Profiler(self.name, os.path.join(confdir.cache, 'profiles'))
+            signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle(self.agents.values()))
+
+            # Incoming messages are routed to the agent owning the transport domain
+            self.routes = {}
+            transportDispatcher = SocketHelper().openDispatcher()
+            transportDispatcher.registerRecvCbFun(self.__route)
+            self.commandsSender.close()
+            ConnectionChannel(
+                self.commands,
+                lambda command: self.__processCommand(transportDispatcher, command),
+                transportDispatcher.getSocketMap()
+            )
+
+            logger.debug ( 'Starting parent and database watchdog' );
+            self.monitor = Watchdog(self.parent_pid, self.monitoring_period)
+            self.monitor.start()
+
+            # Job will never end unless killed
+            logger.debug ( 'Worker %d: Running dispatcher', self.workerId );
+            transportDispatcher.jobStarted(1)
+            transportDispatcher.runDispatcher()
+
+        except KeyboardInterrupt:
+            logger.debug ( 'Worker %d: interrupted', self.workerId );
+        except Exception:
+            logger.error ( 'Unexpected exception catched in worker: %s', sys.exc_info()[1] );
+            logger.error ( "", exc_info=True );
+        finally:
+            if transportDispatcher != None:
+                transportDispatcher.closeDispatcher()
+            logger.info ( 'Worker %d: end', self.workerId );
+            # Issue #3: The parent must not wait for the agents still in queue
+            try:
+                while self.commands.poll():
+                    command, confFile = self.commands.recv()
+                    if command == "add":
+                        self.readiness.put( (confFile, False) )
+            except:
+                pass;
+            logging.shutdown()
+            # Issue #3: This worker is no longer usable so commit suicide to be sure
+            # This process won't become a zombie and that parent will restart its agents
+            os.kill(os.getpid(), signal.SIGKILL)
+
+class HostedAgent:
+    """ Handle on an agent hosted by a worker, gives the parent process the same interface as an Agent process """
+
+    def __init__(self, agent, worker):
+        self.name   = agent.name
+        self.conf   = agent.confFile
+        self.worker = worker
+        self.ident  = worker.ident
+
+    def start(self):
+        self.worker.addAgent(self.conf)
+
+    def is_alive(self):
+        return self.worker.hosts(self.conf)
+
+    def terminate(self):
+        if self.worker.is_alive():
+            self.worker.removeAgent(self.conf)
+
+    def join(self, timeout=None):
+        pass
+
+class ReplicatedAgent:
+    """
+        Handle on the replicas of an agent, gives the parent process the same interface as an Agent process.
+
+        Replicas are agent processes binding the same udp endpoints with SO_REUSEPORT, the system spreads the
+        requests between them by source address. They share the engine ID and the snapshot indexes, and are
+        started, stopped and restarted together.
+    """
+
+    def __init__(self, agent, count, readiness, parent_pid, monitoring_period):
+        self.name     = agent.name
+        self.conf     = agent.confFile
+        self.replicas = [ Agent(agent.confFile, readiness, parent_pid, monitoring_period, replica) for replica in range(count) ]
+        # Replicas that reported their readiness
+        self.reports  = 0
+
+    @property
+    def ident(self):
+        return self.replicas[0].ident
+
+    def pids(self):
+        return [ replica.pid for replica in self.replicas if replica.is_alive() ]
+
+    def reported(self, started):
+        """ Records the readiness of a replica, True when the agent is ready or failed """
+        self.reports += 1
+        return not started or self.reports >= len(self.replicas)
+
+    def start(self):
+        for replica in self.replicas:
+            replica.start()
+
+    def is_alive(self):
+        # A dead replica restarts them all
+        return all( [ replica.is_alive() for replica in self.replicas ] )
+
+    def terminate(self):
+        for replica in self.replicas:
+            if replica.is_alive():
+                replica.terminate()
+
+    def join(self, timeout=None):
+        for replica in self.replicas:
+            if replica.pid is not None:
+                replica.join(timeout)
+
 class Watchdog(threading.Thread):
-    """ Daemon thread that check the parent thread and commit suicide if parent is missing """
+    """
+        Daemon thread that check the parent thread and commit suicide if parent is missing.
+        It also refreshes databases whose source changed: as soon as the change is notified or on each monitoring period.
+    """
     
     def __init__(self, parent_pid, monitoring_period):
         threading.Thread.__init__(self)
         self.parent_pid     = parent_pid
         self.period         = timedelta ( seconds = monitoring_period )
         self.daemon         = True
+        self.watcher        = FileWatcher()
 
     def conf_check(self):
-        for db in Database.all:
+        for db in list(Database.all):
+            self.watcher.watchFile(db.sourceFile)
+            # Lazy snapshots not used yet are checked on their first use
+            if not db.isAttached():
+                continue
             if not db.isUpToDate():
                 logger.info ( 'Configuration file changed: %s', db.sourceFile );
                 db.refresh();
+        logger.debug ( 'Opened snapshots: %(size)d/%(maxsize)d, hits: %(hits)d, misses: %(misses)d, evictions: %(evictions)d, expired: %(expired)d', SnapshotFile.handles.stats() );
+        logger.debug ( 'Cached responses: %(size)d/%(maxsize)d, hits: %(hits)d, misses: %(misses)d, hit ratio: %(ratio).1f%%', SnapshotFileController.responses.stats() );
         return
 
+    def cache_stats(self):
+        """ Copies the statistics of the caches of this process in its metrics """
+        handles   = SnapshotFile.handles.stats()
+        responses = SnapshotFileController.responses.stats()
+        metrics   = processMetrics()
+        metrics.set('agentcluster_open_snapshots',           handles['size'])
+        metrics.set('agentcluster_open_snapshots_max',       handles['maxsize'])
+        metrics.set('agentcluster_snapshot_hits_total',      handles['hits'])
+        metrics.set('agentcluster_snapshot_misses_total',    handles['misses'])
+        metrics.set('agentcluster_snapshot_evictions_total', handles['evictions'])
+        metrics.set('agentcluster_snapshot_expirations_total', handles['expired'])
+        metrics.set('agentcluster_cached_responses',         responses['size'])
+        metrics.set('agentcluster_cached_responses_max',     responses['maxsize'])
+        metrics.set('agentcluster_response_hits_total',      responses['hits'])
+        metrics.set('agentcluster_response_misses_total',    responses['misses'])
+
     def run(self):
         if self.parent_pid is None:
             logger.debug ( 'No parent process to monitor, watchdog disabled' );
             return
         logger.info ( 'Agent watchdog started' );
         period_start = datetime.now()-self.period
+        changed = set()
         while True:
-            if (datetime.now()-period_start) >= self.period:
+            if changed is None or changed or (datetime.now()-period_start) >= self.period:
                 try:
+                    start = datetime.now()
                     self.conf_check()
+                    processMetrics().observe('agentcluster_watchdog_check_seconds', (datetime.now()-start).total_seconds())
+                    # Reads the system tables of all the sockets: not on each loop
+                    countDrops()
                 except:
                     logger.debug ( 'Exception in agent watchdog %s', sys.exc_info()[1] );
                 # Start a new period
                 period_start = datetime.now()
-            # Polling for shutdown must be fast
-            time.sleep(1)
+                # Sent on each period even if unchanged: the daemon forgets the metrics it does not receive any more
+                self.cache_stats()
+                publish(True)
+            else:
+                self.cache_stats()
+                publish()
+            # Snapshots unused for a while are closed
+            SnapshotFile.handles.expire()
+            # Polling for shutdown must be fast, file changes stop waiting
+            changed = self.watcher.wait(1)
+            Database.checksums.forget(changed)
             try:
                 os.kill(self.parent_pid, 0)
             except:
@@ -227,8 +645,6 @@ if __name__ == "__main__":
     if pysnmplogger.isEnabledFor(logging.DEBUG):
         debug.setLogger(debug.Debug("all"))
     logger.info ( 'Test agent alone' );
-    tokens_start = JoinableQueue()
-    tokens_start.put(object());
-    agent = Agent ( "../tests/agents/windows/windows.agent", tokens_start, None, 0 );
+    agent = Agent ( "../tests/agents/windows/windows.agent", None, None, 0 );
     agent.run()
 
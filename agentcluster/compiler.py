@@ -0,0 +1,100 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Snapshot compilation service
+#
+# The master process compiles the snapshots referenced by the agents in a pool of processes.
+# Snapshots with the same content share the same index file, so each content is compiled once,
+# whatever the number of agents or snapshot files referencing it. Agents then find their index
+# up to date and only attach to it.
+#
+from agentcluster import setProcTitle
+from agentcluster.database import Database
+from agentcluster.metrics import processMetrics
+from agentcluster.snmpsetup import SnmpConfHelperBase
+from datetime import datetime
+from multiprocessing import Pool
+import logging
+import os
+import sys
+
+__all__ = ["SnapshotCompiler"]
+logger = logging.getLogger('agentcluster.compiler')
+
+def textParserFor( sourceFile ):
+    """ Record type parsing this snapshot file, None if the extension is not supported """
+    return SnmpConfHelperBase.recordSet.get( os.path.splitext(sourceFile)[1][1:] )
+
+def compilerInit():
+    setProcTitle ("agentcluster compiler");
+
+def compileSnapshot( sourceFile ):
+    """ Builds the index of a snapshot in a pool process, returns (source file, error message or None, seconds) """
+    start = datetime.now()
+    try:
+        Database(sourceFile, textParserFor(sourceFile)).refresh()
+        error = None
+    except Exception:
+        error = str(sys.exc_info()[1])
+        logger.debug ( "", exc_info=True );
+    return sourceFile, error, (datetime.now()-start).total_seconds()
+
+class SnapshotCompiler:
+    """ Compiles snapshot files in parallel, each distinct content once """
+
+    def __init__(self, processes):
+        self.processes = processes
+
+    def pending(self, snapshots):
+        """ Snapshot files whose index must be built: one file for each content """
+        sources = {}
+        for sourceFile in snapshots:
+            textParser = textParserFor(sourceFile)
+            # Images are served as they are
+            if textParser is None or textParser.precompiled:
+                continue
+            try:
+                sourceSum = Database.checksums.md5sum(sourceFile)
+            except (IOError, OSError):
+                # Reported by the agent when it will attach to it
+                continue
+            dbFile = Database.dbFileFor(sourceSum, textParser)
+            if dbFile in sources or Database.isDbUpToDate(dbFile, sourceSum):
+                continue
+            sources[dbFile] = sourceFile
+        return sorted(sources.values())
+
+    def compile(self, snapshots):
+        """ Builds the indexes that are not up to date, returns the number of indexes built """
+        sources = self.pending(snapshots)
+        if not sources:
+            return 0
+        logger.info ( 'Compiling %d snapshots with %d processes', len(sources), self.processes );
+        start = datetime.now()
+        built = 0
+        pool = Pool(min(self.processes, len(sources)), compilerInit)
+        try:
+            for sourceFile, error, seconds in pool.imap_unordered(compileSnapshot, sources):
+                if error is None:
+                    built += 1
+                    processMetrics().observe('agentcluster_index_build_seconds', seconds)
+                    logger.debug ( 'Snapshot compiled in %.2f seconds: %s', seconds, sourceFile );
+                else:
+                    logger.error ( 'Cannot compile snapshot %s: %s', sourceFile, error );
+        finally:
+            pool.close()
+            pool.join()
+        logger.info ( 'Snapshots compiled in %.2f seconds: %d/%d', (datetime.now()-start).total_seconds(), built, len(sources) );
+        return built
@@ -0,0 +1,113 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Control socket of the daemon
+#
+# A client connects to the unix socket, writes one command line and reads the answer until the
+# daemon closes the connection. Answers are text lines, those of a failed command start with "error: ".
+#
+from SocketServer import StreamRequestHandler, UnixStreamServer
+import logging
+import os
+import socket
+import stat
+import sys
+import threading
+
+__all__ = ["ControlServer", "sendCommand", "rssOf"]
+logger = logging.getLogger('agentcluster.control')
+
+# Max length of a command line
+MAX_COMMAND = 4096
+
+def rssOf(pid):
+    """ Resident memory of a process in kB, None if unknown """
+    try:
+        status = open('/proc/%d/status' % pid)
+        try:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        finally:
+            status.close()
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def sendCommand(path, command, timeout=None):
+    """ Sends a command to the daemon listening on this socket, returns the lines answered """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(command.strip() + '\n')
+        answer = []
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            answer.append(data)
+    finally:
+        client.close()
+    return ''.join(answer).splitlines()
+
+class ControlHandler(StreamRequestHandler):
+    """ Reads one command line, writes the lines answered """
+
+    def handle(self):
+        line = self.rfile.readline(MAX_COMMAND).strip()
+        if not line:
+            return
+        logger.debug ( 'Control command: %s', line );
+        try:
+            lines = self.server.target.control(line.split())
+        except Exception:
+            logger.debug ( "", exc_info=True );
+            lines = [ 'error: %s' % sys.exc_info()[1] ]
+        for line in lines:
+            self.wfile.write(line + '\n')
+
+class ControlServer:
+    """
+        Serves the control socket. Commands are given as a list of words to method control(words) of the
+        target, that returns the lines to answer and raises an exception if the command fails.
+    """
+
+    def __init__(self, path, target):
+        self.path   = path
+        self.target = target
+        self.server = None
+
+    def start(self):
+        # Left by a previous daemon that did not stop cleanly
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.remove(self.path)
+        self.server = UnixStreamServer(self.path, ControlHandler)
+        self.server.target = self.target
+        # Only the user of the daemon can control it
+        os.chmod(self.path, stat.S_IRUSR | stat.S_IWUSR)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logger.info ( 'Control socket listening on %s', self.path );
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -12,64 +12,156 @@
 # GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
-from agentcluster import confdir, md5sum
-from pyasn1.compat.octets import str2octs
+from agentcluster import __version__, confdir, md5sum, FileLock
+from agentcluster.exception import BatchError, ClusterException
+from agentcluster.image import imageSignature, openImage, writeImage
+from agentcluster.lrucache import LruCache
+from agentcluster.oidindex import OidIndex, OidIndexWriter, hashLine
+from agentcluster.varbind import EncodedVarBind
+from agentcluster.watcher import ChecksumCache
+from datetime import datetime
+from pyasn1.codec.ber import decoder
 from pyasn1.type import univ
-from whichdb import whichdb
+import hashlib
+import itertools
 import threading
-import anydbm as dbm
 import logging
+import mmap
+import struct
+import tempfile
+import weakref
 import os
 import sys
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 logger = logging.getLogger('agentcluster.database')
 
+def peakRss():
+    """ Peak resident memory of this process in kB, '?' where it is unknown """
+    if resource is None:
+        return '?'
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
 def oid2str( oid ):
     return ".".join( [ '%s' % x for x in oid ] )
 
 def str2oid( oidstr ):
     return [ int(x) for x in oidstr.split(".") ]
 
+class _IndexView:
+    """
+        Opened index with the records already decoded from it. It is never modified once published:
+        readers get the current view without lock, a refresh publishes a new one. The index of a replaced
+        view is unmapped when the last reader using it releases it.
+    """
+
+    def __init__(self, dbFile):
+        self.dbFile = dbFile
+        self.index  = OidIndex(dbFile)
+        # Decoded records indexed by their position in the index
+        self.cache  = LruCache(Database.cacheSize)
+        # Encoded varbinds indexed by their position in the index
+        self.varBinds = LruCache(Database.cacheSize)
+
+class _SourceLines:
+    """
+        Hash and offset of each line of a source file. They are kept in a temporary file, not in memory:
+        comparing a source with its previous index needs the same memory whatever the size of the source.
+    """
+
+    # line hash, offset of the line in the source
+    LINE = struct.Struct('>8sQ')
+
+    def __init__(self, text):
+        self.file  = tempfile.TemporaryFile(dir=confdir.cache)
+        self.count = 0
+        self.map   = None
+        offset = 0
+        while True:
+            lines = list(itertools.islice(text, Database.batchSize))
+            if not lines:
+                break
+            chunk = []
+            for line in lines:
+                chunk.append( _SourceLines.LINE.pack(hashLine(line), offset) )
+                offset += len(line)
+            self.file.write( ''.join(chunk) )
+            self.count += len(lines)
+        self.file.flush()
+        if self.count:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def hash(self, i):
+        return _SourceLines.LINE.unpack_from(self.map, i*_SourceLines.LINE.size)[0]
+
+    def offset(self, i):
+        return _SourceLines.LINE.unpack_from(self.map, i*_SourceLines.LINE.size)[1]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
 class Database:
 
     # Version of the database structure
-    version = "1.0"
+    version = "2.2"
 
     # Maintain the list of all declared databases
-    all = []
+    # Weak references: databases of the agents stopped by a worker must not stay alive
+    all = weakref.WeakSet()
+
+    # Max number of decoded records kept in memory by each database
+    cacheSize = 1000
+
+    # Number of source lines parsed at once when building an index
+    batchSize = 1000
+
+    # Max fraction of the lines of a source changed for its index to be updated instead of built again
+    updateRatio = 0.25
+
+    # Number of lines searched after a change for the place where both versions of a source match again
+    resyncLines = 1000
+
+    # Classes of the values, indexed by their full name
+    tagClasses = {}
 
-    def __init__(self, textFile, textParser):
+    # Checksums of the source files
+    checksums = ChecksumCache()
+
+    # Generations of the databases of this process, never reused
+    generations = itertools.count(1)
+
+    def __init__(self, textFile, textParser, metrics=None):
         self.sourceFile  = textFile
         self.textParser  = textParser
-        self.__dbFile    = textFile + os.path.extsep + 'dbm'
-        self.__dbFile    = os.path.join(confdir.cache, os.path.splitdrive(self.__dbFile)[1].replace(os.path.sep, '_'))
-        self.__dbFileTmp = self.__dbFile + os.path.extsep + 'tmp'
-        self.__db        = self.__text = None
-        self.__dbType    = '?'
+        # Metrics of the agent using this database, None if not measured
+        self.metrics     = metrics
+        # Index file and checksum of the source it was built from, known after first refresh.
+        # Both are replaced at once by a single assignment: readers never see one without the other
+        self.__attached  = (None, None)
+        # Current opened index, None when closed. Replaced by a single assignment as well
+        self.__view      = None
+        # Changes each time the database attaches to another content: answers computed before are outdated
+        self.generation  = next(Database.generations)
+        # Issue #4: Serializes the changes of the database, lookups do not take it
         self.__lock      = threading.RLock()
-        Database.all.append(self)
+        Database.all.add(self)
 
     def __str__(self):
-        res = ""
-        # Issue #4: Synchronizes access to the database
-        self.__lock.acquire(True);
-        try:
-            res= 'Data file %s, %s-indexed, %s' % (
-                self.sourceFile, self.__dbType, self.__db and 'opened' or 'closed'
-            )
-        finally:
-            self.__lock.release();
-        return res
+        return 'Data file %s, index %s, %s' % (
+            self.sourceFile, self.__attached[0], self.__view and 'opened' or 'closed'
+        )
 
     def isOpen(self):
-        rc = False;
-        # Issue #4: Synchronizes access to the database
-        self.__lock.acquire(True);
-        try:
-            rc = self.__db is not None
-        finally:
-            self.__lock.release();
-        return rc
+        return self.__view is not None
 
     def check_cache(self,cachedir):
         if not os.path.exists(cachedir):
@@ -82,166 +174,404 @@ class Database:
             else:
                 logger.debug ( 'Cache directory created' );
 
+    @staticmethod
+    def dbFileFor ( sourceSum, textParser ):
+        """
+            Index files are named after the content of their source and its format: agents serving
+            the same content share the same file, the system then maps it only once in memory.
+        """
+        return os.path.join(confdir.cache, sourceSum + os.path.extsep + textParser.ext + os.path.extsep + 'idx')
+
+    @staticmethod
+    def lastFileFor ( sourceFile ):
+        """ File containing the path of the last index built for this source file """
+        return os.path.join(confdir.cache, hashlib.md5(os.path.abspath(sourceFile)).hexdigest() + os.path.extsep + 'last')
+
+    def sourceSum(self):
+        """ Identifies the content of the source: checksum of a text snapshot, signature of an image """
+        if self.textParser.precompiled:
+            return imageSignature(self.sourceFile)
+        return Database.checksums.md5sum(self.sourceFile)
+
     def isUpToDate(self):
         """ Check if index database is up to date """
-        rc = False;
-        # Issue #4: Synchronizes access to the database
-        self.__lock.acquire(True);
         try:
-            rc = Database.isDbUpToDate ( self.__dbFile )
-        finally:
-            self.__lock.release();
-        return rc;
+            sourceSum = self.sourceSum()
+        except (IOError, OSError):
+            return False
+        dbFile, attachedSum = self.__attached
+        if self.textParser.precompiled:
+            return sourceSum == attachedSum
+        return sourceSum == attachedSum and Database.isDbUpToDate ( dbFile, sourceSum )
 
     @staticmethod
-    def isDbUpToDate ( databaseFile ):
-        """ Check if index database is up to date """
+    def isDbUpToDate ( databaseFile, sourceSum=None ):
+        """
+            Check if index database is up to date.
+            If the checksum of the source is not given, it is computed from the source recorded in the database.
+        """
         upToDate      = False
-        for dbFile in ( databaseFile + os.path.extsep + 'db', databaseFile ):
+        try:
+            if not os.path.exists(databaseFile):
+                return False
+            db = OidIndex(databaseFile)
             try:
-                if not os.path.exists(dbFile):
-                    # Database doesn't exist, try next one
-                    continue;
-                if not whichdb(dbFile):
-                    # Not in a readable format
-                    logger.debug ( 'Database not in a readable format: %s', dbFile );
-                    break;
-                # From here, database exists and is readable
-                db = dbm.open(dbFile)
-                sourceFile  = db["__source_path__"]
-                if not os.path.exists(sourceFile):
-                    # Source file doesn't exist any more
-                    break;
-                textFileSum = md5sum(sourceFile)
-                if textFileSum != db["__source_md5__"]:
-                    logger.debug ( 'Source file checksum differs from the one used to build the database: %s', sourceFile );
-                    db.close()
-                    break;
-                if not db["__version__"] == Database.version:
-                    logger.debug ( 'Database version "%s" doesn\'t match this version "%s"', db["__version__"], Database.version );
-                    db.close()
-                    break;
-                db.close()
+                if sourceSum is None:
+                    sourceFile  = db.meta["__source_path__"]
+                    if not os.path.exists(sourceFile):
+                        # Source file doesn't exist any more
+                        return False
+                    sourceSum = Database.checksums.md5sum(sourceFile)
+                if sourceSum != db.meta["__source_md5__"]:
+                    logger.debug ( 'Source file checksum differs from the one used to build the database: %s', databaseFile );
+                    return False
+                if not db.meta["__version__"] == Database.version:
+                    logger.debug ( 'Database version "%s" doesn\'t match this version "%s"', db.meta["__version__"], Database.version );
+                    return False
                 # Everything is ok with the existing database
                 upToDate = True
-                break;
-            except Exception:
-                pass
+            finally:
+                db.close()
+        except Exception:
+            logger.debug ( 'Database not in a readable format: %s', databaseFile );
         return upToDate
 
     def refresh (self):
-        """ Rebuild the index from source file """
-
-        # The cache directory must exist
-        self.check_cache(confdir.cache)
-
-        # these might speed-up indexing
-        db_oids = []
-        open_flags = 'nfu' 
-        while open_flags:
+        """ Attach to the index of the current source content, build it if nobody did it yet """
+
+        if self.textParser.precompiled:
+            # Images are their own index, they are only checked
+            sourceSum = self.sourceSum()
+            dbFile    = os.path.abspath(self.sourceFile)
+            openImage(dbFile).close()
+            logger.debug ( 'Snapshot image %s attached', dbFile );
+        else:
+            # The cache directory must exist
+            self.check_cache(confdir.cache)
+
+            sourceSum = self.sourceSum()
+            dbFile    = Database.dbFileFor(sourceSum, self.textParser)
+
+            # Agents referencing the same content must not build the same index simultaneously
+            lock = FileLock(dbFile + os.path.extsep + 'lock')
+            lock.acquire()
             try:
-                # Issue #4: work on a temporary file to limit collisions
-                db = dbm.open(self.__dbFileTmp, open_flags)
-                db["__version__"]     = Database.version
-                db["__source_path__"] = os.path.abspath(self.sourceFile)
-                db["__source_md5__"]  = md5sum(self.sourceFile)
-            except Exception:
-                open_flags = open_flags[:-1]
-                if not open_flags:
-                    raise
-            else:
-                break
-
-        text = open(self.sourceFile, 'rb')
+                if Database.isDbUpToDate(dbFile, sourceSum):
+                    logger.debug ( 'Index %s already built for data file %s', dbFile, self.sourceFile );
+                else:
+                    self.build(dbFile, sourceSum)
+            finally:
+                lock.release()
 
-        logger.debug ( 'Building index %s for data file %s (open flags \"%s\")', self.__dbFileTmp, self.sourceFile, open_flags );
+        # Issue #4: Synchronizes access to the database
+        self.__lock.acquire(True);
+        try:
+            # Previous index file is left in place, other agents may still use it.
+            # An opened database switches to the new index at once, lookups in progress end on the previous one.
+            # An image keeps its path when its content changes
+            if self.__attached != (dbFile, sourceSum):
+                if self.__view is not None:
+                    self.__view = _IndexView(dbFile)
+                self.generation = next(Database.generations)
+            self.__attached = (dbFile, sourceSum)
+        finally:
+            self.__lock.release();
 
-        # Build the "direct" indexes to have direct access to values
-        nb_direct = nb_next = 0
-        lineNo = 0
-        while 1:
+    def build (self, dbFile, sourceSum):
+        """ Build the index file from source file, from the previous index of this source if there is one """
 
-            try:
-                oid = line = None
-                while not oid:
-                    line = text.readline()
-                    lineNo += 1
-                    if not line: break
-                    oid, tag, val = self.textParser.grammar.parse(line)
-                if not oid: break
-            except Exception:
-                db.close()
-                exc = sys.exc_info()[1]
-                try:
-                    os.remove(self.__dbFileTmp)
-                except OSError:
-                    pass
-                raise Exception('Data error at %s:%d: %s' % ( self.sourceFile, lineNo, exc ) )
+        # Issue #4: work on a temporary file to limit collisions
+        dbFileTmp = dbFile + os.path.extsep + str(os.getpid()) + os.path.extsep + 'tmp'
+        start = datetime.now()
 
-            try:
-                _oid     = self.textParser.evaluateOid(oid)
-            except Exception:
-                db.close()
-                exc = sys.exc_info()[1]
-                try:
-                    os.remove(self.__dbFileTmp)
-                except OSError:
-                    pass
-                raise Exception( 'OID error at %s:%d: %s' % ( self.sourceFile, lineNo, exc ) )
+        previous = self.previousIndex()
+        source = None
+        text = open(self.sourceFile, 'rb')
+        try:
+            runs = None
+            if previous is not None:
+                source = _SourceLines(text)
+                runs   = self.changes(previous, source)
+            if runs is None:
+                logger.debug ( 'Building index %s for data file %s', dbFileTmp, self.sourceFile );
+                db = OidIndexWriter(dbFileTmp)
+                text.seek(0)
+                nb_lines = 0
+                while True:
+                    lines = list(itertools.islice(text, Database.batchSize))
+                    if not lines:
+                        break
+                    self.addLines(db, lines, nb_lines+1)
+                    nb_lines += len(lines)
+                nb_parsed = nb_lines
+            else:
+                logger.debug ( 'Updating index %s from %s for data file %s', dbFileTmp, previous.path, self.sourceFile );
+                db = OidIndexWriter(dbFileTmp, previous)
+                nb_parsed, nb_lines = self.update(db, previous, source, text, runs)
+
+            # Sort records by OID: we cannot sort them by string comparison: "1"<"10"<"2" and we want 1<2<10
+            #   the binary keys of the index give this order, get-next is then a binary search
+            nb_direct = db.write( {
+                "__version__":     Database.version,
+                "__source_path__": os.path.abspath(self.sourceFile),
+                "__source_md5__":  sourceSum
+            } )
+        finally:
+            text.close()
+            if source is not None:
+                source.close()
+            if previous is not None:
+                previous.close()
+        seconds = (datetime.now()-start).total_seconds()
+        logger.debug ( 'Index ok: %d entries, %d/%d lines parsed in %.2f seconds, %d records/s, peak RSS %s kB',
+                       nb_direct, nb_parsed, nb_lines, seconds, db.count / max(seconds, 0.001), peakRss() );
+        if self.metrics is not None:
+            self.metrics.observe('agentcluster_index_build_seconds', seconds)
+
+        # Replaced atomically: the processes opening the index without the lock see the old one or the new one
+        os.rename(dbFileTmp, dbFile);
+
+        # Records the new index as the base of the next update
+        lastFile = Database.lastFileFor(self.sourceFile)
+        out = open(dbFileTmp, 'w')
+        try:
+            out.write(dbFile)
+        finally:
+            out.close()
+        os.rename(dbFileTmp, lastFile);
+
+    def exportImage (self, imageFile):
+        """ Writes the records of the source as a snapshot image, returns the number of records written """
+        if self.textParser.precompiled:
+            raise ClusterException('Already a snapshot image: %s' % self.sourceFile)
+        self.refresh()
+        dbFile, sourceSum = self.__attached
+        index = OidIndex(dbFile)
+        try:
+            return writeImage(index, imageFile, {
+                "__source_path__":   os.path.abspath(self.sourceFile),
+                "__source_md5__":    sourceSum,
+                "__source_format__": self.textParser.ext,
+                "__agentcluster__":  __version__
+            })
+        finally:
+            index.close()
 
+    def previousIndex (self):
+        """ Last index built for the source file if any, None otherwise """
+        try:
+            last = open(Database.lastFileFor(self.sourceFile))
             try:
-                _tag = self.textParser.evaluateTag(tag)
-            except Exception:
-                logger.warn ( 'Validation error at line %s, tag %r: %s', lineNo, tag, sys.exc_info()[1] );
+                index = OidIndex(last.read())
+            finally:
+                last.close()
+        except Exception:
+            return None
+        if index.meta["__source_path__"] != os.path.abspath(self.sourceFile) or index.meta["__version__"] != Database.version:
+            index.close()
+            return None
+        return index
+
+    def changes (self, previous, source):
+        """
+            Compares the lines of the source with the lines of its previous index. Returns the runs of
+            unchanged lines as tuples (first line in the source, first line in the previous index, number of
+            lines), None when too many lines changed for an update to be worth it.
+            Lines are compared in step: after a change, the next lines of both versions are searched for a
+            place where they match again, a few lines at a time.
+        """
+        nb_previous = previous.countLines()
+        nb_lines    = len(source)
+        # Lines removed are kept in memory by the update: past a run of the writer, a build needs less memory
+        limit = min(Database.updateRatio * max(nb_previous, nb_lines), OidIndexWriter.runSize)
+
+        # Unchanged lines at the end, the ones at the beginning are the first run
+        suffix = 0
+        while suffix < min(nb_previous, nb_lines) and source.hash(nb_lines-1-suffix) == previous.lineHash(nb_previous-1-suffix):
+            suffix += 1
+        end, previousEnd = nb_lines-suffix, nb_previous-suffix
+
+        runs = []
+        changed = 0
+        j, i = 0, 0
+        while j < end and i < previousEnd:
+            first = j
+            while j < end and i < previousEnd and source.hash(j) == previous.lineHash(i):
+                i += 1
+                j += 1
+            if j > first:
+                runs.append( (first, i-(j-first), j-first) )
+            if j < end and i < previousEnd:
+                j2, i2 = self.resync(previous, source, i, j, previousEnd, end)
+                changed += max(j2-j, i2-i)
+                if changed > limit:
+                    logger.debug ( 'More than %d lines of %d changed in data file %s, index built again', changed, nb_lines, self.sourceFile );
+                    return None
+                j, i = j2, i2
+        changed += max(end-j, previousEnd-i)
+        if changed > limit:
+            logger.debug ( 'More than %d lines of %d changed in data file %s, index built again', changed, nb_lines, self.sourceFile );
+            return None
+        if suffix:
+            runs.append( (end, previousEnd, suffix) )
+        return runs
+
+    def resync (self, previous, source, i, j, previousEnd, end):
+        """
+            Finds the next lines where the source and its previous index match again after a change at line j
+            of the source and line i of the index. Only the next resyncLines lines of both are searched,
+            the lines in between are considered changed when nothing matches there.
+        """
+        def match(i, j):
+            # Matching lines must be followed by a few matching lines: comments and empty lines are common
+            for n in xrange(4):
+                if i+n >= previousEnd or j+n >= end:
+                    return True
+                if source.hash(j+n) != previous.lineHash(i+n):
+                    return False
+            return True
+
+        # Usual edits first: a few lines replaced, inserted or deleted
+        for n in xrange(1, 9):
+            for i2, j2 in [ (i+n, j+n), (i, j+n), (i+n, j) ]:
+                if i2 < previousEnd and j2 < end and match(i2, j2):
+                    return j2, i2
+        window = {}
+        for i2 in xrange(i, min(i+Database.resyncLines, previousEnd)):
+            window.setdefault(previous.lineHash(i2), i2)
+        for j2 in xrange(j, min(j+Database.resyncLines, end)):
+            i2 = window.get(source.hash(j2))
+            if i2 is not None and match(i2, j2):
+                return j2, i2
+        return min(j+Database.resyncLines, end), min(i+Database.resyncLines, previousEnd)
+
+    def update (self, db, previous, source, text, runs):
+        """
+            Adds the records of the source file to the index, only the lines modified since the previous
+            index are parsed. Records of the unchanged lines, and of the changed lines found elsewhere in the
+            previous index, keep their place in the previous index: they are merged as they are sorted there.
+            Returns the number of lines parsed and the number of lines of the source.
+        """
+        nb_lines = len(source)
+
+        # Lines removed from the previous version, found again if they only moved
+        moved = {}
+        previousLine = 0
+        for _, first, count in runs + [ (nb_lines, previous.countLines(), 0) ]:
+            for line, entry in previous.lines(previousLine, first):
+                moved.setdefault(line, []).append(entry)
+            previousLine = first+count
+
+        # Changed lines are parsed in batches, the lines and runs before them are added once they are parsed
+        pending = []
+        nb_parsed = 0
+        position = 0
+        for first, previousFirst, count in runs + [ (nb_lines, 0, 0) ]:
+            # Changed lines before the run
+            if position < first:
+                text.seek(source.offset(position))
+            for j in xrange(position, first):
+                line, lineText = source.hash(j), text.readline()
+                if moved.get(line):
+                    pending.append( (line, moved[line].pop(0), None) )
+                    continue
+                pending.append( (line, j+1, lineText) )
+                nb_parsed += 1
+                if nb_parsed % Database.batchSize == 0:
+                    self.addPending(db, previous, pending)
+                    pending = []
+            pending.append( (None, previousFirst, count) )
+            position = first+count
+        self.addPending(db, previous, pending)
+        return nb_parsed, nb_lines
+
+    def addPending (self, db, previous, pending):
+        """
+            Adds lines in the order of the source, as tuples: (hash, number, text) for the changed lines to parse,
+            (hash, entry, None) for the changed lines found in the previous index, (None, first, count) for the
+            runs of unchanged lines of the previous index.
+        """
+        parsed  = [ (lineNo, lineText) for line, lineNo, lineText in pending if line is not None and lineText is not None ]
+        lineNos = [ lineNo for lineNo, _ in parsed ]
+        records = dict( zip(lineNos, self.parseLines([ lineText for _, lineText in parsed ], lineNos)) )
+        for line, value, lineText in pending:
+            if line is None:
+                # Run of unchanged lines
+                for line, entry in previous.lines(value, value+lineText):
+                    db.keep(line, entry)
+            elif lineText is None:
+                db.keep(line, value)
+            else:
+                self.addRecord(db, records[value], line)
+
+    def addLines (self, db, lines, lineNo):
+        """
+            Parses a chunk of lines of the source file and adds their records to the index.
+            lineNo is the number of the first line of the chunk in the source file.
+        """
+        records = self.parseLines(lines, range(lineNo, lineNo+len(lines)))
+        for n in xrange(len(lines)):
+            self.addRecord(db, records[n], hashLine(lines[n]))
+
+    def addRecord (self, db, record, lineHash):
+        """ Adds the record parsed from a line to the index, None if the line has no record """
+        if record is None:
+            db.addLine(lineHash)
+        else:
+            db.add( *(record + (lineHash,)) )
+
+    def parseLines (self, lines, lineNos):
+        """
+            Parses lines of the source file, lineNos are their numbers in the source file.
+            Returns for each line its record as a tuple oid, subtree flag, tag, value or None if it has none.
+        """
+        if not lines:
+            return []
 
-            try:
-                _val = self.textParser.evaluateValue( oid, tag, val, dataValidation=True)
-            except Exception:
-                logger.warn ( 'Validation error at line %s, value %r: %s', lineNo, val, sys.exc_info()[1] );
-
-            # for lines serving subtrees, type is empty in tag field
-            db[oid] = '%s,%d,%s,%s' % (oid2str(_oid), tag[0] == ':', _tag, _val)
-            db_oids.append ( _oid );
-            nb_direct = nb_direct+1
-
-        # Build the "next" indexes to have direct access to next values
-
-        # First we need oids splitted into nodes. We cannot sort them by string
-        #   comparison: "1"<"10"<"2" and we want 1<2<10
-        db_oids.sort()
-        for i in range(len(db_oids)-1):
-            oid         = db_oids[i]
-            oid_txt     = oid2str(oid)
-            # The easy one
-            key      = "next."+oid_txt
-            db[key]  = oid2str(db_oids[i+1])
-            nb_next  = nb_next+1
-            # Now the parents: their next is current oid unless they already have one next
-            nodes = oid[:-1]
-            for n in range(len(nodes)):
-                key     = "next." + oid2str(nodes[:n+1])
-                if not db.has_key(key):
-                    db[key] = oid_txt
-                    nb_next = nb_next+1
-        # The last one have no next
-        key = "next." + oid2str(db_oids[ len(db_oids)-1 ])
-        db[key] = ""
-        nb_next = nb_next+1
-
-        text.close()
-        db.close()
-        logger.debug ( 'Index ok: %d direct entries, %d next entries' % (nb_direct,nb_next) );
+        try:
+            oids, tags, vals = self.textParser.grammar.parseBatch(lines)
+        except BatchError:
+            exc = sys.exc_info()[1]
+            raise Exception('Data error at %s:%d: %s' % ( self.sourceFile, lineNos[exc.index], exc ) )
 
-        # Issue #4: Synchronizes access to the database
-        self.__lock.acquire(True);
         try:
-            self.close()
-            if os.access(self.__dbFile, os.R_OK):
-                os.remove(self.__dbFile);
-            os.rename(self.__dbFileTmp, self.__dbFile);
-            self.__dbType = whichdb(self.__dbFile)
-        finally:
-            self.__lock.release();
+            _oids = self.textParser.evaluateOids(oids)
+        except BatchError:
+            exc = sys.exc_info()[1]
+            raise Exception( 'OID error at %s:%d: %s' % ( self.sourceFile, lineNos[exc.index], exc ) )
+
+        _tags, _vals = self.textParser.evaluateValues(oids, tags, vals)
+
+        records = []
+        for n in xrange(len(lines)):
+            if not oids[n]:
+                # Comment or empty line
+                records.append(None)
+            elif isinstance(_vals[n], Exception):
+                logger.warn ( 'Validation error at line %s, tag %r value %r, line ignored: %s', lineNos[n], tags[n], vals[n], _vals[n] );
+                records.append(None)
+            else:
+                # for lines serving subtrees, type is empty in tag field
+                records.append( ( _oids[n], tags[n][0] == ':', _tags[n], _vals[n] ) )
+        return records
+
+    def isBuilt(self):
+        """ True if the index of the current source content can be opened without building or checking it """
+        dbFile = self.__attached[0]
+        if dbFile is not None and os.path.exists(dbFile):
+            # Changes of the source are followed by the watchdog
+            return True
+        if self.textParser.precompiled:
+            return False
+        try:
+            sourceSum = self.sourceSum()
+        except (IOError, OSError):
+            return False
+        return Database.isDbUpToDate(Database.dbFileFor(sourceSum, self.textParser), sourceSum)
+
+    def isAttached(self):
+        """ False until the index is first refreshed: lazy snapshots are attached on their first use """
+        return self.__attached[0] is not None
 
     def create(self):
         if not self.isUpToDate():
@@ -249,77 +579,131 @@ class Database:
         return self
 
     def str2class(self, class_full_name):
+        if class_full_name in Database.tagClasses:
+            return Database.tagClasses[class_full_name]
         module_tree = class_full_name.split(".")
         module_name = ".".join(module_tree[:-1])
         class_name  = module_tree[-1:][0]
         m = __import__(module_name, globals(), locals(), class_name)
         # get the class, will raise AttributeError if class cannot be found
         c = getattr(m, class_name)
+        Database.tagClasses[class_full_name] = c
         return c
 
-    def lookup(self, oid):
-        """ Returns the record which oid is exactly the given one or None if the record doesn't exist """
-
-        # Issue #4: Synchronizes access to the database
-        self.__lock.acquire(True);
-        try:
-            oid, is_subtree, tag, val = self.__db[oid].split(str2octs(','), 3)
-        finally:
-            self.__lock.release();
-
+    def __current(self):
+        """ Current view, the database is opened if needed """
+        view = self.__view
+        if view is None:
+            view = self.__open()
+        return view
+
+    def __record(self, view, i):
+        record = view.cache.get(i)
+        if record is not None:
+            return record
+        oid, is_subtree, tag, val = view.index.record(i)
+        tag_class = self.__tagClass(tag)
+        record = ( univ.ObjectIdentifier(oid), is_subtree, tag_class, decoder.decode(val, asn1Spec=tag_class())[0] )
+        view.cache.put(i, record)
+        return record
+
+    def __varBind(self, view, i):
+        """ Record as an encoded varbind: its value is not decoded """
+        varBind = view.varBinds.get(i)
+        if varBind is not None:
+            return varBind
+        oid, _, tag, val = view.index.record(i)
+        varBind = EncodedVarBind(univ.ObjectIdentifier(oid), self.__tagClass(tag), val)
+        view.varBinds.put(i, varBind)
+        return varBind
+
+    def __tagClass(self, tag):
         try:
-            tag_class = self.str2class(tag);
+            return self.str2class(tag);
         except Exception:
             logger.error ( 'Could not interpret tag %s', tag, exc_info=True );
             raise
-        return univ.ObjectIdentifier(oid), is_subtree, tag_class, tag_class(val)
-
-    def lookup_next(self, oid):
-        """ Returns the record which oid is the closest after the given one or None if none exist after """
 
-        # Issue #4: Synchronizes access to the database
-        self.__lock.acquire(True);
-        try:
-            next_oid = self.__db["next." + oid]
-            oid, is_subtree, tag_class, val = self.lookup(next_oid);
-        finally:
-            self.__lock.release();
-        return oid, is_subtree, tag_class, val;
+    def lookup(self, oid, encoded=False):
+        """
+            Returns the record which oid is exactly the given one, raise KeyError if the record doesn't exist.
+            If encoded is True the record is returned as an EncodedVarBind.
+        """
+        if isinstance(oid, str): oid = str2oid(oid)
+
+        view = self.__current()
+        i = view.index.find(oid)
+        if i < 0:
+            raise KeyError(oid2str(oid))
+        return self.__varBind(view, i) if encoded else self.__record(view, i)
+
+    def lookup_next(self, oid, encoded=False):
+        """
+            Returns the record which oid is the closest after the given one, raise KeyError if none exist after.
+            If encoded is True the record is returned as an EncodedVarBind.
+        """
+        if isinstance(oid, str): oid = str2oid(oid)
+
+        view = self.__current()
+        i = view.index.findNext(oid)
+        if i >= len(view.index):
+            raise KeyError(oid2str(oid))
+        return self.__varBind(view, i) if encoded else self.__record(view, i)
+
+    def lookup_range(self, oid, count, encoded=False):
+        """
+            Returns at most count consecutive records following the given oid, they are read in a single pass.
+            If encoded is True the records are returned as EncodedVarBind.
+        """
+        if isinstance(oid, str): oid = str2oid(oid)
+
+        view = self.__current()
+        i = view.index.findNext(oid)
+        get = self.__varBind if encoded else self.__record
+        return [ get(view, j) for j in xrange(i, min(i+count, len(view.index))) ]
 
     def dump(self):
         """ Dump current database """
 
-        # Issue #4: Synchronizes access to the database
-        self.__lock.acquire(True);
-        try:
-            self.dump_from_file(self.__dbFile)
-        finally:
-            self.__lock.release();
+        dbFile = self.__attached[0]
+        if dbFile is not None:
+            self.dump_from_file(dbFile)
 
     def dump_from_file(self, dbfile):
         """ Dump a database in debug log level """
         logger.debug ( "Dumping database %s", dbfile );
-        db = dbm.open(dbfile, 'r')
-        oids = db.keys();
-        oids.sort()
-        for oid in oids:
-            logger.debug ( "  %s = %s", oid, db[oid] );
+        db = OidIndex(dbfile)
+        for name, value in sorted(db.meta.items()):
+            logger.debug ( "  %s = %s", name, value );
+        for oid, is_subtree, tag, val in db.records():
+            try:
+                val = decoder.decode(val, asn1Spec=self.str2class(tag)())[0].prettyPrint()
+            except Exception:
+                # Shown as stored
+                val = repr(val)
+            logger.debug ( "  %s = %d,%s,%s", oid2str(oid), is_subtree, tag, val );
         db.close()
 
     def open(self):
+        self.__open()
+
+    def __open(self):
+        """ Publishes a view on the current index, returns it """
         # Issue #4: Synchronizes access to the database
         self.__lock.acquire(True);
         try:
-            self.__db = dbm.open(self.__dbFile)
+            dbFile = self.__attached[0]
+            if dbFile is None or not os.path.exists(dbFile):
+                # Never built or cleaned from the cache since
+                self.refresh()
+                dbFile = self.__attached[0]
+            view = _IndexView(dbFile)
+            self.__view = view
         finally:
             self.__lock.release();
+        return view
 
     def close(self):
-        # Issue #4: Synchronizes access to the database
-        self.__lock.acquire(True);
-        try:
-            if self.__text!=None:self.__text.close()
-            if self.__db!=None:self.__db.close()
-            self.__db = self.__text = None
-        finally:
-            self.__lock.release();
+        # The index is not closed here: lookups in progress may still use it.
+        # It is unmapped when they end, as soon as nothing references it any more
+        self.__view = None
@@ -12,11 +12,18 @@
 # GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
-__all__ = ["ClusterException", "NoDataNotification"]
+__all__ = ["ClusterException", "BatchError", "NoDataNotification"]
 
 class ClusterException(Exception):
     pass
 
+class BatchError(ClusterException):
+    """ Error on one item of a batch: index is the position of the item in the batch, cause the original exception """
+    def __init__(self, index, cause):
+        ClusterException.__init__(self, str(cause))
+        self.index = index
+        self.cause = cause
+
 class NoDataNotification(Exception):
     pass
 
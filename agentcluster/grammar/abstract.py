@@ -12,12 +12,56 @@
 # GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
-from agentcluster.exception import ClusterException
+from agentcluster.exception import BatchError, ClusterException
+import binascii
+import sys
 
 class AbstractGrammar:
     def parse(self, line):
         raise ClusterException('Method not implemented at %s' % self.__class__.__name__)
 
+    def parseBatch(self, lines):
+        """
+            Parses a chunk of lines, returns three columns with one item per line: OIDs, tags and values.
+            Comments and empty lines have a None OID. Raises BatchError at the first line that cannot be parsed.
+        """
+        oids = []; tags = []; values = []
+        for n, line in enumerate(lines):
+            try:
+                oid, tag, value = self.parse(line)
+            except Exception:
+                raise BatchError(n, sys.exc_info()[1])
+            oids.append(oid)
+            tags.append(tag)
+            values.append(value)
+        return oids, tags, values
+
+    def decodeHex(self, values, pending, fallback):
+        """
+            Decodes hex values of a column in a single call: pending is a list of tuples (position in the column,
+            hex digits, raw value). Values whose digits cannot be decoded are given to fallback, the filter used
+            when parsing line by line, which gives the same result or raises the same error.
+        """
+        if not pending:
+            return
+        try:
+            data = binascii.unhexlify(''.join( [ digits for _, digits, _ in pending ] ))
+        except (TypeError, binascii.Error):
+            data = None
+        offset = 0
+        for position, digits, raw in pending:
+            if data is not None:
+                values[position] = data[offset:offset+len(digits)//2]
+                offset += len(digits)//2
+                continue
+            try:
+                values[position] = binascii.unhexlify(digits)
+            except (TypeError, binascii.Error):
+                try:
+                    values[position] = fallback(raw)
+                except Exception:
+                    raise BatchError(position, sys.exc_info()[1])
+
     def build(self, oid, tag, val):
         raise ClusterException('Method not implemented at %s' % self.__class__.__name__)
 
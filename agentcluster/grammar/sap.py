@@ -15,7 +15,9 @@
 from pyasn1.compat.octets import octs2str
 from pyasn1.type import univ
 from pysnmp.proto import rfc1902
+from agentcluster.exception import BatchError
 from agentcluster.grammar import abstract
+import sys
 
 class SapGrammar(abstract.AbstractGrammar):
     tagMap = {
@@ -49,3 +51,30 @@ class SapGrammar(abstract.AbstractGrammar):
             return None,None,None
         oid, tag, value = [ x.strip() for x in octs2str(line).split(',', 2) ]
         return oid, tag, self.filterMap.get(tag, lambda x: x)(value.strip())
+
+    def parseBatch(self, lines):
+        """ Same result as parse for each line, with the hex octet strings decoded for the whole chunk at once """
+        oids = []; tags = []; values = []
+        # Hex values decoded at the end: position, digits, raw value
+        pending = []
+        filterMap = self.filterMap
+        identity  = lambda x: x
+        for n, line in enumerate(lines):
+            line = octs2str(line).strip(" \t\n\r")
+            if line.startswith('#') or len(line)==0:
+                # Ignore comment or empty line
+                oids.append(None); tags.append(None); values.append(None)
+                continue
+            try:
+                oid, tag, value = [ x.strip() for x in line.split(',', 2) ]
+                if tag == 'OctetString' and value[:2] == '0x' and len(value) % 2 == 0:
+                    pending.append( (n, value[2:], value) )
+                else:
+                    value = filterMap.get(tag, identity)(value)
+            except Exception:
+                raise BatchError(n, sys.exc_info()[1])
+            oids.append(oid)
+            tags.append(tag)
+            values.append(value)
+        self.decodeHex(values, pending, filterMap['OctetString'])
+        return oids, tags, values
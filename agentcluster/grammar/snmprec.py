@@ -15,7 +15,9 @@
 from pysnmp.proto import rfc1902, rfc1905
 from pyasn1.compat.octets import octs2str, str2octs
 from pyasn1.type import univ
+from agentcluster.exception import BatchError
 from agentcluster.grammar.abstract import AbstractGrammar
+import sys
 
 class SnmprecGrammar(AbstractGrammar):
     tagMap = {}
@@ -44,6 +46,23 @@ class SnmprecGrammar(AbstractGrammar):
         splitted = line.split('|', 2)
         return splitted[0],splitted[1],splitted[2]
 
+    def parseBatch(self, lines):
+        """ Same result as parse for each line """
+        oids = []; tags = []; values = []
+        for n, line in enumerate(lines):
+            line = octs2str(line).strip(" \t\n\r")
+            if line.startswith('#') or len(line)==0:
+                # Ignore comment or empty line
+                oids.append(None); tags.append(None); values.append(None)
+                continue
+            splitted = line.split('|', 2)
+            if len(splitted) < 3:
+                raise BatchError(n, IndexError('list index out of range'))
+            oids.append(splitted[0])
+            tags.append(splitted[1])
+            values.append(splitted[2])
+        return oids, tags, values
+
     # helper functions
 
     def getTagByType(self, value):
@@ -14,7 +14,9 @@
 #
 from pysnmp.proto import rfc1902
 from pyasn1.compat.octets import octs2str
+from agentcluster.exception import BatchError
 from agentcluster.grammar import abstract
+import sys
 
 class WalkGrammar(abstract.AbstractGrammar):
     # case-insensitive keys as snmpwalk output tend to vary
@@ -72,6 +74,11 @@ class WalkGrammar(abstract.AbstractGrammar):
             'BITS:':        self.__getBitsFilter(),
             'HEX-STRING:':  self.__getHexStringFilter()
         }
+        # Filters of space separated hex bytes, replaced by a bulk decoding in parseBatch
+        self.hexFilters = {
+            'OPAQUE:':      self.filterMap['OPAQUE:'],
+            'HEX-STRING:':  self.filterMap['HEX-STRING:']
+        }
 
     def parse(self, line):
         line = octs2str(line).strip(" \t\n\r").decode('ascii', 'ignore').encode() # drop possible 8-bits
@@ -97,3 +104,51 @@ class WalkGrammar(abstract.AbstractGrammar):
             else:
                 tag = 'TimeTicks:'
         return oid, tag.upper(), self.filterMap.get(tag, lambda x: x)(value.strip())
+
+    def parseBatch(self, lines):
+        """ Same result as parse for each line, with non ASCII characters dropped and hex values decoded for the whole chunk at once """
+        text = octs2str('\n'.join( [ line.strip(" \t\n\r") for line in lines ] )).decode('ascii', 'ignore').encode() # drop possible 8-bits
+        oids = []; tags = []; values = []
+        # Hex values decoded at the end: position, digits, raw value
+        pending = []
+        filterMap  = self.filterMap
+        hexFilters = self.hexFilters
+        identity   = lambda x: x
+        for n, line in enumerate(text.split('\n')):
+            if line.startswith('#') or len(line)==0:
+                # Ignore comment or empty line
+                oids.append(None); tags.append(None); values.append(None)
+                continue
+            try:
+                splitted = line.split(' = ', 1)
+                oid   = splitted[0]
+                value = splitted[1]
+                if oid and oid[0] == '.':
+                    oid = oid[1:]
+                if value.startswith('Wrong Type (should be'):
+                    value = value[value.index(': ')+2:]
+                if value.startswith('No more variables left in this MIB View'):
+                    value = 'STRING: '
+                try:
+                    tag, value = value.split(' ', 1)
+                except ValueError:
+                    # this is implicit snmpwalk's fuzziness
+                    if value == '""' or value == 'STRING:':
+                        tag = 'STRING:'
+                        value = ''
+                    else:
+                        tag = 'TimeTicks:'
+                value = value.strip()
+                # Well formed hex bytes: 2 digits separated by a single space
+                if tag in hexFilters and len(value) % 3 == 2 and value[2::3] == ' ' * (len(value)//3):
+                    pending.append( (n, value.replace(' ', ''), value) )
+                else:
+                    value = filterMap.get(tag, identity)(value)
+            except Exception:
+                raise BatchError(n, sys.exc_info()[1])
+            oids.append(oid)
+            tags.append(tag.upper())
+            values.append(value)
+        # Opaque and hex string filters convert values the same way
+        self.decodeHex(values, pending, hexFilters['HEX-STRING:'])
+        return oids, tags, values
@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Precompiled snapshot images
+#
+# An image is an index file (see oidindex) holding the records of a snapshot with their values BER
+# encoded, like in any index, marked by the '__image__' metadata with the version of the image format. It does not depend
+# on the cache nor on the source it was compiled from: agents serve it directly, without parsing, hashing
+# or building anything. Images are built from any supported text format by agentclusterimage.py.
+#
+from agentcluster.exception import ClusterException
+from agentcluster.oidindex import OidIndex, OidIndexWriter
+import os
+
+__all__ = ["IMAGE_VERSION", "openImage", "imageSignature", "writeImage"]
+
+# Version of the image format, images of other versions are rejected
+IMAGE_VERSION = '1'
+
+def openImage( path ):
+    """ Opens an image, raises ClusterException if the file is not an image or has an unsupported version """
+    try:
+        index = OidIndex(path)
+    except (IOError, OSError):
+        raise
+    except Exception:
+        raise ClusterException('Not a snapshot image: %s' % path)
+    version = index.meta.get('__image__')
+    if version != IMAGE_VERSION:
+        index.close()
+        if version is None:
+            raise ClusterException('Not a snapshot image: %s' % path)
+        raise ClusterException('Snapshot image version "%s" not supported, expected "%s": %s' % (version, IMAGE_VERSION, path))
+    return index
+
+def imageSignature( path ):
+    """
+        Identifies the content of an image without reading it: images are replaced as a whole, never
+        modified in place, a new content comes with a new inode, size or modification date.
+        Raises OSError if the file does not exist.
+    """
+    st = os.stat(path)
+    return '%d-%d-%d-%d' % (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime*1000000))
+
+def writeImage( index, imageFile, meta ):
+    """ Writes the records of an index as an image, without the table of its source lines. Returns the number of records written """
+    meta = dict(meta)
+    meta['__image__'] = IMAGE_VERSION
+
+    imageFileTmp = imageFile + os.path.extsep + str(os.getpid()) + os.path.extsep + 'tmp'
+    image = OidIndexWriter(imageFileTmp)
+    for oid, subtree, tag, val in index.records():
+        image.add(oid, subtree, tag, val)
+    count = image.write(meta)
+    os.rename(imageFileTmp, imageFile)
+    return count
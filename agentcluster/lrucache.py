@@ -0,0 +1,194 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+from collections import OrderedDict
+import threading
+import time
+
+__all__ = ["LruCache", "HandleCache"]
+
+class LruCache:
+    """
+        Dictionary limited in size: when full, the least recently used entry is evicted.
+        A size of 0 disables the cache.
+    """
+
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self.__entries  = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, default=None):
+        try:
+            value = self.__entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # Moves the entry to the most recently used end
+        self.__entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxEntries <= 0:
+            return
+        self.__entries.pop(key, None)
+        self.__entries[key] = value
+        while len(self.__entries) > self.maxEntries:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.__entries.clear()
+
+    def hitRatio(self):
+        """ Percentage of the lookups found in the cache """
+        lookups = self.hits + self.misses
+        return 100.0 * self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "size":      len(self.__entries),
+            "maxsize":   self.maxEntries,
+            "hits":      self.hits,
+            "misses":    self.misses,
+            "evictions": self.evictions,
+            "ratio":     self.hitRatio()
+        }
+
+class HandleCache:
+    """
+        Opened handles limited in number: when full, the least recently used handles are closed.
+        A handle is acquired for the time it is used and released afterwards, a handle in use is never
+        closed: the cache may then exceed its size until handles are released. A size of 0 closes
+        handles as soon as they are released. Handles not used for idle seconds are closed by expire().
+        Handles provide the methods isOpen(), open() and close().
+    """
+
+    def __init__(self, maxEntries, idle=0):
+        self.maxEntries = maxEntries
+        # Seconds a handle not in use stays opened, 0 to keep it until evicted
+        self.idle       = idle
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self.expired    = 0
+        # Opened handles with their number of users, least recently used first
+        self.__entries  = OrderedDict()
+        # Time of the last release of the handles not in use
+        self.__released = {}
+        self.__lock     = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __evict(self):
+        """ Removes the least recently used handles not in use until the cache fits in its size, returns them """
+        evicted = []
+        if len(self.__entries) <= self.maxEntries:
+            return evicted
+        for handle, users in self.__entries.items():
+            if len(self.__entries) <= self.maxEntries:
+                break
+            if users == 0:
+                del self.__entries[handle]
+                self.__released.pop(handle, None)
+                evicted.append(handle)
+                self.evictions += 1
+        return evicted
+
+    def __close(self, handles):
+        # Closed out of the lock: closing must not delay the other users of the cache
+        for handle in handles:
+            handle.close()
+
+    def resize(self, maxEntries):
+        self.__lock.acquire()
+        try:
+            self.maxEntries = maxEntries
+            evicted = self.__evict()
+        finally:
+            self.__lock.release()
+        self.__close(evicted)
+
+    def acquire(self, handle):
+        """ Opens the handle if needed, it will not be closed by the cache until it is released """
+        self.__lock.acquire()
+        try:
+            users = self.__entries.pop(handle, None)
+            if users is not None and handle.isOpen():
+                self.hits += 1
+            else:
+                self.misses += 1
+            # Moves the handle to the most recently used end
+            self.__entries[handle] = (users or 0) + 1
+            self.__released.pop(handle, None)
+            evicted = self.__evict()
+        finally:
+            self.__lock.release()
+        self.__close(evicted)
+        if not handle.isOpen():
+            try:
+                handle.open()
+            except:
+                # Not used if it cannot be opened
+                self.release(handle)
+                raise
+        return handle
+
+    def release(self, handle):
+        """ Ends a use of the handle, it may then be closed """
+        self.__lock.acquire()
+        try:
+            users = self.__entries.get(handle)
+            if users:
+                self.__entries[handle] = users - 1
+                if users == 1:
+                    self.__released[handle] = time.time()
+            evicted = self.__evict()
+        finally:
+            self.__lock.release()
+        self.__close(evicted)
+
+    def expire(self):
+        """ Closes the handles not used for idle seconds, returns their number """
+        if self.idle <= 0:
+            return 0
+        limit = time.time() - self.idle
+        self.__lock.acquire()
+        try:
+            expired = [ handle for handle, released in self.__released.items() if released <= limit ]
+            for handle in expired:
+                del self.__entries[handle]
+                del self.__released[handle]
+            self.expired += len(expired)
+        finally:
+            self.__lock.release()
+        self.__close(expired)
+        return len(expired)
+
+    def stats(self):
+        return {
+            "size":      len(self.__entries),
+            "maxsize":   self.maxEntries,
+            "hits":      self.hits,
+            "misses":    self.misses,
+            "evictions": self.evictions,
+            "expired":   self.expired
+        }
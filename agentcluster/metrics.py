@@ -0,0 +1,345 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Metrics of the agents, served by the daemon
+#
+# Each agent counts its requests and times its lookups in a Metrics, each process times its own work
+# (watchdog checks, index builds) in the metrics of the process. The watchdog of a process sends them
+# to the daemon through a queue inherited from it, the daemon serves the last ones received with its
+# own in Prometheus text exposition format.
+#
+# Replicas of an agent label their metrics with their index, the daemon sums them: a replicated agent
+# is served as a single one.
+#
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from Queue import Empty
+from multiprocessing.process import current_process
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+
+__all__ = ["Metrics", "MetricsServer", "processMetrics", "publish"]
+logger = logging.getLogger('agentcluster.metrics')
+
+# Latency buckets in seconds, from a single lookup to a big index build
+LOOKUP_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+TASK_BUCKETS   = (0.001, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# Number of datagrams read at once from an endpoint
+BATCH_BUCKETS  = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# Type, help and buckets of the metrics, indexed by their name
+definitions = {
+    "agentcluster_requests_total":            ("counter",   "SNMP requests received, by PDU type", None),
+    "agentcluster_varbinds_total":            ("counter",   "Variables returned in responses", None),
+    "agentcluster_varbind_exceptions_total":  ("counter",   "Variables returned as noSuchInstance or endOfMib", None),
+    "agentcluster_datagrams_total":           ("counter",   "UDP datagrams received and sent, by endpoint and direction", None),
+    "agentcluster_datagram_drops_total":      ("counter",   "UDP datagrams dropped, by endpoint: receive buffer full or send failed", None),
+    "agentcluster_datagram_batch_size":       ("histogram", "UDP datagrams read at once from an endpoint", BATCH_BUCKETS),
+    "agentcluster_lookup_seconds":            ("histogram", "Time spent reading the variables of a request in its snapshot", LOOKUP_BUCKETS),
+    "agentcluster_index_build_seconds":       ("histogram", "Time spent building the index of a snapshot", TASK_BUCKETS),
+    "agentcluster_watchdog_check_seconds":    ("histogram", "Time spent by a watchdog checking configurations and snapshots", TASK_BUCKETS),
+    "agentcluster_open_snapshots":            ("gauge",     "Snapshots opened by the process", None),
+    "agentcluster_open_snapshots_max":        ("gauge",     "Max number of snapshots kept opened by the process", None),
+    "agentcluster_snapshot_hits_total":       ("counter",   "Uses of a snapshot already opened", None),
+    "agentcluster_snapshot_misses_total":     ("counter",   "Uses of a snapshot that had to be opened", None),
+    "agentcluster_snapshot_evictions_total":  ("counter",   "Snapshots closed to open other ones", None),
+    "agentcluster_snapshot_expirations_total": ("counter",   "Snapshots closed because they were not used for a while", None),
+    "agentcluster_cached_responses":          ("gauge",     "Responses kept by the process", None),
+    "agentcluster_cached_responses_max":      ("gauge",     "Max number of responses kept by the process", None),
+    "agentcluster_response_hits_total":       ("counter",   "Requests answered from the response cache", None),
+    "agentcluster_response_misses_total":     ("counter",   "Requests not found in the response cache", None),
+}
+
+class Histogram:
+    """ Observations counted in buckets by upper bound, the last bucket is +Inf """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts  = [0] * (len(buckets)+1)
+        self.sum     = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Metrics:
+    """
+        Counters and histograms of an agent or of a process, identified by their labels.
+        Samples are indexed by metric name and by their own labels: a tuple of (name, value) pairs.
+    """
+
+    # Queue to the daemon, None when metrics are not served. Inherited by agents and workers
+    queue = None
+
+    # Metrics of this process, published by its watchdog
+    all = weakref.WeakSet()
+
+    def __init__(self, **labels):
+        self.labels     = tuple(sorted(labels.items()))
+        self.pid        = os.getpid()
+        self.counters   = {}
+        self.histograms = {}
+        # Number of changes, and number of changes when last published
+        self.changes    = 0
+        self.published  = None
+        Metrics.all.add(self)
+
+    def close(self):
+        """ Stops publishing these metrics """
+        Metrics.all.discard(self)
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+        self.changes += 1
+
+    def set(self, name, value, labels=()):
+        key = (name, labels)
+        if self.counters.get(key) != value:
+            self.counters[key] = value
+            self.changes += 1
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(definitions[name][2])
+        histogram.observe(value)
+        self.changes += 1
+
+    def sample(self):
+        """ Copy of the current values, sent to the daemon: (labels, counters, histograms) """
+        histograms = dict( [ (key, (histogram.buckets, list(histogram.counts), histogram.sum)) for key, histogram in self.histograms.items() ] )
+        return (self.labels, dict(self.counters), histograms)
+
+def processMetrics():
+    """ Metrics of the current process, labelled with the process name and the replica index if any """
+    global _processMetrics
+    # Forked processes inherit the metrics of their parent
+    if _processMetrics is None or _processMetrics.pid != os.getpid():
+        replica = getattr(current_process(), 'replica', None)
+        if replica is not None:
+            _processMetrics = Metrics(process=current_process().name, replica=str(replica))
+        else:
+            _processMetrics = Metrics(process=current_process().name)
+    return _processMetrics
+
+_processMetrics = None
+
+def publish(force=False):
+    """ Sends the metrics of this process that changed since last time, all of them if force is set """
+    if Metrics.queue is None:
+        return
+    pid = os.getpid()
+    for metrics in list(Metrics.all):
+        # Inherited from the parent process, published by it
+        if metrics.pid != pid:
+            continue
+        if force or metrics.changes != metrics.published:
+            metrics.published = metrics.changes
+            try:
+                Metrics.queue.put( (pid, metrics.sample()) )
+            except Exception:
+                logger.debug ( 'Cannot publish metrics %s', sys.exc_info()[1] );
+
+def unreplicated(labels):
+    """ Labels without the replica index """
+    return tuple( [ label for label in labels if label[0] != 'replica' ] )
+
+def merge(samples):
+    """ Sums the samples of the replicas of the same agent or process """
+    merged = {}
+    for labels, counters, histograms in samples:
+        labels = unreplicated(labels)
+        if labels not in merged:
+            merged[labels] = (labels, dict(counters), dict(histograms))
+            continue
+        total = merged[labels]
+        for key, value in counters.items():
+            total[1][key] = total[1].get(key, 0) + value
+        for key, (buckets, counts, observed) in histograms.items():
+            if key in total[2]:
+                counts = [ a + b for a, b in zip(total[2][key][1], counts) ]
+                observed += total[2][key][2]
+            total[2][key] = (buckets, counts, observed)
+    return merged.values()
+
+def requests(sample):
+    """ Number of requests counted in a sample """
+    return sum( [ value for (name, _), value in sample[1].items() if name == 'agentcluster_requests_total' ] )
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join( [ '%s="%s"' % (name, escape(value)) for name, value in labels ] )
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Answers GET /metrics """
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug ( 'Metrics request from %s: %s', self.client_address[0], format % args );
+
+class MetricsServer:
+    """
+        Collects the metrics sent by the agents and serves them over HTTP along with those of the daemon,
+        only collects them if no address is given. Metrics not received for expiry seconds are from stopped
+        processes, they are no longer served.
+    """
+
+    def __init__(self, address, queue, expiry):
+        self.address = address
+        self.queue   = queue
+        self.expiry  = expiry
+        # Last sample received indexed by labels: (pid, time received, sample)
+        self.samples = {}
+        # Requests per second between the last two samples, indexed by labels
+        self.rates   = {}
+        self.lock    = threading.Lock()
+        self.httpd   = None
+
+    def start(self):
+        targets = [ self.__collect ]
+        if self.address is not None:
+            self.httpd = HTTPServer(self.address, MetricsHandler)
+            self.httpd.metrics = self
+            targets.append(self.httpd.serve_forever)
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        if self.httpd is not None:
+            logger.info ( 'Metrics served on http://%s:%d/metrics', *self.httpd.server_address );
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def __collect(self):
+        while True:
+            try:
+                pid, sample = self.queue.get(True, 1)
+            except Empty:
+                continue
+            except Exception:
+                logger.debug ( 'Exception reading metrics %s', sys.exc_info()[1] );
+                continue
+            now = time.time()
+            self.lock.acquire()
+            try:
+                previous = self.samples.get(sample[0])
+                if previous is not None and previous[0] == pid and now > previous[1]:
+                    self.rates[sample[0]] = (requests(sample) - requests(previous[2])) / (now - previous[1])
+                self.samples[sample[0]] = (pid, now, sample)
+            finally:
+                self.lock.release()
+
+    def forget(self, **labels):
+        """ Stops serving the metrics with these labels, for example those of a stopped agent and of its replicas """
+        labels = tuple(sorted(labels.items()))
+        self.lock.acquire()
+        try:
+            for key in self.samples.keys():
+                if unreplicated(key) == labels:
+                    del self.samples[key]
+                    self.rates.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def rate(self, **labels):
+        """ Requests per second received between the last two samples with these labels, None if unknown """
+        labels = tuple(sorted(labels.items()))
+        total = None
+        self.lock.acquire()
+        try:
+            for key, last in self.samples.items():
+                if unreplicated(key) != labels:
+                    continue
+                # Metrics are sent each second while they change: nothing was received since
+                if time.time() - last[1] > 3:
+                    rate = 0.0
+                else:
+                    rate = self.rates.get(key)
+                if rate is not None:
+                    total = (total or 0.0) + rate
+        finally:
+            self.lock.release()
+        return total
+
+    def current(self):
+        """ Samples currently served: those received and those of this process """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for labels, (pid, received, sample) in self.samples.items():
+                if now - received > self.expiry:
+                    del self.samples[labels]
+                    self.rates.pop(labels, None)
+            samples = [ sample for _, _, sample in self.samples.values() ]
+        finally:
+            self.lock.release()
+        samples.extend( [ metrics.sample() for metrics in list(Metrics.all) if metrics.pid == os.getpid() ] )
+        return merge(samples)
+
+    def render(self):
+        """ Metrics in Prometheus text exposition format """
+        # Series of each metric
+        series = {}
+        for labels, counters, histograms in self.current():
+            for (name, own), value in counters.items():
+                series.setdefault(name, []).append( (labels + own, value) )
+            for (name, own), value in histograms.items():
+                series.setdefault(name, []).append( (labels + own, value) )
+
+        lines = []
+        for name in sorted(series):
+            kind, text, _ = definitions[name]
+            lines.append( '# HELP %s %s' % (name, text) )
+            lines.append( '# TYPE %s %s' % (name, kind) )
+            for labels, value in sorted(series[name], key=lambda serie: serie[0]):
+                if kind != 'histogram':
+                    lines.append( '%s%s %s' % (name, formatLabels(labels), formatValue(value)) )
+                    continue
+                buckets, counts, total = value
+                cumulated = 0
+                for bound, count in zip(buckets + (float('inf'),), counts):
+                    cumulated += count
+                    lines.append( '%s_bucket%s %d' % (name, formatLabels(labels + (('le', formatValue(bound)),)), cumulated) )
+                lines.append( '%s_sum%s %s' % (name, formatLabels(labels), formatValue(total)) )
+                lines.append( '%s_count%s %d' % (name, formatLabels(labels), cumulated) )
+        return '\n'.join(lines) + '\n'
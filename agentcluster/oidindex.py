@@ -0,0 +1,388 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Compact OID index file
+#
+# The file is made of:
+#   - a fixed size header,
+#   - a metadata block: null separated list of names and values,
+#   - a table of fixed size entries sorted by OID,
+#   - a blob with the OID keys,
+#   - a blob with the values,
+#   - a table of the source lines: hash of each line and entry of the record read from it.
+#
+# OID keys are encoded as a sequence of 32 bits big endian sub identifiers. With this encoding, byte
+# comparison of two keys gives the same result as OID comparison: 1.3.6.1.2 < 1.3.6.1.10 and a parent
+# always comes before its children. Then get-next is a simple binary search in the entry table.
+#
+# Records are sorted by runs of bounded size written to temporary files, then the runs are merged
+# while the index is written: building an index needs the same memory whatever the size of the source.
+#
+# The table of source lines allows to rebuild the index of a modified source by parsing only the
+# modified lines: records of unchanged lines are merged from the previous index, already sorted, with
+# the records of the modified ones. Records overridden by a later line with the same OID are kept after
+# the sorted entries for this purpose.
+#
+from agentcluster.exception import ClusterException
+import array
+import bisect
+import hashlib
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+__all__ = ["OidIndex", "OidIndexWriter", "encodeOid", "decodeOid", "hashLine"]
+
+# Magic string and version of the file format
+MAGIC   = 'AGCLIDX\0'
+FORMAT  = 2
+
+# magic, format, nb records, nb entries, meta offset, meta length, table offset, keys offset, values offset, lines offset, nb lines
+HEADER  = struct.Struct('>8sHIIIIIIIII')
+# key offset, key length, value offset, value length
+ENTRY   = struct.Struct('>IIII')
+# subtree flag, tag index
+VALUE   = struct.Struct('>BH')
+# line hash, entry of the record read from this line
+LINE    = struct.Struct('>8sI')
+# Entry of a line without record
+NO_ENTRY = 0xFFFFFFFF
+# Record in a temporary sorted run: key length, sequence number, value length
+RUN     = struct.Struct('>III')
+
+def encodeOid( oid ):
+    """ Encodes an OID (sequence of integers) as a sortable binary key """
+    return struct.pack('>%dI' % len(oid), *oid)
+
+def decodeOid( key ):
+    """ Decodes a binary key into an OID tuple """
+    return struct.unpack('>%dI' % (len(key)//4), key)
+
+def hashLine( line ):
+    """ Short hash of a source line, used to find the lines modified between two versions of a source """
+    return hashlib.md5(line).digest()[:8]
+
+class OidIndexWriter:
+    """
+        Collects records and writes them as a sorted index file.
+        Records are sorted by runs of runSize records written to temporary files, and the runs are merged
+        when the index is written: besides the current run, only 4 bytes per record are kept in memory.
+        When a base index is given, the records kept from it are merged as they are sorted in the base.
+        Records are added either all with their source line or all without: the sequence number of a
+        record is the number of its line when lines are given.
+    """
+
+    # Max number of records sorted in memory
+    runSize = 100000
+
+    def __init__(self, path, base=None):
+        self.path     = path
+        self.tags     = []
+        self.count    = 0
+        self.__tagIdx = {}
+        self.__run    = []
+        self.__runs   = []
+        # Hash of each source line with the sequence number of its record
+        self.__lines  = self.__temporary()
+        self.__nbLines = 0
+        # Index the unchanged records are taken from, with the sequence number of each of its sorted records kept
+        self.__base   = base
+        if base is not None:
+            # Tags keep their position: values of the base are copied as they are
+            for tag in base.tags:
+                self.__tagIndex(tag)
+            self.__kept = array.array('I', [NO_ENTRY]) * len(base)
+
+    def __temporary(self):
+        # Next to the index: the cache directory is expected to have room for it
+        return tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.path)))
+
+    def add(self, oid, subtree, tag, value, line=None):
+        """
+            Adds a record, when the same OID is added twice the last one wins.
+            The hash of the source line of the record is given to record it in the table of lines.
+        """
+        self.__addRecord( encodeOid(oid), VALUE.pack(subtree and 1 or 0, self.__tagIndex(tag)) + value, line )
+
+    def addLine(self, line):
+        """ Adds the hash of a source line without record """
+        self.__addLine(line, NO_ENTRY)
+
+    def keep(self, line, entry):
+        """
+            Adds a source line found in the base index, with the entry of its record in the base or -1.
+            Each entry is kept once. A sorted record keeps its place: it is merged with the others when
+            the index is written.
+        """
+        if entry < 0:
+            self.addLine(line)
+        elif entry < len(self.__kept):
+            self.__kept[entry] = self.__nbLines
+            self.__addLine(line, self.__nbLines)
+            self.count += 1
+        else:
+            # Overridden in the base, it may not be any more
+            self.__addRecord( *(self.__base.raw(entry) + (line,)) )
+
+    def __tagIndex(self, tag):
+        if tag not in self.__tagIdx:
+            self.__tagIdx[tag] = len(self.tags)
+            self.tags.append(tag)
+        return self.__tagIdx[tag]
+
+    def __addRecord(self, key, value, line):
+        if line is not None:
+            sequence = self.__nbLines
+            self.__addLine(line, sequence)
+        else:
+            sequence = self.count
+        self.__run.append( ( key, sequence, value ) )
+        self.count += 1
+        if len(self.__run) >= self.runSize:
+            self.__flushRun()
+
+    def __addLine(self, line, sequence):
+        self.__lines.write( LINE.pack(line, sequence) )
+        self.__nbLines += 1
+
+    def __flushRun(self):
+        """ Sorts the records in memory and writes them as a run in a temporary file """
+        self.__run.sort()
+        run = self.__temporary()
+        for key, sequence, value in self.__run:
+            run.write( RUN.pack(len(key), sequence, len(value)) )
+            run.write( key )
+            run.write( value )
+        run.seek(0)
+        self.__runs.append(run)
+        self.__run = []
+
+    def __readRun(self, run):
+        while True:
+            header = run.read(RUN.size)
+            if not header:
+                return
+            kl, sequence, vl = RUN.unpack(header)
+            yield run.read(kl), sequence, run.read(vl)
+
+    def __readKept(self):
+        """ Records kept from the base index, in its order """
+        for entry, sequence in enumerate(self.__kept):
+            if sequence != NO_ENTRY:
+                key, value = self.__base.raw(entry)
+                yield key, sequence, value
+
+    def __sorted(self):
+        """ All records sorted by key then by order of addition """
+        # A single run is merged from memory, without temporary file
+        if not self.__runs and self.__base is None:
+            self.__run.sort()
+            return iter(self.__run)
+        if self.__run:
+            self.__flushRun()
+        runs = [ self.__readRun(run) for run in self.__runs ]
+        if self.__base is not None:
+            runs.append(self.__readKept())
+        return heapq.merge( *runs )
+
+    def write(self, meta):
+        """ Sorts the records and writes the index file, returns the number of records written """
+        meta = dict(meta)
+        meta['__tags__'] = ','.join(self.tags)
+        metaBlob = ''.join( [ '%s\0%s\0' % (name, value) for name, value in meta.items() ] )
+
+        # Entry of each record in the table, indexed by sequence number
+        entryOf = array.array('I', [NO_ENTRY]) * max(self.count, self.__nbLines)
+        blobs = _Blobs(self.__temporary)
+        # Overridden records are stored after the sorted ones, out of reach of the searches
+        overridden = self.__temporary()
+        previous = None
+        for record in self.__sorted():
+            if previous is not None:
+                key, sequence, value = previous
+                if key == record[0]:
+                    # For duplicated keys the last added is the last one after sort
+                    overridden.write( RUN.pack(len(key), sequence, len(value)) + key + value )
+                else:
+                    entryOf[sequence] = blobs.add(key, value)
+            previous = record
+        if previous is not None:
+            key, sequence, value = previous
+            entryOf[sequence] = blobs.add(key, value)
+        winners = blobs.count
+        overridden.seek(0)
+        for key, sequence, value in self.__readRun(overridden):
+            entryOf[sequence] = blobs.add(key, value)
+        overridden.close()
+
+        meta_offset   = HEADER.size
+        table_offset  = meta_offset + len(metaBlob)
+        keys_offset   = table_offset + ENTRY.size*blobs.count
+        values_offset = keys_offset + blobs.keys_len
+        lines_offset  = values_offset + blobs.values_len
+
+        out = open(self.path, 'wb')
+        try:
+            out.write( HEADER.pack(MAGIC, FORMAT, winners, blobs.count, meta_offset, len(metaBlob),
+                                   table_offset, keys_offset, values_offset, lines_offset, self.__nbLines) )
+            out.write( metaBlob )
+            blobs.copy(out)
+            # Lines reference their record by entry, known only now
+            self.__lines.seek(0)
+            while True:
+                chunk = self.__lines.read(LINE.size * 4096)
+                if not chunk:
+                    break
+                for offset in xrange(0, len(chunk), LINE.size):
+                    line, sequence = LINE.unpack_from(chunk, offset)
+                    out.write( LINE.pack(line, entryOf[sequence] if sequence != NO_ENTRY else NO_ENTRY) )
+        finally:
+            out.close()
+            blobs.close()
+            for run in self.__runs:
+                run.close()
+            self.__lines.close()
+        self.__run  = []
+        self.__runs = []
+        return winners
+
+class _Blobs:
+    """ Table, keys and values of an index being written, in temporary files until their sizes are known """
+
+    def __init__(self, temporary):
+        self.table      = temporary()
+        self.keys       = temporary()
+        self.values     = temporary()
+        self.count      = 0
+        self.keys_len   = 0
+        self.values_len = 0
+
+    def add(self, key, value):
+        """ Adds a record after the previous ones, returns its entry """
+        self.table.write( ENTRY.pack(self.keys_len, len(key), self.values_len, len(value)) )
+        self.keys.write(key)
+        self.values.write(value)
+        self.keys_len   += len(key)
+        self.values_len += len(value)
+        self.count      += 1
+        return self.count - 1
+
+    def copy(self, out):
+        for blob in [ self.table, self.keys, self.values ]:
+            blob.seek(0)
+            shutil.copyfileobj(blob, out)
+
+    def close(self):
+        for blob in [ self.table, self.keys, self.values ]:
+            blob.close()
+
+class _Keys:
+    """
+        Sequence view on the keys of an index, used for binary search.
+        Built for each search: the index does not reference it, then nothing but its users keeps an index
+        alive and its memory map is released as soon as its last user drops it.
+    """
+    def __init__(self, index):
+        self.index = index
+    def __len__(self):
+        return len(self.index)
+    def __getitem__(self, i):
+        return self.index.key(i)
+
+class OidIndex:
+    """ Read only access to an index file through a memory map """
+
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            magic, fmt = HEADER.unpack_from(self.__map, 0)[0:2]
+            if magic != MAGIC or fmt != FORMAT:
+                raise ClusterException('Not an index file or unsupported format: %s' % path)
+            ( _, _, self.__count, _, meta_offset, meta_len, self.__table,
+              self.__keys, self.__values, self.__lines, self.__nbLines ) = HEADER.unpack_from(self.__map, 0)
+            fields = self.__map[meta_offset:meta_offset+meta_len].split('\0')
+            self.meta = dict( zip(fields[0:-1:2], fields[1::2]) )
+            self.tags = self.meta['__tags__'].split(',')
+        except:
+            self.__map.close()
+            raise
+
+    def __len__(self):
+        return self.__count
+
+    def close(self):
+        self.__map.close()
+
+    def key(self, i):
+        """ Binary key of the i-th record """
+        ko, kl, _, _ = ENTRY.unpack_from(self.__map, self.__table + i*ENTRY.size)
+        ko += self.__keys
+        return self.__map[ko:ko+kl]
+
+    def record(self, i):
+        """ i-th record as a tuple: oid, subtree flag, tag, value """
+        ko, kl, vo, vl = ENTRY.unpack_from(self.__map, self.__table + i*ENTRY.size)
+        ko += self.__keys
+        vo += self.__values
+        subtree, tag = VALUE.unpack_from(self.__map, vo)
+        return decodeOid(self.__map[ko:ko+kl]), subtree, self.tags[tag], self.__map[vo+VALUE.size:vo+vl]
+
+    def find(self, oid):
+        """ Position of the record with exactly this OID, -1 if there is no such record """
+        key = encodeOid(oid)
+        i = bisect.bisect_left(_Keys(self), key)
+        if i < self.__count and self.key(i) == key:
+            return i
+        return -1
+
+    def findNext(self, oid):
+        """ Position of the first record strictly after this OID, len(self) if there is none """
+        return bisect.bisect_right(_Keys(self), encodeOid(oid))
+
+    def records(self):
+        """ Iterates over all records in OID order """
+        for i in xrange(self.__count):
+            yield self.record(i)
+
+    def raw(self, i):
+        """ Binary key and value of the i-th record as they are stored """
+        ko, kl, vo, vl = ENTRY.unpack_from(self.__map, self.__table + i*ENTRY.size)
+        ko += self.__keys
+        vo += self.__values
+        return self.__map[ko:ko+kl], self.__map[vo:vo+vl]
+
+    def countLines(self):
+        """ Number of lines of the source """
+        return self.__nbLines
+
+    def lineHash(self, i):
+        """ Hash of the i-th line of the source """
+        return LINE.unpack_from(self.__map, self.__lines + i*LINE.size)[0]
+
+    def lines(self, start=0, stop=None):
+        """ Iterates over the table of the source lines from start to stop: tuples (line hash, entry of its record or -1) """
+        if stop is None:
+            stop = self.__nbLines
+        for i in xrange(start, stop):
+            line, entry = LINE.unpack_from(self.__map, self.__lines + i*LINE.size)
+            yield line, entry if entry != NO_ENTRY else -1
@@ -0,0 +1,209 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Profiling of the agents, switched on and off at runtime
+#
+# When profiling is on, each agent of the process traces its requests: the transport reading its endpoints
+# and the SNMP engine methods handling the phases of a request are wrapped to time them as nested spans. Meanwhile the stack of the dispatcher
+# is sampled on each SIGPROF. Nothing is wrapped nor sampled when profiling is off.
+#
+# When profiling is switched off, both are written in collapsed stack format, one line per stack followed
+# by its weight, that flamegraph.pl reads as it is:
+#   <agent>.<pid>.trace.folded    time spent by the agent in each phase, in microseconds
+#   <agent>.<pid>.samples.folded  stacks sampled while the agent was handling a request
+#   <process>.<pid>.samples.folded stacks sampled outside of requests
+#
+from agentcluster.snapshot import SnapshotFileController
+import logging
+import os
+import signal
+import sys
+import time
+
+__all__ = ["Profiler", "Tracer"]
+logger = logging.getLogger('agentcluster.profiler')
+
+class Tracer:
+    """
+        Times the phases of the requests handled by one SNMP engine, spans are named after the phases:
+          receive  read of the incoming messages on an endpoint, contains the requests of the messages read
+          request  whole handling of an incoming message, from its decoding to the response queued
+          decode   message decoding, including security processing
+          security community or USM processing: authentication, encryption
+          lookup   reading of the variables in the snapshot
+          encode   response encoding, including security processing
+        Each span is weighted with its own time, without the time of the spans it contains.
+    """
+
+    # Tracer of the request in progress, None between requests
+    current = None
+
+    def __init__(self, name):
+        self.name    = name
+        # Spans in progress: [path, start time, time of the spans contained]
+        self.spans   = []
+        # Own time of each span in seconds, indexed by path
+        self.times   = {}
+        # Methods wrapped: (object, name, original method or None if inherited)
+        self.wrapped = []
+
+    def enter(self, phase):
+        if self.spans:
+            path = self.spans[-1][0] + ';' + phase
+        else:
+            path = self.name + ';' + phase
+            Tracer.current = self
+        self.spans.append( [path, time.time(), 0.0] )
+
+    def leave(self):
+        # Spans started before the tracer was reset are ignored
+        if not self.spans:
+            return
+        path, start, contained = self.spans.pop()
+        elapsed = time.time() - start
+        self.times[path] = self.times.get(path, 0.0) + elapsed - contained
+        if self.spans:
+            self.spans[-1][2] += elapsed
+        elif Tracer.current is self:
+            Tracer.current = None
+
+    def wrap(self, obj, name, phase):
+        """ Replaces the method of this object by a version timing it in a span """
+        method = getattr(obj, name)
+        def traced(*args, **kwargs):
+            self.enter(phase)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.leave()
+        self.wrapped.append( (obj, name, obj.__dict__.get(name)) )
+        setattr(obj, name, traced)
+
+    def attach(self, snmpEngine, snmpContext, domains=()):
+        """ Wraps the methods of this engine, of the transports of these domains and of the snapshots of its contexts """
+        for domain in domains:
+            self.wrap(snmpEngine.transportDispatcher.getTransport(domain), 'handle_read', 'receive')
+        self.wrap(snmpEngine.msgAndPduDsp, 'receiveMessage', 'request')
+        for mpModel in snmpEngine.messageProcessingSubsystems.values():
+            self.wrap(mpModel, 'prepareDataElements', 'decode')
+            self.wrap(mpModel, 'prepareResponseMessage', 'encode')
+        for securityModel in snmpEngine.securityModels.values():
+            self.wrap(securityModel, 'processIncomingMsg', 'security')
+            self.wrap(securityModel, 'generateResponseMsg', 'security')
+        for mibInstrum in snmpContext.contextNames.values():
+            if isinstance(mibInstrum, SnapshotFileController):
+                for name in ('readVars', 'readNextVars', 'readBulkVars', 'writeVars'):
+                    self.wrap(mibInstrum, name, 'lookup')
+
+    def detach(self):
+        """ Restores the methods wrapped """
+        for obj, name, original in reversed(self.wrapped):
+            if original is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, original)
+        self.wrapped = []
+        self.spans   = []
+        if Tracer.current is self:
+            Tracer.current = None
+
+    def folded(self):
+        """ Time of each span in microseconds, in collapsed stack format """
+        return [ '%s %d' % (path, seconds * 1000000) for path, seconds in sorted(self.times.items()) ]
+
+class Profiler:
+    """
+        Profiles the agents of this process: traces their requests and samples the stack of the dispatcher.
+        Samples are attributed to the agent whose request is in progress.
+    """
+
+    # Time in seconds of processor used between 2 samples
+    interval = 0.005
+
+    def __init__(self, name, directory):
+        self.name      = name
+        self.directory = directory
+        self.tracers   = []
+        # Number of times each stack was sampled, indexed by agent or process name, then by stack
+        self.samples   = {}
+        self.running   = False
+
+    def toggle(self, agents):
+        """ Starts profiling these agents, or stops profiling if it is in progress """
+        if self.running:
+            self.stop()
+        else:
+            self.start(agents)
+
+    def start(self, agents):
+        for agent in agents:
+            if agent.snmpEngine is None:
+                continue
+            tracer = Tracer(agent.name)
+            tracer.attach(agent.snmpEngine, agent.snmpContext, agent.domains)
+            self.tracers.append(tracer)
+        self.samples = {}
+        self.running = True
+        signal.signal(signal.SIGPROF, self.sample)
+        # System calls interrupted by a sample are resumed instead of failing with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, Profiler.interval, Profiler.interval)
+        logger.info ( '%s: profiling started for %d agents', self.name, len(self.tracers) );
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.running = False
+        for tracer in self.tracers:
+            tracer.detach()
+        try:
+            self.dump()
+        except Exception:
+            logger.error ( '%s: cannot write profile in %s: %s', self.name, self.directory, sys.exc_info()[1] );
+            logger.debug ( "", exc_info=True );
+        self.tracers = []
+        self.samples = {}
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append( '%s:%s' % (os.path.basename(code.co_filename), code.co_name) )
+            frame = frame.f_back
+        stack.reverse()
+        tracer = Tracer.current
+        samples = self.samples.setdefault(tracer.name if tracer is not None else self.name, {})
+        stack = ';'.join(stack)
+        samples[stack] = samples.get(stack, 0) + 1
+
+    def dump(self):
+        """ Writes the traces and samples collected in collapsed stack format """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        pid = os.getpid()
+        files = []
+        for tracer in self.tracers:
+            files.append( ('%s.%d.trace.folded' % (tracer.name, pid), tracer.folded()) )
+        for name, samples in sorted(self.samples.items()):
+            files.append( ('%s.%d.samples.folded' % (name, pid), [ '%s;%s %d' % (name, stack, count) for stack, count in sorted(samples.items()) ]) )
+        for fileName, lines in files:
+            path = os.path.join(self.directory, fileName)
+            out = open(path, 'w')
+            try:
+                for line in lines:
+                    out.write(line + '\n')
+            finally:
+                out.close()
+            logger.info ( '%s: profile written in %s', self.name, path );
@@ -12,12 +12,16 @@
 # GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
-from agentcluster.exception import ClusterException
+from agentcluster.exception import BatchError, ClusterException
 from agentcluster.grammar import abstract
+from pyasn1.codec.ber import encoder
+import sys
 
 class AbstractRecord:
     grammar = abstract.AbstractGrammar()
     ext = ''
+    # Precompiled snapshots are served as they are, without parsing
+    precompiled = False
 
     def evaluateOid(self, oid):
         raise ClusterException('Method not implemented at %s' % self.__class__.__name__)
@@ -28,6 +32,38 @@ class AbstractRecord:
     def evaluateTag(self, tag):
         raise ClusterException('Method not implemented at %s' % self.__class__.__name__)
 
+    def evaluateOids(self, oids):
+        """ Evaluates a column of OIDs as tuples of integers, None for empty ones. Raises BatchError at the first invalid OID """
+        result = []
+        for n, oid in enumerate(oids):
+            if not oid:
+                result.append(None)
+                continue
+            try:
+                result.append( tuple(self.evaluateOid(oid)) )
+            except Exception:
+                raise BatchError(n, sys.exc_info()[1])
+        return result
+
+    def evaluateValues(self, oids, tags, values):
+        """
+            Evaluates columns of parsed lines, returns a column of tag class names and a column of values encoded
+            in BER as stored in the index. Items of empty OIDs are None, the value of a line that cannot be evaluated
+            is the exception raised by its evaluation.
+        """
+        tagNames = []; encoded = []
+        for oid, tag, value in zip(oids, tags, values):
+            tagName = _value = None
+            if oid:
+                try:
+                    tagName = str(self.evaluateTag(tag))
+                    _value  = encoder.encode(self.evaluateValue(oid, tag, value, dataValidation=True))
+                except Exception:
+                    _value  = sys.exc_info()[1]
+            tagNames.append(tagName)
+            encoded.append(_value)
+        return tagNames, encoded
+
     def evaluate(self, line, **context):
         raise ClusterException('Method not implemented at %s' % self.__class__.__name__)
 
@@ -12,13 +12,41 @@
 # GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+from pyasn1.codec.ber import encoder
 from pyasn1.error import PyAsn1Error
-from pyasn1.type import univ
-from agentcluster.exception import ClusterException
+from pyasn1.type import constraint, univ
+from agentcluster.exception import BatchError, ClusterException
 from agentcluster.grammar import dump
 from agentcluster.record import abstract
+import re
 import sys
 
+# Encoders of the values encoded without building them
+_integerEncoder = encoder.IntegerEncoder()
+
+# OID made of decimal sub identifiers without leading zero, converted the same way by int() and univ.ObjectIdentifier
+_decimalOid = re.compile(r'^(0|[1-9][0-9]*)(\.(0|[1-9][0-9]*))*$')
+
+def boundsOf(spec, rangeClass):
+    """
+        Lowest and highest bounds allowed by a set of constraints made only of ranges of the given class,
+        (None, None) if the set contains other constraints.
+    """
+    low = high = None
+    pending = [ spec ]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, constraint.ConstraintsIntersection):
+            pending.extend(item._values)
+        elif getattr(item, '__class__', None) is rangeClass:
+            low  = item.start if low  is None else max(low, item.start)
+            high = item.stop  if high is None else min(high, item.stop)
+        else:
+            return None, None
+    if low is None:
+        return None, None
+    return low, high
+
 class DumpRecord(abstract.AbstractRecord):
     grammar = dump.DumpGrammar()
     ext = 'dump'
@@ -32,6 +60,92 @@ class DumpRecord(abstract.AbstractRecord):
     def evaluateValue(self, oid, tag, value, **context):
         return self.grammar.tagMap[tag](value)
 
+    def evaluateOids(self, oids):
+        """ Same conversion as univ.ObjectIdentifier, without building one object per OID """
+        result = []
+        for n, oid in enumerate(oids):
+            if not oid:
+                result.append(None)
+                continue
+            # Sub identifiers in other bases, signed or empty are left to the usual conversion
+            if not oid.translate(None, '0123456789.') and ( '.0' not in '.'+oid or _decimalOid.match(oid) ):
+                try:
+                    result.append( tuple(map(int, oid.split('.'))) )
+                    continue
+                except ValueError:
+                    pass
+            try:
+                result.append( tuple(self.evaluateOid(oid)) )
+            except Exception:
+                raise BatchError(n, sys.exc_info()[1])
+        return result
+
+    @staticmethod
+    def conversionOf(tagClass):
+        """
+            Conversion of string values of this class done without building the value, None when the value
+            must be built. A conversion is a tuple: 'int' for integers or 'str' for octet strings, the bounds
+            of the value or of its size, and the BER encoded tag of the class. Bounds are None when the
+            constraints of the class are not only value or size ranges.
+        """
+        # Explicitly tagged values are encoded with several tags
+        if len(tagClass.tagSet) != 1:
+            return None
+        tag = _integerEncoder.encodeTag(tagClass.tagSet[-1], 0)
+        if tagClass.prettyIn.im_func is univ.Integer.prettyIn.im_func and tagClass.__str__.im_func is univ.Integer.__str__.im_func \
+                and not len(tagClass.namedValues):
+            return ('int',) + boundsOf(tagClass.subtypeSpec, constraint.ValueRangeConstraint) + (tag,)
+        if tagClass.prettyIn.im_func is univ.OctetString.prettyIn.im_func and tagClass.__str__.im_func is univ.OctetString.__str__.im_func:
+            return ('str',) + boundsOf(tagClass.subtypeSpec, constraint.ValueSizeConstraint) + (tag,)
+        return None
+
+    @staticmethod
+    def encodeConverted(kind, tag, value):
+        """ BER encoding of a converted value, the same as the one of the value built from it """
+        if kind == 'int':
+            contents = _integerEncoder.encodeValue(None, value, 1, 0)[0]
+        else:
+            contents = value
+        return tag + _integerEncoder.encodeLength(len(contents), 1) + contents
+
+    def evaluateValues(self, oids, tags, values):
+        """
+            Integers and octet strings are only checked against the constraints of their class, they are
+            encoded in BER without building the value. Other values, and values failing the check to report
+            the exact error, are evaluated the usual way.
+        """
+        tagNames = []; encoded = []
+        conversions = {}
+        for oid, tag, value in zip(oids, tags, values):
+            tagName = _value = None
+            if oid:
+                try:
+                    tagClass = self.evaluateTag(tag)
+                    tagName  = str(tagClass)
+                    if tagClass not in conversions:
+                        conversions[tagClass] = self.conversionOf(tagClass)
+                    conversion = conversions[tagClass]
+                    _value = None
+                    if conversion is not None and isinstance(value, str):
+                        kind, low, high, berTag = conversion
+                        try:
+                            checked = int(value) if kind == 'int' else value
+                            if low is None:
+                                tagClass.subtypeSpec(checked)
+                                _value = self.encodeConverted(kind, berTag, checked)
+                            elif low <= (checked if kind == 'int' else len(checked)) <= high:
+                                _value = self.encodeConverted(kind, berTag, checked)
+                        except Exception:
+                            # Evaluated the usual way for the exact error
+                            pass
+                    if _value is None:
+                        _value = encoder.encode(self.evaluateValue(oid, tag, value, dataValidation=True))
+                except Exception:
+                    _value = sys.exc_info()[1]
+            tagNames.append(tagName)
+            encoded.append(_value)
+        return tagNames, encoded
+
     def evaluate(self, line, **context):
         oid, tag, value = self.grammar.parse(line)
         oid = self.evaluateOid(oid)
@@ -13,7 +13,7 @@
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 from agentcluster.grammar import snmprec
-from agentcluster.record import dump
+from agentcluster.record import abstract, dump
 
 class SnmprecRecord(dump.DumpRecord):
     grammar = snmprec.SnmprecGrammar()
@@ -32,10 +32,14 @@ class SnmprecRecord(dump.DumpRecord):
             hexvalue = None
 
         if hexvalue is None:
-            return oid, tag, self.grammar.tagMap[tag](value)
+            return self.grammar.tagMap[tag](value)
         else:
             return self.grammar.tagMap[tag](hexValue=hexvalue)
 
+    def evaluateValues(self, oids, tags, values):
+        # Values are not evaluated the DumpRecord way
+        return abstract.AbstractRecord.evaluateValues(self, oids, tags, values)
+
     def formatValue(self, oid, value, **context):
         if 'nohex' in context and context['nohex']:
             hexvalue = None
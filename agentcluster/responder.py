@@ -0,0 +1,143 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Command responders
+#
+# Snapshots answer with varbinds already encoded (see varbind), pysnmp copies them as they are into
+# SNMPv2c and SNMPv3 responses. SNMPv1 responses are converted from SNMPv2 ones by reading their varbinds:
+# they are decoded before.
+#
+from agentcluster.varbind import EncodedVarBind
+from pysnmp import debug
+from pysnmp.entity.rfc3413 import cmdrsp
+from pysnmp.proto.api import v2c
+from pysnmp.smi import exval
+import pysnmp.smi.error
+
+__all__ = ["GetCommandResponder", "SetCommandResponder", "NextCommandResponder", "BulkCommandResponder"]
+
+class EncodedResponderMixin:
+    """ Decodes the encoded varbinds of the responses to SNMPv1 requests, counts requests and responses in the agent metrics """
+
+    def __init__(self, snmpEngine, snmpContext, metrics=None):
+        cmdrsp.CommandResponderBase.__init__(self, snmpEngine, snmpContext)
+        self.metrics = metrics
+        # Requests in progress received as SNMPv1 messages
+        self.v1Requests = set()
+
+    def processPdu(
+        self,
+        snmpEngine,
+        messageProcessingModel,
+        securityModel,
+        securityName,
+        securityLevel,
+        contextEngineId,
+        contextName,
+        pduVersion,
+        PDU,
+        maxSizeResponseScopedPDU,
+        stateReference
+        ):
+        if messageProcessingModel == 0:
+            self.v1Requests.add(stateReference)
+        if self.metrics is not None:
+            self.metrics.inc('agentcluster_requests_total', labels=(('pdu', PDU.__class__.__name__),))
+        try:
+            return cmdrsp.CommandResponderBase.processPdu(
+                self, snmpEngine, messageProcessingModel, securityModel, securityName, securityLevel,
+                contextEngineId, contextName, pduVersion, PDU, maxSizeResponseScopedPDU, stateReference
+                )
+        finally:
+            self.v1Requests.discard(stateReference)
+
+    def sendRsp(self, snmpEngine, stateReference,
+                     errorStatus, errorIndex, varBinds):
+        if self.metrics is not None and not errorStatus:
+            self.metrics.inc('agentcluster_varbinds_total', len(varBinds))
+            for varBind in varBinds:
+                # Records found are encoded, exceptions are not
+                if isinstance(varBind, EncodedVarBind):
+                    continue
+                if varBind[1] is exval.noSuchInstance:
+                    self.metrics.inc('agentcluster_varbind_exceptions_total', labels=(('exception', 'noSuchInstance'),))
+                elif varBind[1] is exval.endOfMib:
+                    self.metrics.inc('agentcluster_varbind_exceptions_total', labels=(('exception', 'endOfMibView'),))
+        if stateReference in self.v1Requests:
+            varBinds = [ varBind.decode() if isinstance(varBind, EncodedVarBind) else varBind for varBind in varBinds ]
+        cmdrsp.CommandResponderBase.sendRsp(
+            self, snmpEngine, stateReference, errorStatus, errorIndex, varBinds
+            )
+
+class GetCommandResponder(EncodedResponderMixin, cmdrsp.GetCommandResponder):
+    pass
+
+class SetCommandResponder(EncodedResponderMixin, cmdrsp.SetCommandResponder):
+    pass
+
+class NextCommandResponder(EncodedResponderMixin, cmdrsp.NextCommandResponder):
+    pass
+
+class BulkCommandResponder(EncodedResponderMixin, cmdrsp.BulkCommandResponder):
+    """
+        Get-bulk responder asking the MIB for all the repetitions at once when the MIB supports it
+        (method readBulkVars), instead of one get-next request per repetition.
+    """
+
+    # rfc1905: 4.2.3
+    def handleMgmtOperation(
+        self, snmpEngine, stateReference, contextName, PDU, acInfo
+        ):
+        mibInstrum = self.snmpContext.getMibInstrum(contextName)
+        if not hasattr(mibInstrum, 'readBulkVars'):
+            return cmdrsp.BulkCommandResponder.handleMgmtOperation(
+                self, snmpEngine, stateReference, contextName, PDU, acInfo
+                )
+
+        (acFun, acCtx) = acInfo
+        nonRepeaters = v2c.apiBulkPDU.getNonRepeaters(PDU)
+        if nonRepeaters < 0:
+            nonRepeaters = 0
+        maxRepetitions = v2c.apiBulkPDU.getMaxRepetitions(PDU)
+        if maxRepetitions < 0:
+            maxRepetitions = 0
+
+        reqVarBinds = v2c.apiPDU.getVarBinds(PDU)
+
+        N = min(int(nonRepeaters), len(reqVarBinds))
+        M = int(maxRepetitions)
+        R = max(len(reqVarBinds)-N, 0)
+
+        if R: M = min(M, self.maxVarBinds//R)
+
+        debug.logger & debug.flagApp and debug.logger('handleMgmtOperation: N %d, M %d, R %d' % (N, M, R))
+
+        if N:
+            rspVarBinds = mibInstrum.readNextVars(reqVarBinds[:N], (acFun, acCtx))
+        else:
+            rspVarBinds = []
+
+        if M and R:
+            rspVarBinds.extend(
+                mibInstrum.readBulkVars(reqVarBinds[-R:], M, (acFun, acCtx))
+                )
+
+        if len(rspVarBinds):
+            self.sendRsp(
+                snmpEngine, stateReference, 0, 0, rspVarBinds
+                )
+            self.releaseStateInformation(stateReference)
+        else:
+            raise pysnmp.smi.error.SmiError()
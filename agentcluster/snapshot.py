@@ -12,69 +12,194 @@
 # GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
-from agentcluster.database import Database, oid2str
-from pyasn1.type import univ
+from agentcluster.database import Database
+from agentcluster.lrucache import HandleCache, LruCache
 from pysnmp.smi import exval
 from pysnmp.smi.instrum import AbstractMibInstrumController
 import logging
+import pysnmp.smi.error
+import Queue
+import sys
+import threading
+import time
 
 __all__ = ["SnapshotFile", "SnapshotFileController"]
 logger = logging.getLogger('agentcluster.snapshot')
 
+class SnapshotBuilder:
+    """
+        Builds the indexes of the snapshots of this process in the background, in a few daemon threads
+        started on the first build: requests are answered meanwhile, small snapshots do not wait for big ones.
+    """
+
+    def __init__(self, threads):
+        self.threads  = threads
+        self.queue    = Queue.Queue()
+        # Snapshots queued or being built
+        self.pending  = set()
+        self.__workers = []
+        self.__lock   = threading.Lock()
+
+    def submit(self, snapshot, key):
+        """ Queues the build of a snapshot unless it is already pending """
+        self.__lock.acquire()
+        try:
+            if snapshot in self.pending:
+                return
+            self.pending.add(snapshot)
+            self.__workers = [ worker for worker in self.__workers if worker.is_alive() ]
+            while len(self.__workers) < self.threads:
+                worker = threading.Thread(target=self.__run, name='builder')
+                worker.daemon = True
+                worker.start()
+                self.__workers.append(worker)
+        finally:
+            self.__lock.release()
+        self.queue.put( (snapshot, key) )
+
+    def __run(self):
+        while True:
+            snapshot, key = self.queue.get()
+            try:
+                snapshot.build(key)
+            finally:
+                self.__lock.acquire()
+                self.pending.discard(snapshot)
+                self.__lock.release()
+
 class SnapshotFile (AbstractMibInstrumController):
 
-    openedQueue = []
-    maxQueueEntries = 15  # max number of open text and index files
+    # Opened snapshots of this process, the least recently used ones are closed first
+    handles = HandleCache(15)
+
+    # Builds the indexes of this process in the background
+    builder = SnapshotBuilder(2)
+
+    # Errors of the snapshots whose index could not be built, indexed by file and checksum: a snapshot
+    # is not parsed again before its content changes
+    failures = {}
 
-    def __init__(self, textFile, textParser):
+    def __init__(self, textFile, textParser, metrics=None):
         self.__textParser = textParser
         self.__textFile = textFile
-        self._db = Database(self.__textFile, self.__textParser)
+        # Metrics of the agent serving this snapshot, None if not measured
+        self.metrics = metrics
+        self._db = Database(self.__textFile, self.__textParser, metrics)
 
     def indexText(self):
         self._db.create()
         return self
 
+    def isOpen(self):
+        return self._db.isOpen()
+
+    def open(self):
+        """
+            Opens the index of the snapshot. An index not built yet is built in the background and the
+            snapshot is not available until then: the request fails, not the agent nor the other agents
+            of the process.
+        """
+        if not self._db.isBuilt():
+            self.__submit()
+        try:
+            self._db.open()
+        except Exception:
+            logger.error ( 'Cannot open snapshot %s: %s', self.__textFile, sys.exc_info()[1] );
+            logger.debug ( "", exc_info=True );
+            raise pysnmp.smi.error.SmiError('snapshot not available')
+
+    def __submit(self):
+        """ Queues the build of the index unless it already failed for this content, raises SmiError """
+        try:
+            sourceSum = self._db.sourceSum()
+        except (IOError, OSError):
+            sourceSum = None
+        key = (self.__textFile, sourceSum)
+        if key in SnapshotFile.failures:
+            raise pysnmp.smi.error.SmiError('snapshot not available: %s' % SnapshotFile.failures[key])
+        SnapshotFile.builder.submit(self, key)
+        raise pysnmp.smi.error.SmiError('snapshot not available yet')
+
+    def build(self, key):
+        """ Builds the index, called by the builder. A failure is remembered for this content """
+        logger.debug ( 'Building snapshot %s', self.__textFile );
+        try:
+            self._db.refresh()
+        except Exception:
+            SnapshotFile.failures[key] = str(sys.exc_info()[1])
+            logger.error ( 'Cannot open snapshot %s: %s', self.__textFile, sys.exc_info()[1] );
+            logger.debug ( "", exc_info=True );
+
     def close(self):
         self._db.close()
 
-    def openDb(self):
-        if not self._db.isOpen():
-            if len(SnapshotFile.openedQueue) > self.maxQueueEntries:
-                SnapshotFile.openedQueue[0].close()
-                del SnapshotFile.openedQueue[0]
-            SnapshotFile.openedQueue.append(self)
-            self._db.open()
+    def generation(self):
+        """ Changes each time the content served changes """
+        return self._db.generation
 
     def processVarBinds(self, varBinds, nextFlag=False, setFlag=False):
-
-        self.openDb()
-
+        """ Records found are returned as EncodedVarBind, see responder """
+        start = time.time()
+        SnapshotFile.handles.acquire(self)
+        try:
+            return self.__processVarBinds(varBinds, nextFlag)
+        finally:
+            SnapshotFile.handles.release(self)
+            if self.metrics is not None:
+                operation = setFlag and 'set' or nextFlag and 'getnext' or 'get'
+                self.metrics.observe('agentcluster_lookup_seconds', time.time()-start, (('operation', operation),))
+
+    def __processVarBinds(self, varBinds, nextFlag):
         rspVarBinds = []
         for oid,_ in varBinds: 
-            textOid = str( univ.OctetString( oid2str(oid) ) )
 
             if nextFlag:
                 try:
-                    (_oid, _, _tag, _val) = self._db.lookup_next( textOid )
-                    subtreeFlag = False
+                    varBind = self._db.lookup_next( tuple(oid), encoded=True )
                 except KeyError:
                     rspVarBinds.append((oid, exval.endOfMib))
                     continue
             else:
                 try:
-                    (_oid, subtreeFlag, _tag, _val) = self._db.lookup( textOid )
-                    subtreeFlag, int(subtreeFlag), True
+                    varBind = self._db.lookup( tuple(oid), encoded=True )
                 except KeyError:
                     rspVarBinds.append((oid, exval.noSuchInstance))
                     continue
 
-            # _oid     = parser.evaluateOid(_oid)
-            # _,_,_val = parser.evaluateValue(_oid,_tag,_val)
-            rspVarBinds.append ( ( _oid, _val ) )
+            rspVarBinds.append ( varBind )
 
         return rspVarBinds
  
+    def processBulkVarBinds(self, varBinds, maxRepetitions):
+        """
+            Returns the maxRepetitions successors of each variable, interleaved the same way as successive
+            get-next requests would return them. Successors of a variable are read in a single index scan.
+        """
+        start = time.time()
+        SnapshotFile.handles.acquire(self)
+        try:
+            return self.__processBulkVarBinds(varBinds, maxRepetitions)
+        finally:
+            SnapshotFile.handles.release(self)
+            if self.metrics is not None:
+                self.metrics.observe('agentcluster_lookup_seconds', time.time()-start, (('operation', 'getbulk'),))
+
+    def __processBulkVarBinds(self, varBinds, maxRepetitions):
+        columns = []
+        for oid,_ in varBinds:
+            column = self._db.lookup_range( tuple(oid), maxRepetitions, encoded=True )
+            # Past the end of the MIB, get-next answers endOfMib with the last OID
+            if column:
+                oid = column[-1].oid
+            column.extend( [ (oid, exval.endOfMib) ] * (maxRepetitions-len(column)) )
+            columns.append(column)
+
+        rspVarBinds = []
+        for repetition in range(maxRepetitions):
+            for column in columns:
+                rspVarBinds.append(column[repetition])
+        return rspVarBinds
+
     def __str__(self):
         return str(self._db)
 
@@ -82,17 +207,34 @@ class SnapshotFile (AbstractMibInstrumController):
 # Maps one or more snapshot file to SNMP engine
 #
 class SnapshotFileController (AbstractMibInstrumController):
+
+    # Latest responses of this process, shared by all the snapshots. Keyed by the generation of
+    # the snapshot: responses computed before a refresh are never found again and get evicted
+    responses = LruCache(1000)
+
     def __init__(self, dataFile):
         self.__dataFile = dataFile
 
     def __str__(self): return str(self.__dataFile)
 
+    def __respond(self, process, varBinds, *args):
+        """ Response of the data file to these varbinds, from the cache when the same request was already answered """
+        key = (self.__dataFile.generation(), process.__name__) + args + tuple([ tuple(oid) for oid,_ in varBinds ])
+        rspVarBinds = SnapshotFileController.responses.get(key)
+        if rspVarBinds is None:
+            rspVarBinds = tuple(process(varBinds, *args))
+            SnapshotFileController.responses.put(key, rspVarBinds)
+        # Responders append to the list they get
+        return list(rspVarBinds)
+
     def readVars(self, varBinds, acInfo=None):
-        return self.__dataFile.processVarBinds(varBinds, False)
+        return self.__respond(self.__dataFile.processVarBinds, varBinds, False)
 
     def readNextVars(self, varBinds, acInfo=None):
-        return self.__dataFile.processVarBinds(varBinds, True)
+        return self.__respond(self.__dataFile.processVarBinds, varBinds, True)
+
+    def readBulkVars(self, varBinds, maxRepetitions, acInfo=None):
+        return self.__respond(self.__dataFile.processBulkVarBinds, varBinds, maxRepetitions)
 
     def writeVars(self, varBinds, acInfo=None):
         return self.__dataFile.processVarBinds(varBinds, False, True)
-
@@ -14,8 +14,9 @@
 #
 from pysnmp.entity import config
 from agentcluster.exception import ClusterException
-from agentcluster.record import dump, mvc, sap, walk, snmprec
+from agentcluster.record import dump, image, mvc, sap, walk, snmprec
 from agentcluster.snapshot import SnapshotFile, SnapshotFileController
+from agentcluster.usmkeys import addV3User
 import logging
 import os
 
@@ -23,14 +24,23 @@ __all__ = ["SnmpConfHelperV1", "SnmpConfHelperV2", "SnmpConfHelperV3"]
 logger = logging.getLogger('agentcluster.snmp')
 
 class SnmpConfHelperBase:
+
+    # Snapshots are checked and indexed on their first use instead of when the agent starts. Inherited by agents and workers
+    lazy = False
+
     recordSet = {
         dump.DumpRecord.ext: dump.DumpRecord(),
         mvc.MvcRecord.ext: mvc.MvcRecord(),
         sap.SapRecord.ext: sap.SapRecord(),
         walk.WalkRecord.ext: walk.WalkRecord(),
-        snmprec.SnmprecRecord.ext: snmprec.SnmprecRecord()
+        snmprec.SnmprecRecord.ext: snmprec.SnmprecRecord(),
+        image.ImageRecord.ext: image.ImageRecord()
     }
 
+    def __init__(self, metrics=None):
+        # Metrics of the agent configured
+        self.metrics = metrics
+
     def configure(self, snmpEngine, snmpContext, params):
         if (params is None) or (params.users is None):
             msg = 'Snmp configuration needs at least one user'
@@ -47,13 +57,16 @@ class SnmpConfHelperBase:
             msg = 'Usupported snapshot file extension, snapshot ignored %s' % (snapshotFullPath)
             logger.warning ( msg );
             return;
-        snapshotFile = SnapshotFile( snapshotFullPath, self.recordSet[dExt]).indexText()
+        snapshotFile = SnapshotFile( snapshotFullPath, self.recordSet[dExt], self.metrics)
+        if not self.lazy:
+            snapshotFile.indexText()
         return SnapshotFileController(snapshotFile)
 
 class SnmpConfHelperV1(SnmpConfHelperBase):
     version="V1"
 
-    def __init__(self):
+    def __init__(self, metrics=None):
+        SnmpConfHelperBase.__init__(self, metrics)
         # List of contexts indexed by community
         self.contexts = {};
 
@@ -115,49 +128,65 @@ class SnmpConfHelperV3(SnmpConfHelperBase):
             # Registers the new context
             snmpContext.registerContextName(contextName, mibInstrum)
 
-    def _configureUsers(self, snmpEngine, snmpContext, params):
-        logger.debug ( 'Configure users' );
+    def passwords(self, params):
+        """ Passwords of the users to hash, as entries of the USM key cache: (auth protocol, priv protocol or None, password) """
+        entries = []
         for user in params.users:
-            logger.debug ( 'Creating user "%s"', user.name );
-
-            # Parse authentication algorithm
-            authAlgo = config.usmNoAuthProtocol;
-            if user.authAlgo is not None:
-                if not user.authAlgo in self.authAlgorithms:
-                    msg = 'Invalid snmp V3 Authentification algorithm %s. Valid values are: %s' % (user.authAlgo, self.authAlgorithms.keys())
-                    logger.error ( msg );
-                    raise ClusterException(msg);
-                else:
-                    authAlgo = self.authAlgorithms[user.authAlgo.lower()];
-
-            # Parse privacy algorithm
-            privAlgo = config.usmNoPrivProtocol;
-            if user.privAlgo is not None:
-                if not user.privAlgo in self.privAlgorithms:
-                    msg = 'Invalid snmp V3 Privacy algorithm %s. Valid values are: %s' % (user.privAlgo, self.privAlgorithms.keys())
-                    logger.error ( msg );
-                    raise ClusterException(msg);
-                else:
-                    privAlgo = self.privAlgorithms[user.privAlgo.lower()];
-
-            # Check provided parameters
-            if authAlgo==config.usmNoAuthProtocol and privAlgo!=config.usmNoPrivProtocol:
-                msg = 'Privacy impossible without authentication for user: %s' % (user.name)
+            authAlgo, privAlgo = self._userProtocols(user)
+            if authAlgo!=config.usmNoAuthProtocol:
+                entries.append( (authAlgo, None, user.authPass) )
+            if privAlgo!=config.usmNoPrivProtocol:
+                entries.append( (authAlgo, privAlgo, user.privPass) )
+        return entries
+
+    def _userProtocols(self, user):
+        """ Authentication and privacy protocols of a user, checked with its passwords """
+        # Parse authentication algorithm
+        authAlgo = config.usmNoAuthProtocol;
+        if user.authAlgo is not None:
+            if not user.authAlgo in self.authAlgorithms:
+                msg = 'Invalid snmp V3 Authentification algorithm %s. Valid values are: %s' % (user.authAlgo, self.authAlgorithms.keys())
                 logger.error ( msg );
                 raise ClusterException(msg);
-
-            if authAlgo!=config.usmNoAuthProtocol and user.authPass is None:
-                msg = 'No authentication password given for user %s' % (user.name)
+            else:
+                authAlgo = self.authAlgorithms[user.authAlgo.lower()];
+
+        # Parse privacy algorithm
+        privAlgo = config.usmNoPrivProtocol;
+        if user.privAlgo is not None:
+            if not user.privAlgo in self.privAlgorithms:
+                msg = 'Invalid snmp V3 Privacy algorithm %s. Valid values are: %s' % (user.privAlgo, self.privAlgorithms.keys())
                 logger.error ( msg );
                 raise ClusterException(msg);
+            else:
+                privAlgo = self.privAlgorithms[user.privAlgo.lower()];
 
-            if privAlgo!=config.usmNoPrivProtocol and user.privPass is None:
-                msg = 'No privacy password given for user %s' % (user.name)
-                logger.error ( msg );
-                raise ClusterException(msg);
+        # Check provided parameters
+        if authAlgo==config.usmNoAuthProtocol and privAlgo!=config.usmNoPrivProtocol:
+            msg = 'Privacy impossible without authentication for user: %s' % (user.name)
+            logger.error ( msg );
+            raise ClusterException(msg);
+
+        if authAlgo!=config.usmNoAuthProtocol and user.authPass is None:
+            msg = 'No authentication password given for user %s' % (user.name)
+            logger.error ( msg );
+            raise ClusterException(msg);
+
+        if privAlgo!=config.usmNoPrivProtocol and user.privPass is None:
+            msg = 'No privacy password given for user %s' % (user.name)
+            logger.error ( msg );
+            raise ClusterException(msg);
+
+        return authAlgo, privAlgo
+
+    def _configureUsers(self, snmpEngine, snmpContext, params):
+        logger.debug ( 'Configure users' );
+        for user in params.users:
+            logger.debug ( 'Creating user "%s"', user.name );
+            authAlgo, privAlgo = self._userProtocols(user)
 
-            # At least we can create the user
-            config.addV3User( snmpEngine, user.name,
+            # At least we can create the user, passwords hashed once for all the agents
+            addV3User( snmpEngine, user.name,
                 authAlgo, user.authPass,
                 privAlgo, user.privPass
             )
@@ -13,10 +13,25 @@
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 from agentcluster.exception import ClusterException
+from collections import deque
+from pysnmp.carrier import error
+from pysnmp.carrier.asynsock.dgram.base import sockErrors
+from pysnmp.carrier.asynsock.dispatch import AsynsockDispatcher
+import asyncore
+import errno
 import logging
+import os
+import select
+import socket
+import sys
+import time
+import weakref
 
 logger = logging.getLogger('agentcluster.transport')
 
+# Python 2 does not define it, Linux does since 3.9
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", sys.platform.startswith("linux") and 15 or None)
+
 udp = None
 udp6 = None
 unix = None
@@ -33,7 +48,7 @@ try:
 except ImportError:
     pass;
 
-__all__ = ["SocketHelper"]
+__all__ = ["SocketHelper", "EpollDispatcher", "BatchedDgramMixin", "ConnectionChannel", "countDrops"]
 
 
 class TransportHelperBase:
@@ -44,12 +59,132 @@ class TransportHelperBase:
     def parseAddress (self, params):
         pass;
 
+class BatchedDgramMixin:
+    """
+        Datagram transport reading and sending its messages in batches.
+
+        pysnmp reads one datagram each time the dispatcher sees the socket readable, and sends one response
+        each time it sees it writable: one wait per datagram. Readable sockets are drained here up to batchSize
+        datagrams, processed as a group, and all the responses queued are sent as soon as the socket is writable.
+        Python 2 has no recvmmsg/sendmmsg: each datagram still costs a system call, but not a wait.
+        Datagrams are counted in the metrics of the agent owning the endpoint.
+    """
+
+    # Max number of datagrams read at once from an endpoint. Inherited by agents and workers
+    batchSize = 32
+
+    # Transports of this process, their drops are read from the system by countDrops
+    all = weakref.WeakSet()
+
+    def __init__(self):
+        self.__outQueue = deque()
+        self.metrics = None
+        self.labels  = ()
+        self.inode   = None
+
+    def setMetrics(self, metrics, labels):
+        """ Counts the datagrams of this endpoint in these metrics, with these labels """
+        self.metrics = metrics
+        self.labels  = labels
+        # Identifies the socket in /proc/net/udp
+        self.inode   = os.fstat(self.socket.fileno()).st_ino
+        BatchedDgramMixin.all.add(self)
+
+    def closeTransport(self):
+        BatchedDgramMixin.all.discard(self)
+        self.__outQueue.clear()
+        self.unregisterCbFun()
+        self.close()
+
+    def sendMessage(self, outgoingMessage, transportAddress):
+        self.__outQueue.append( (outgoingMessage, transportAddress) )
+
+    def writable(self):
+        return self.__outQueue
+
+    def handle_write(self):
+        sent = failed = 0
+        while self.__outQueue:
+            outgoingMessage, transportAddress = self.__outQueue[0]
+            try:
+                if transportAddress:
+                    self.socket.sendto(outgoingMessage, transportAddress)
+                    sent += 1
+                else:
+                    failed += 1
+            except socket.error:
+                code = sys.exc_info()[1].args[0]
+                if code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # Send buffer full, the rest is sent when the socket is writable again
+                    break
+                if code not in sockErrors:
+                    raise error.CarrierError('sendto() failed for %s: %s' % (transportAddress, sys.exc_info()[1]))
+                failed += 1
+            self.__outQueue.popleft()
+        if self.metrics is not None:
+            if sent:
+                self.metrics.inc('agentcluster_datagrams_total', sent, self.labels + (('direction', 'out'),))
+            if failed:
+                self.metrics.inc('agentcluster_datagram_drops_total', failed, self.labels + (('reason', 'send'),))
+
+    def handle_read(self):
+        messages = []
+        try:
+            while len(messages) < self.batchSize:
+                messages.append( self.socket.recvfrom(65535) )
+        except socket.error:
+            code = sys.exc_info()[1].args[0]
+            if code not in sockErrors:
+                raise error.CarrierError('recvfrom() failed: %s' % (sys.exc_info()[1],))
+            # Drained, or an error on a previous send reported by the system: the datagrams read are kept
+            if sockErrors[code]:
+                self.handle_close()
+        if self.metrics is not None and messages:
+            self.metrics.inc('agentcluster_datagrams_total', len(messages), self.labels + (('direction', 'in'),))
+            self.metrics.observe('agentcluster_datagram_batch_size', len(messages))
+        for incomingMessage, transportAddress in messages:
+            if incomingMessage and self._cbFun is not None:
+                self._cbFun(self, transportAddress, incomingMessage)
+
+BatchedUdpTransport = None
+BatchedUdp6Transport = None
+if udp:
+    class BatchedUdpTransport(BatchedDgramMixin, udp.UdpTransport):
+        def __init__(self, sock=None, sockMap=None):
+            udp.UdpTransport.__init__(self, sock, sockMap)
+            BatchedDgramMixin.__init__(self)
+if udp6:
+    class BatchedUdp6Transport(BatchedDgramMixin, udp6.Udp6Transport):
+        def __init__(self, sock=None, sockMap=None):
+            udp6.Udp6Transport.__init__(self, sock, sockMap)
+            BatchedDgramMixin.__init__(self)
+
+def countDrops():
+    """ Copies in the metrics the datagrams dropped by the system on each udp endpoint of this process, its receive buffer was full """
+    transports = [ transport for transport in list(BatchedDgramMixin.all) if transport.metrics is not None ]
+    if not transports:
+        return
+    drops = {}
+    for table in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            lines = open(table).readlines()
+        except IOError:
+            continue
+        # Columns: sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ref pointer drops
+        for line in lines[1:]:
+            fields = line.split()
+            if len(fields) >= 13:
+                drops[int(fields[9])] = int(fields[-1])
+    for transport in transports:
+        if transport.inode in drops:
+            transport.metrics.set('agentcluster_datagram_drops_total', drops[transport.inode], transport.labels + (('reason', 'buffer'),))
+
 class TransportHelperUdp(TransportHelperBase):
     """ Provides tools to initialize IPV4 UDP transport """
     def __init__ (self):
         if udp:
             self.domain      = udp.domainName;
-            self.pclass      = udp.UdpTransport;
+            self.pclass      = BatchedUdpTransport;
 
     def parseAddress (self, params):
         f = lambda h,p=161 : (h, int(p) )
@@ -65,7 +200,7 @@ class TransportHelperUdp6(TransportHelperBase):
     def __init__ (self):
         if udp6:
             self.domain      = udp6.domainName;
-            self.pclass      = udp6.Udp6Transport;
+            self.pclass      = BatchedUdp6Transport;
 
     def parseAddress (self, params):
         if params.find(']:') != -1 and params[0] == '[':
@@ -92,6 +227,120 @@ class TransportHelperUnix(TransportHelperBase):
     def parseAddress (self, params):
         return params;
 
+class EpollSocketMap(dict):
+    """ Socket map of asyncore registering the sockets in an epoll object as they are added and removed """
+
+    def __init__(self, epoll):
+        dict.__init__(self)
+        self.epoll = epoll
+
+    def __setitem__(self, fd, channel):
+        if fd in self:
+            self.epoll.unregister(fd)
+        dict.__setitem__(self, fd, channel)
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            # Socket already closed, the system removed it
+            pass;
+
+class EpollDispatcher(AsynsockDispatcher):
+    """
+        Transport dispatcher waiting for its sockets with epoll instead of select.
+        Sockets are registered once, and only those with responses to send are polled for writing: the cost
+        of a wait depends on the number of sockets ready, not on the number of sockets opened.
+    """
+
+    def __init__(self):
+        AsynsockDispatcher.__init__(self)
+        self.__epoll = select.epoll()
+        # Transports with messages waiting to be sent, indexed by socket
+        self.__writers = {}
+        self.setSocketMap(EpollSocketMap(self.__epoll))
+
+    def sendMessage(self, outgoingMessage, transportDomain, transportAddress):
+        AsynsockDispatcher.sendMessage(self, outgoingMessage, transportDomain, transportAddress)
+        transport = self.getTransport(transportDomain)
+        fd = transport.socket.fileno()
+        if fd not in self.__writers:
+            self.__writers[fd] = transport
+            self.__epoll.modify(fd, select.EPOLLIN | select.EPOLLOUT)
+
+    def unregisterTransport(self, tDomain):
+        transport = self.getTransport(tDomain)
+        for fd, writer in self.__writers.items():
+            if writer is transport:
+                del self.__writers[fd]
+        AsynsockDispatcher.unregisterTransport(self, tDomain)
+
+    def transportsAreWorking(self):
+        return len(self.__writers)
+
+    def runDispatcher(self, timeout=0.0):
+        sockMap = self.getSocketMap()
+        while self.jobsArePending() or self.transportsAreWorking():
+            try:
+                events = self.__epoll.poll(timeout and timeout or self.timeout)
+            except IOError:
+                if sys.exc_info()[1].errno != errno.EINTR:
+                    raise
+                # Interrupted by a signal
+                events = []
+            for fd, flags in events:
+                transport = sockMap.get(fd)
+                if transport is None:
+                    continue
+                asyncore.readwrite(transport, flags)
+                if fd in self.__writers and not transport.writable():
+                    del self.__writers[fd]
+                    self.__epoll.modify(fd, select.EPOLLIN)
+            self.handleTimerTick(time.time())
+
+    def closeDispatcher(self):
+        AsynsockDispatcher.closeDispatcher(self)
+        self.__epoll.close()
+
+class ConnectionChannel(asyncore.dispatcher):
+    """
+        Channel of a transport dispatcher waiting for the messages of a multiprocessing connection.
+        The callback is called with each message as soon as it arrives, the dispatcher polls the connection
+        with its sockets, at no cost when nothing is sent.
+    """
+
+    def __init__(self, connection, cbFun, sockMap):
+        asyncore.dispatcher.__init__(self, map=sockMap)
+        self.connection = connection
+        self.cbFun      = cbFun
+        # The connection is used as is, asyncore would make a copy of a file non-blocking
+        self._fileno    = connection.fileno()
+        self.connected  = True
+        self.add_channel(sockMap)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            while self.connection.poll():
+                self.cbFun(self.connection.recv())
+        except EOFError:
+            # All the senders are gone
+            self.handle_close()
+
+    def handle_close(self):
+        self.del_channel()
+
+    def handle_error(self):
+        logger.error ( 'Unexpected exception on connection channel: %s', sys.exc_info()[1] );
+        logger.debug ( "", exc_info=True );
+
 class SocketHelper:
     protoHelpers = {
         "udp":  TransportHelperUdp(),
@@ -99,12 +348,44 @@ class SocketHelper:
         "unix": TransportHelperUnix()
     };
 
-    def openSocket(self, protocol, params):
+    # Transport dispatchers, indexed by the name given in the listen section of agents
+    dispatchers = {
+        "asyncore": AsynsockDispatcher,
+        "epoll":    EpollDispatcher
+    };
+
+    # Dispatcher of the agents that do not choose one, and of the workers. Inherited by agents and workers
+    defaultDispatcher = "asyncore"
+
+    def openDispatcher(self, name=None):
+        """ New transport dispatcher of this name, the default one if None """
+        if name is None:
+            name = SocketHelper.defaultDispatcher
+        if not name in self.dispatchers:
+            msg = 'Transport dispatcher %s not supported, supported dispatchers are %s. Aborting' % (name,self.dispatchers.keys())
+            logger.error ( msg );
+            raise ClusterException(msg);
+        if name == "epoll" and not hasattr(select, "epoll"):
+            logger.warning ( 'Transport dispatcher epoll not available on this system, asyncore used instead' );
+            name = "asyncore"
+        logger.debug ( 'Transport dispatcher: %s', name );
+        return self.dispatchers[name]()
+
+    def openSocket(self, protocol, params, reusePort=False, metrics=None):
+        """
+            Binds an endpoint, returns (domain, transport).
+            With reusePort, several processes can bind the same udp endpoint: the system spreads the requests between them.
+            Datagrams of udp endpoints are counted in metrics if given.
+        """
 
         if not protocol in self.protoHelpers:
             msg = 'Transport protocol %s not supported, supported transport protocols are %s. Aborting' % (protocol,self.protoHelpers.keys())
             logger.error ( msg );
             raise ClusterException(msg);
+        if reusePort and (protocol == "unix" or SO_REUSEPORT is None):
+            msg = 'Transport protocol %s endpoint %s cannot be shared by several processes on this system. Aborting' % (protocol,params)
+            logger.error ( msg );
+            raise ClusterException(msg);
         protoHelper = self.protoHelpers[protocol]
 
         # Increment the transport domain idx to have different values for each (in fact we don't care)
@@ -112,9 +393,13 @@ class SocketHelper:
         domain = protoHelper.domain + (protoHelper.idx,);
         address = protoHelper.parseAddress(params);
         transport = protoHelper.pclass();
+        if reusePort:
+            transport.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
 
         logger.debug ( 'Binding %s on domain %s with attributes: %s', protoHelper.pclass.__name__, domain, str(address) );
-        socket = transport.openServerMode( address );
-        return ( domain, socket );
+        transport = transport.openServerMode( address );
+        if metrics is not None and isinstance(transport, BatchedDgramMixin):
+            transport.setMetrics(metrics, (('endpoint', params), ('protocol', protocol)))
+        return ( domain, transport );
 
 
@@ -0,0 +1,246 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# SNMPv3 user keys
+#
+# pysnmp derives the keys of a SNMPv3 user from its passwords in two steps: the password is hashed
+# over one MB of its repetitions, then this hash is localized to the engine ID with a single hash.
+# Hashed passwords do not depend on the engine: they are kept in the cache directory and shared by
+# all the agents, whatever their engine ID. The daemon hashes the missing ones in a pool of
+# processes before starting the agents.
+#
+# Key files are named after an HMAC of their entry with a random secret of the cache: their names
+# do not tell which password they hold.
+#
+from agentcluster import confdir, searchFiles, setProcTitle
+from multiprocessing import Pool
+from pyasn1.compat.octets import null
+from pysnmp.entity import config
+import errno
+import hashlib
+import hmac
+import inspect
+import logging
+import os
+import sys
+
+__all__ = ["UsmKeyCache", "addV3User"]
+logger = logging.getLogger('agentcluster.usmkeys')
+
+def cookV3UserInfo():
+    """ Helper of config.addV3User in pysnmp 4.2, None if this version of pysnmp does not provide it as expected """
+    # Same name in pysnmp, but out of a class
+    cook = getattr(config, '__cookV3UserInfo', None)
+    try:
+        if inspect.getargspec(cook).args != ['snmpEngine', 'securityName', 'contextEngineId']:
+            return None
+    except TypeError:
+        return None
+    return cook
+
+def hashPassword( authProtocol, privProtocol, password ):
+    """ Hash of an authentication password if privProtocol is None, of a privacy password otherwise """
+    if privProtocol is None:
+        return config.authServices[authProtocol].hashPassphrase(password)
+    return config.privServices[privProtocol].hashPassphrase(authProtocol, password)
+
+def hasherInit():
+    setProcTitle ("agentcluster usm keys");
+
+def hashEntry( entry ):
+    """ Hashes a password in a pool process, returns (entry, hash or None, error message or None) """
+    try:
+        return entry, hashPassword(*entry), None
+    except Exception:
+        return entry, None, str(sys.exc_info()[1])
+
+class UsmKeyCache:
+    """
+        Hashed passwords of the SNMPv3 users, in memory and in the cache directory.
+        Entries are tuples (auth protocol, priv protocol or None for an authentication password, password).
+    """
+
+    # Hashed passwords known by this process, indexed by entry. Inherited by agents and workers
+    hashed = {}
+
+    # Secret of the cache directory naming the key files, read on first use. Inherited by agents and workers
+    secret = None
+
+    def directory(self):
+        return os.path.join(confdir.cache, 'usm')
+
+    def getSecret(self):
+        """ Random secret of the cache directory, created if it does not exist yet """
+        if UsmKeyCache.secret is not None:
+            return UsmKeyCache.secret
+        secretPath = os.path.join(self.directory(), 'secret')
+        if not os.path.exists(secretPath):
+            secretPathTmp = secretPath + os.path.extsep + str(os.getpid()) + os.path.extsep + 'tmp'
+            if not os.path.exists(self.directory()):
+                os.makedirs(self.directory(), 0700)
+            secretFile = os.fdopen(os.open(secretPathTmp, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600), 'wb')
+            try:
+                secretFile.write(os.urandom(32))
+            finally:
+                secretFile.close()
+            try:
+                # Another process may have created it meanwhile: the first one wins
+                os.link(secretPathTmp, secretPath)
+            except OSError:
+                if sys.exc_info()[1].errno != errno.EEXIST:
+                    raise
+            finally:
+                os.remove(secretPathTmp)
+        secretFile = open(secretPath, 'rb')
+        try:
+            UsmKeyCache.secret = secretFile.read()
+        finally:
+            secretFile.close()
+        return UsmKeyCache.secret
+
+    def path(self, entry):
+        """ File of a hashed password, named after an HMAC of its entry """
+        digest = hmac.new(self.getSecret(), repr(entry), hashlib.sha256).hexdigest()
+        return os.path.join(self.directory(), digest + os.path.extsep + 'key')
+
+    def cached(self, entry):
+        """ Hashed password of this entry if already computed, None otherwise """
+        if entry in UsmKeyCache.hashed:
+            return UsmKeyCache.hashed[entry]
+        try:
+            keyFile = open(self.path(entry), 'rb')
+            try:
+                UsmKeyCache.hashed[entry] = keyFile.read()
+            finally:
+                keyFile.close()
+        except (IOError, OSError):
+            return None
+        return UsmKeyCache.hashed[entry]
+
+    def store(self, entry, hashed):
+        """ Keeps a hashed password, readable by the user of the cluster only: it gives access to the agents as the password does """
+        UsmKeyCache.hashed[entry] = hashed
+        keyPath = self.path(entry)
+        keyPathTmp = keyPath + os.path.extsep + str(os.getpid()) + os.path.extsep + 'tmp'
+        try:
+            if not os.path.exists(os.path.dirname(keyPath)):
+                os.makedirs(os.path.dirname(keyPath), 0700)
+            keyFile = os.fdopen(os.open(keyPathTmp, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600), 'wb')
+            try:
+                keyFile.write(hashed)
+            finally:
+                keyFile.close()
+            os.rename(keyPathTmp, keyPath)
+        except (IOError, OSError):
+            # Computed again next time
+            logger.warning ( 'Cannot store hashed password in %s: %s', keyPath, sys.exc_info()[1] );
+
+    def get(self, authProtocol, privProtocol, password):
+        """ Hashed password, computed and stored if not cached. Protocols none are not hashed """
+        if authProtocol == config.usmNoAuthProtocol or privProtocol == config.usmNoPrivProtocol:
+            return hashPassword(authProtocol, privProtocol, password)
+        entry = (authProtocol, privProtocol, password)
+        hashed = self.cached(entry)
+        if hashed is None:
+            logger.debug ( 'Hashing password, not cached' );
+            hashed = hashPassword(*entry)
+            self.store(entry, hashed)
+        return hashed
+
+    def prepare(self, entries, processes):
+        """ Hashes the passwords of these entries that are not cached in a pool of processes, returns the number hashed """
+        if cookV3UserInfo() is None:
+            # Users are added by pysnmp, which does not use the cache
+            return 0
+        entries = sorted( [ entry for entry in set(entries) if self.cached(entry) is None ] )
+        if not entries:
+            return 0
+        logger.info ( 'Hashing %d SNMPv3 passwords with %d processes', len(entries), processes );
+        hashed = 0
+        pool = Pool(min(processes, len(entries)), hasherInit)
+        try:
+            for entry, value, error in pool.imap_unordered(hashEntry, entries):
+                if error is None:
+                    hashed += 1
+                    self.store(entry, value)
+                else:
+                    # Reported by the agent when it will create the user
+                    logger.debug ( 'Cannot hash password: %s', error );
+        finally:
+            pool.close()
+            pool.join()
+        return hashed
+
+    def clean(self, entries):
+        """ Removes the key files of the passwords that are not in these entries, returns the number removed """
+        if not os.path.exists(self.directory()):
+            return 0
+        kept = set( [ os.path.abspath(self.path(entry)) for entry in entries ] )
+        removed = 0
+        for keyPath in searchFiles(self.directory(), lambda _,ext: ext=='key'):
+            if keyPath not in kept:
+                os.remove(keyPath)
+                removed += 1
+        return removed
+
+def addV3User( snmpEngine, securityName, authProtocol, authKey, privProtocol, privKey ):
+    """
+        config.addV3User of pysnmp 4.2, passwords hashed through the cache.
+        With other versions of pysnmp, the user is added by pysnmp and its passwords are not cached.
+    """
+    cook = cookV3UserInfo()
+    if cook is None:
+        config.addV3User( snmpEngine, securityName, authProtocol, authKey, privProtocol, privKey )
+        return
+    cache = UsmKeyCache()
+    ( snmpEngineID, usmUserEntry, tblIdx1,
+      pysnmpUsmSecretEntry, tblIdx2 ) = cook( snmpEngine, securityName, None )
+    mibInstrumController = snmpEngine.msgAndPduDsp.mibInstrumController
+    pysnmpUsmKeyEntry, = mibInstrumController.mibBuilder.importSymbols('PYSNMP-USM-MIB', 'pysnmpUsmKeyEntry')
+    zeroDotZero, = mibInstrumController.mibBuilder.importSymbols('SNMPv2-SMI', 'zeroDotZero')
+
+    mibInstrumController.writeVars(
+        ((usmUserEntry.name + (13,) + tblIdx1, 'destroy'),)
+    )
+    mibInstrumController.writeVars(
+        ((usmUserEntry.name + (13,) + tblIdx1, 'createAndGo'),
+         (usmUserEntry.name + (3,) + tblIdx1, securityName),
+         (usmUserEntry.name + (4,) + tblIdx1, zeroDotZero.name),
+         (usmUserEntry.name + (5,) + tblIdx1, authProtocol),
+         (usmUserEntry.name + (8,) + tblIdx1, privProtocol))
+    )
+
+    # Localize keys
+    hashedAuthPassphrase = cache.get( authProtocol, None, authKey or null )
+    localAuthKey = config.authServices[authProtocol].localizeKey( hashedAuthPassphrase, snmpEngineID )
+    hashedPrivPassphrase = cache.get( authProtocol, privProtocol, privKey or null )
+    localPrivKey = config.privServices[privProtocol].localizeKey( authProtocol, hashedPrivPassphrase, snmpEngineID )
+
+    mibInstrumController.writeVars(
+        ((pysnmpUsmKeyEntry.name + (1,) + tblIdx1, localAuthKey),
+         (pysnmpUsmKeyEntry.name + (2,) + tblIdx1, localPrivKey),
+         (pysnmpUsmKeyEntry.name + (3,) + tblIdx1, hashedAuthPassphrase),
+         (pysnmpUsmKeyEntry.name + (4,) + tblIdx1, hashedPrivPassphrase))
+    )
+
+    # Commit passphrases
+    mibInstrumController.writeVars(
+        ((pysnmpUsmSecretEntry.name + (4,) + tblIdx2, 'destroy'),)
+    )
+    mibInstrumController.writeVars(
+        ((pysnmpUsmSecretEntry.name + (4,) + tblIdx2, 'createAndGo'),
+         (pysnmpUsmSecretEntry.name + (2,) + tblIdx2, authKey),
+         (pysnmpUsmSecretEntry.name + (3,) + tblIdx2, privKey),)
+    )
@@ -0,0 +1,66 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Pre-encoded variable bindings
+#
+# Values are stored BER encoded in the indexes. Responses are made of varbinds whose name and value are
+# encoded once, when their record is read from the index, and copied as they are into the response
+# messages: pysnmp encodes the rest of the message around them.
+#
+from pyasn1.codec.ber import decoder, encoder
+from pyasn1.type import univ
+from pysnmp.proto.api import v1, v2c
+
+__all__ = ["EncodedVarBind"]
+
+class EncodedVarBind(v1.VarBind):
+    """
+        Variable binding with its name and value already encoded. v2c.apiPDU.setVarBinds, inherited from v1,
+        puts instances of v1.VarBind in the PDU as they are, and the SNMPv1 and SNMPv2 varbinds are the same
+        sequence: an EncodedVarBind goes into any response PDU. The BER encoder writes it with the tag of the
+        sequence around its encoded content, the same bytes as the varbind built from its name and value.
+        SNMPv1 responses are converted from SNMPv2 ones by reading their varbinds: decode() gives them.
+    """
+
+    # Encoded the way univ.Any is: its content as it is
+    typeId = univ.Any.typeId
+
+    def __init__(self, oid, tagClass, value):
+        """ oid is the name as an univ.ObjectIdentifier, value is the BER encoding of a value of class tagClass """
+        v1.VarBind.__init__(self)
+        self.oid        = oid
+        self.tagClass   = tagClass
+        self.__value    = value
+        self.__contents = encoder.encode(oid) + value
+
+    def asOctets(self):
+        return self.__contents
+
+    def decode(self):
+        """ Decoded varbind: tuple (name, value) """
+        return self.oid, decoder.decode(self.__value, asn1Spec=self.tagClass())[0]
+
+    def prettyPrint(self, scope=0):
+        # The pysnmp debug logs show the varbind decoded, its components are empty
+        varBind = v2c.VarBind()
+        v2c.apiVarBind.setOIDVal(varBind, self.decode())
+        return varBind.prettyPrint(scope)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.decode())
+
+    def __getitem__(self, i):
+        # Read as the tuple (name, value) it replaces
+        return self.decode()[i]
@@ -0,0 +1,233 @@
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# File change detection
+#
+# Watchdogs are woken up by inotify events as soon as a watched file is written, moved or deleted.
+# Where inotify is not available, they keep on checking files on each monitoring period. In both cases
+# a file checksum is computed again only if the inode, the size or the modification date of the file changed.
+#
+from agentcluster import md5sum
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+__all__ = ["ChecksumCache", "FileWatcher"]
+logger = logging.getLogger('agentcluster.watcher')
+
+# inotify constants from sys/inotify.h
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ISDIR        = 0x40000000
+IN_CLOEXEC      = 0x00080000
+IN_NONBLOCK     = 0x00000800
+
+# Files modified but not yet closed are not reported: they are reported when closed
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# wd, mask, cookie, name length
+EVENT = struct.Struct('iIII')
+
+class ChecksumCache:
+    """ Checksums of files, computed again only when the inode, size or modification date of a file changes """
+
+    def __init__(self):
+        self.__sums = {}
+        self.__lock = threading.Lock()
+
+    def md5sum(self, path):
+        """ md5 of the file content, raises IOError or OSError if the file cannot be read """
+        st = os.stat(path)
+        signature = (st.st_ino, st.st_size, st.st_mtime)
+        self.__lock.acquire()
+        try:
+            cached = self.__sums.get(path)
+        finally:
+            self.__lock.release()
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        checksum = md5sum(path)
+        self.__lock.acquire()
+        try:
+            self.__sums[path] = (signature, checksum)
+        finally:
+            self.__lock.release()
+        return checksum
+
+    def forget(self, paths=None):
+        """ Forgets the checksums of these files, of all files if none is given """
+        self.__lock.acquire()
+        try:
+            if paths is None:
+                self.__sums.clear()
+            else:
+                for path in paths:
+                    self.__sums.pop(path, None)
+        finally:
+            self.__lock.release()
+
+class FileWatcher:
+    """
+        Waits for changes in watched directories and files.
+        Uses inotify when available, otherwise waiting only sleeps and reports no change.
+    """
+
+    # Delay without event before reporting changes: one save often produces several events
+    quietDelay = 0.05
+    # Max delay for reporting changes, even if events keep on coming
+    maxDelay   = 0.5
+
+    def __init__(self):
+        self.fd = None
+        # Watched directories indexed by watch descriptor, and the reverse
+        self.__dirs = {}
+        self.__wds  = {}
+        # Directories whose new sub directories are watched as well
+        self.__trees = set()
+        if _libc is not None:
+            fd = _libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+            if fd >= 0:
+                self.fd = fd
+            else:
+                logger.info ( 'inotify not available, files checked on each monitoring period: %s', os.strerror(ctypes.get_errno()) );
+
+    def isActive(self):
+        return self.fd is not None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __watchDir(self, directory):
+        directory = os.path.abspath(directory)
+        if self.fd is None or directory in self.__wds:
+            return
+        wd = _libc.inotify_add_watch(self.fd, directory.encode('utf-8') if isinstance(directory, unicode) else directory, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # Missing directories are just not watched, they will be checked on each monitoring period
+            if err != errno.ENOENT:
+                logger.warning ( 'Cannot watch directory %s: %s', directory, os.strerror(err) );
+            return
+        self.__dirs[wd] = directory
+        self.__wds[directory] = wd
+
+    def watchTree(self, root):
+        """ Watches changes of files in this directory and all its sub directories, including the ones created later """
+        if self.fd is None:
+            return
+        root = os.path.abspath(root)
+        self.__trees.add(root)
+        for directory, _, _ in os.walk(root, followlinks=True):
+            self.__watchDir(directory)
+
+    def watchFile(self, path):
+        """ Watches changes of this file: its directory is watched """
+        self.__watchDir(os.path.dirname(os.path.abspath(path)))
+
+    def __inTree(self, directory):
+        for root in self.__trees:
+            if directory == root or directory.startswith(root + os.path.sep):
+                return True
+        return False
+
+    def __read(self, changed):
+        """ Reads pending events and adds the paths they concern to changed, returns False if some events were lost """
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            if sys.exc_info()[1].errno == errno.EAGAIN:
+                return True
+            raise
+        complete = True
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset+EVENT.size:offset+EVENT.size+length].rstrip('\0')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                complete = False
+                continue
+            directory = self.__dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                # Watched directory removed
+                del self.__dirs[wd]
+                self.__wds.pop(directory, None)
+                changed.add(directory)
+                continue
+            path = name and os.path.join(directory, name) or directory
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and self.__inTree(path):
+                self.watchTree(path)
+        return complete
+
+    def wait(self, timeout):
+        """
+            Waits at most timeout seconds for file changes.
+            Returns the set of changed paths, empty if there is no change or if changes are unknown
+            because inotify is not used. Returns None if some changes have been lost: everything may have changed.
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return set()
+        changed  = set()
+        complete = True
+        deadline = None
+        while True:
+            if deadline is None:
+                delay = timeout
+            else:
+                delay = min(self.quietDelay, deadline-time.time())
+                if delay <= 0:
+                    break
+            try:
+                readable, _, _ = select.select([self.fd], [], [], delay)
+            except select.error:
+                if sys.exc_info()[1][0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                break
+            complete = self.__read(changed) and complete
+            if deadline is None:
+                deadline = time.time() + self.maxDelay
+        if not complete:
+            return None
+        return changed
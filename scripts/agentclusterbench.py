@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Description:  Load generator and benchmark of a cluster of agents
+#
+#   - generates N agents with M loopback endpoints each, answering from one of the test snapshots
+#   - starts agentclusterd on them and measures the time until all the agents are started
+#   - drives GET, GETNEXT, GETBULK and SNMPv3 authPriv GET load from concurrent asynchronous clients
+#   - reports throughput, latency percentiles and memory used, and saves them in a JSON file
+#
+from agentcluster import __version__
+from datetime import datetime
+from multiprocessing import Process, Queue, cpu_count
+from pysnmp.entity.rfc3413.oneliner import cmdgen
+import agentcluster
+import argparse
+import json
+import logging.config
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+logger = logging.getLogger('agentcluster.bench')
+default_log_file = os.path.join ( agentcluster.__path__[0], "agentcluster-log-console.conf")
+
+# Credentials of the generated agents
+COMMUNITY  = "public"
+V3_USER    = "bench"
+V3_AUTH    = "bench-auth-key"
+V3_PRIV    = "bench-priv-key"
+
+# Request sent for each operation: sysDescr, interface names and the interface table
+OID_GET    = "1.3.6.1.2.1.1.1.0"
+OID_NEXT   = "1.3.6.1.2.1.2.2.1.2"
+OID_BULK   = "1.3.6.1.2.1.2.2"
+OPERATIONS = [ "get", "next", "bulk", "v3" ]
+
+def defaultSnapshot():
+    """ LinuxHost test snapshot, from the source tree or from the installed tests """
+    candidates = [
+        os.path.join( os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'agents', 'linux', 'LinuxHost.snmpwalk' ),
+        os.path.join( sys.prefix, 'share', 'agentcluster', 'tests', 'agents', 'linux', 'LinuxHost.snmpwalk' )
+    ]
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return os.path.normpath(candidate)
+    return None
+
+def generate( directory, agents, endpoints, address, port, snapshot ):
+    """ Writes the agent files, returns the list of (address, port) endpoints of the cluster """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    listen = []
+    for n in range(agents):
+        udp = [ "%s:%d" % (address, port + n*endpoints + m) for m in range(endpoints) ]
+        listen.extend( [ (address, port + n*endpoints + m) for m in range(endpoints) ] )
+        agentFile = os.path.join( directory, "bench-%04d.agent" % n )
+        mib = os.path.relpath( snapshot, directory )
+        conf = {
+            "name":    "bench-%04d" % n,
+            "active":  "True",
+            "listen":  { "udp": udp },
+            "snmpv2c": {
+                "users": [ { "name": COMMUNITY } ],
+                "mib":   { COMMUNITY: mib }
+            },
+            "snmpv3": {
+                "users": [ { "name": V3_USER, "authAlgo": "sha", "authPass": V3_AUTH, "privAlgo": "aes", "privPass": V3_PRIV } ],
+                "mib":   { "": mib }
+            }
+        }
+        out = open( agentFile, 'w' )
+        try:
+            json.dump( conf, out, indent=4, sort_keys=True )
+        finally:
+            out.close()
+    logger.info ( 'Generated %d agents with %d endpoints each in %s', agents, endpoints, directory );
+    return listen
+
+def percentile( values, ratio ):
+    """ Percentile of a sorted list of seconds in milliseconds, None if the list is empty """
+    if not values:
+        return None
+    return values[ min( len(values)-1, int(round(ratio*(len(values)-1))) ) ] * 1000
+
+def client( operation, endpoints, duration, concurrency, timeout, results ):
+    """ Sends requests during duration seconds, keeping concurrency requests in flight. Puts (latencies, errors) in results """
+    cmdGen = cmdgen.AsynCommandGenerator()
+    if operation == "v3":
+        authData = cmdgen.UsmUserData( V3_USER, V3_AUTH, V3_PRIV,
+                                       authProtocol=cmdgen.usmHMACSHAAuthProtocol,
+                                       privProtocol=cmdgen.usmAesCfb128Protocol )
+    else:
+        authData = cmdgen.CommunityData( COMMUNITY )
+    targets = [ cmdgen.UdpTransportTarget( endpoint, timeout=timeout, retries=0 ) for endpoint in endpoints ]
+    state = { "sent": 0, "latencies": [], "errors": 0, "end": time.time() + duration }
+
+    def send():
+        target = targets[ state["sent"] % len(targets) ]
+        state["sent"] += 1
+        cbInfo = ( received, time.time() )
+        if operation == "next":
+            cmdGen.nextCmd( authData, target, ( OID_NEXT, ), cbInfo )
+        elif operation == "bulk":
+            cmdGen.bulkCmd( authData, target, 0, 25, ( OID_BULK, ), cbInfo )
+        else:
+            cmdGen.getCmd( authData, target, ( OID_GET, ), cbInfo )
+
+    def received( sendRequestHandle, errorIndication, errorStatus, errorIndex, varBinds, start ):
+        now = time.time()
+        if errorIndication or errorStatus:
+            state["errors"] += 1
+        else:
+            state["latencies"].append( now - start )
+        if now < state["end"]:
+            send()
+        # One response per request, even for next and bulk
+        return False
+
+    for _ in range(concurrency):
+        send()
+    cmdGen.snmpEngine.transportDispatcher.runDispatcher()
+    results.put( ( state["latencies"], state["errors"] ) )
+
+def load( operation, endpoints, clients, duration, concurrency, timeout ):
+    """ Runs one operation from several client processes, returns its measures """
+    results = Queue()
+    processes = []
+    for n in range(clients):
+        # Each client spreads its requests on its own share of the endpoints
+        share = endpoints[n::clients] or endpoints
+        process = Process( target=client, name="client%d" % n, args=( operation, share, duration, concurrency, timeout, results ) )
+        process.start()
+        processes.append(process)
+    start = datetime.now()
+    latencies = []
+    errors = 0
+    for _ in processes:
+        clientLatencies, clientErrors = results.get()
+        latencies.extend(clientLatencies)
+        errors += clientErrors
+    elapsed = (datetime.now()-start).total_seconds()
+    for process in processes:
+        process.join()
+    latencies.sort()
+    measures = {
+        "responses":  len(latencies),
+        "errors":     errors,
+        "seconds":    elapsed,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms":     percentile( latencies, 0.50 ),
+        "p99_ms":     percentile( latencies, 0.99 ),
+        "max_ms":     percentile( latencies, 1.0 )
+    }
+    logger.info ( '%-4s: %8.1f responses/s, p50 %s ms, p99 %s ms, %d errors', operation, measures["throughput"],
+                  measures["p50_ms"] is not None and "%.2f" % measures["p50_ms"] or "-",
+                  measures["p99_ms"] is not None and "%.2f" % measures["p99_ms"] or "-", errors );
+    return measures
+
+def children( pid ):
+    """ Pids of the child processes of a process, empty if /proc is not available """
+    pids = []
+    if not os.path.isdir('/proc'):
+        return pids
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            stat = open( os.path.join('/proc', entry, 'stat') ).read()
+        except IOError:
+            continue
+        # Process name is between parenthesis and may contain spaces
+        if int( stat[stat.rindex(')')+2:].split()[1] ) == pid:
+            pids.append( int(entry) )
+    return pids
+
+def rss( pid ):
+    """ Resident memory of a process in kB, None if it is unknown """
+    try:
+        for line in open( os.path.join('/proc', str(pid), 'status') ):
+            if line.startswith('VmRSS:'):
+                return int( line.split()[1] )
+    except IOError:
+        pass
+    return None
+
+def memory( daemonPid, agents ):
+    """ Resident memory of the daemon and of its agents or workers """
+    processes = [ value for value in [ rss(pid) for pid in children(daemonPid) ] if value is not None ]
+    total = sum(processes)
+    return {
+        "master_kb":    rss(daemonPid),
+        "processes":    len(processes),
+        "process_kb":   sorted(processes),
+        "total_kb":     total,
+        "per_agent_kb": agents and processes and total / agents or None
+    }
+
+def startDaemon( options, agentDir, cacheDir, readyFile, logFile ):
+    """ Starts agentclusterd and waits for all its agents to be started, returns (process, seconds) """
+    daemon = os.path.join( os.path.dirname(os.path.abspath(__file__)), 'agentclusterd.py' )
+    command = [ sys.executable, daemon, '-l', 'console', '-a', agentDir, '-c', cacheDir, '-r', readyFile ]
+    if options.workers:
+        command.extend( [ '-w', str(options.workers) ] )
+    logger.info ( 'Starting %s', ' '.join(command) );
+    start = datetime.now()
+    process = subprocess.Popen( command, stdout=logFile, stderr=subprocess.STDOUT )
+    while not os.path.exists(readyFile):
+        if process.poll() is not None:
+            raise RuntimeError( 'agentclusterd exited with code %s' % process.returncode )
+        if (datetime.now()-start).total_seconds() > options.startup_timeout:
+            stopDaemon(process)
+            raise RuntimeError( 'agents not started after %d seconds' % options.startup_timeout )
+        time.sleep(0.05)
+    seconds = (datetime.now()-start).total_seconds()
+    logger.info ( 'Cluster started in %.2f seconds', seconds );
+    return process, seconds
+
+def stopDaemon( process ):
+    """ Stops agentclusterd and its agents """
+    pids = children(process.pid)
+    if process.poll() is None:
+        process.terminate()
+        process.wait()
+    # Agents stop by themselves when their parent dies, but the next run would not find their ports free
+    for pid in pids:
+        try:
+            os.kill( pid, signal.SIGKILL )
+        except OSError:
+            pass
+
+def run( options ):
+    snapshot = options.snapshot or defaultSnapshot()
+    if snapshot is None or not os.path.isfile(snapshot):
+        logger.error ( 'Snapshot file not found, use option --snapshot' );
+        return 1
+    snapshot = os.path.abspath(snapshot)
+    operations = [ operation.strip() for operation in options.operations.split(',') if operation.strip() ]
+    for operation in operations:
+        if operation not in OPERATIONS:
+            logger.error ( 'Unknown operation "%s", valid values are: %s', operation, ','.join(OPERATIONS) );
+            return 1
+
+    if options.generate:
+        generate( options.generate, options.agents, options.endpoints, options.address, options.port, snapshot )
+        return 0
+
+    workDir = tempfile.mkdtemp( prefix='agentclusterbench-' )
+    try:
+        agentDir  = os.path.join( workDir, 'agents' )
+        cacheDir  = os.path.join( workDir, 'cache' )
+        readyFile = os.path.join( workDir, 'ready' )
+        endpoints = generate( agentDir, options.agents, options.endpoints, options.address, options.port, snapshot )
+        os.makedirs( cacheDir )
+        logFile = open( options.log_file or os.devnull, 'w' )
+        try:
+            process, startup = startDaemon( options, agentDir, cacheDir, readyFile, logFile )
+            try:
+                measures = {}
+                for operation in operations:
+                    measures[operation] = load( operation, endpoints, options.clients, options.duration, options.concurrency, options.timeout )
+                used = memory( process.pid, options.agents )
+            finally:
+                stopDaemon( process )
+        finally:
+            logFile.close()
+    finally:
+        shutil.rmtree( workDir, ignore_errors=True )
+
+    if used["per_agent_kb"] is not None:
+        logger.info ( 'Memory: %d kB per agent, %d kB for %d processes', used["per_agent_kb"], used["total_kb"], used["processes"] );
+    results = {
+        "version":    __version__,
+        "date":       datetime.now().isoformat(),
+        "host":       platform.node(),
+        "platform":   platform.platform(),
+        "python":     platform.python_version(),
+        "cpus":       cpu_count(),
+        "parameters": {
+            "agents":      options.agents,
+            "endpoints":   options.endpoints,
+            "workers":     options.workers,
+            "snapshot":    os.path.basename(snapshot),
+            "clients":     options.clients,
+            "concurrency": options.concurrency,
+            "duration":    options.duration,
+            "timeout":     options.timeout
+        },
+        "startup_seconds": startup,
+        "memory":          used,
+        "operations":      measures
+    }
+    output = options.output or "agentclusterbench-%s-%s.json" % ( __version__, datetime.now().strftime('%Y%m%d-%H%M%S') )
+    out = open( output, 'w' )
+    try:
+        json.dump( results, out, indent=4, sort_keys=True )
+    finally:
+        out.close()
+    logger.info ( 'Results saved in %s', output );
+    return 0
+
+if __name__ == '__main__':
+    epilogue = """
+Examples:
+    # 10 agents with 5 endpoints each, 4 client processes with 20 requests in flight each
+    agentclusterbench.py -n 10 -e 5 -k 4 -C 20
+
+    # Same cluster hosted in 2 worker processes, only GET and GETBULK
+    agentclusterbench.py -n 10 -e 5 -w 2 -o get,bulk
+
+    # Only writes the agent files, for example to run the cluster by hand
+    agentclusterbench.py -n 100 -e 200 -g ~/.agentcluster/data/bench
+"""
+    parser = argparse.ArgumentParser(description='Benchmark of SNMP Cluster of agents, by Gilles Bouissac. version %s'%__version__, epilog=epilogue, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument( '-v', '--version',     action='version', version=('%(prog)s '+__version__) )
+    parser.add_argument( '-n', '--agents',      metavar='<nb>', type=int, default=10, help='Number of agents. default: %(default)s' )
+    parser.add_argument( '-e', '--endpoints',   metavar='<nb>', type=int, default=1, help='Number of UDP endpoints per agent. default: %(default)s' )
+    parser.add_argument( '-A', '--address',     metavar='<ip>', default='127.0.0.1', help='Address the agents are listening on. default: %(default)s' )
+    parser.add_argument( '-P', '--port',        metavar='<port>', type=int, default=40000, help='First port of the agents, following ports are used in sequence. default: %(default)s' )
+    parser.add_argument( '-s', '--snapshot',    metavar='<file>', help='Snapshot the agents answer from. default: tests/agents/linux/LinuxHost.snmpwalk' )
+    parser.add_argument( '-w', '--workers',     metavar='<nb>', type=int, default=0, help='Number of worker processes hosting the agents, see agentclusterd.py. default: %(default)s' )
+    parser.add_argument( '-o', '--operations',  metavar='<list>', default=','.join(OPERATIONS), help='Comma separated operations to run, one after the other. default: %(default)s' )
+    parser.add_argument( '-k', '--clients',     metavar='<nb>', type=int, default=cpu_count(), help='Number of client processes. default: %(default)s' )
+    parser.add_argument( '-C', '--concurrency', metavar='<nb>', type=int, default=10, help='Requests in flight for each client process. default: %(default)s' )
+    parser.add_argument( '-d', '--duration',    metavar='<seconds>', type=float, default=10, help='Duration of each operation. default: %(default)s' )
+    parser.add_argument( '-t', '--timeout',     metavar='<seconds>', type=float, default=2, help='Request timeout, a request timed out is counted as an error. default: %(default)s' )
+    parser.add_argument( '-T', '--startup-timeout', metavar='<seconds>', type=int, default=300, help='Max time to wait for all the agents to be started. default: %(default)s' )
+    parser.add_argument( '-l', '--log-file',    metavar='<file>', help='File receiving the logs of agentclusterd. default: logs are discarded' )
+    parser.add_argument( '-r', '--output',      metavar='<file>', help='JSON results file. default: agentclusterbench-<version>-<date>.json' )
+    parser.add_argument( '-g', '--generate',    metavar='<dir>', help='Only writes the agent files in this directory' )
+    options = parser.parse_args()
+
+    logging.config.fileConfig( default_log_file )
+    logging.getLogger('agentcluster').setLevel(logging.INFO)
+    sys.exit( run(options) )
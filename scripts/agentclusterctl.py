@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Description:  Sends a command to a running agentclusterd.py through its control socket (option --control)
+#
+#   Commands run immediately, without waiting for the next configuration check. Command "help" lists them.
+#   Exits with status 1 if the command failed or the daemon cannot be reached.
+#
+from agentcluster import __version__
+from agentcluster.control import sendCommand
+import sys
+import argparse
+
+parser = argparse.ArgumentParser(description='SNMP Cluster of agents, by Gilles Bouissac. version %s'%__version__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument( '-s', '--control', metavar='<socket>', required=True, help='Control socket of the daemon, as given to agentclusterd.py' )
+parser.add_argument( '-t', '--timeout', metavar='<seconds>', type=float, default=None, help='Max time waiting for the answer. default: no limit' )
+parser.add_argument( 'command',         metavar='<command>', nargs='+', help='Command and its arguments, "help" for the list of commands' )
+options = parser.parse_args()
+
+try:
+    lines = sendCommand(options.control, ' '.join(options.command), options.timeout)
+except Exception:
+    sys.stderr.write('Cannot reach the daemon on %s: %s\n' % (options.control, sys.exc_info()[1]))
+    sys.exit(1)
+
+for line in lines:
+    print line
+sys.exit(lines and lines[0].startswith('error: ') and 1 or 0)
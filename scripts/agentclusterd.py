@@ -32,21 +32,32 @@
 #       mib2dev.py:       Will not be integrated, you can use snmpsim version to produce snapshots
 #                         from live snmp agents to produce snmprec files
 #
-from agentcluster import __version__, confdir, Any, md5sum, searchFiles, setProcTitle
-from agentcluster.agent import Agent
+from agentcluster import __version__, confdir, Any, searchFiles, setProcTitle
+from agentcluster.agent import Agent, AgentWorker, HostedAgent, ReplicatedAgent
+from agentcluster.compiler import SnapshotCompiler
+from agentcluster.control import ControlServer, rssOf
 from agentcluster.database import Database
+from agentcluster.exception import ClusterException
+from agentcluster.metrics import Metrics, MetricsServer, processMetrics
+from agentcluster.snapshot import SnapshotFile, SnapshotFileController
+from agentcluster.snmpsetup import SnmpConfHelperBase
+from agentcluster.transport import BatchedDgramMixin, SocketHelper
+from agentcluster.usmkeys import UsmKeyCache
+from agentcluster.watcher import FileWatcher
+from collections import deque
 from datetime import datetime, timedelta
-from multiprocessing import JoinableQueue
+from Queue import Empty
+from multiprocessing import JoinableQueue, Queue, cpu_count
 from multiprocessing.process import current_process
 from pysnmp import debug
 import agentcluster
 import argparse
 import logging.config
 import os
+import signal
 import stat
 import sys
 import threading
-import time
 
 logger = logging.getLogger('agentcluster.main')
 pysnmplogger = logging.getLogger('pysnmp')
@@ -57,11 +68,39 @@ class AgentCluster:
     def __init__(self, options):
         # Agent restart delay after crash
         self.monitoring_period = 30
+        # Number of worker processes hosting the agents, 0 for one process per agent
+        self.workers = 0
+        # Max number of agents configuring at the same time
+        self.parallel = cpu_count()
+        # File created when the cluster is ready
+        self.ready_file = None
+        # Number of processes compiling snapshots, 0 to let agents compile their snapshots
+        self.compilers = cpu_count()
         # The monitoring thread
         self.watchdog = None
+        # Address where metrics are served, None if they are not
+        self.metrics_address = None
+        self.metrics = None
+        # Path of the control socket, None if the daemon is not controlled
+        self.control_path = None
+        self.control = None
+        # Process id of the daemon, its children inherit its signal handlers
+        self.pid = os.getpid()
 
         if options.monitoring is not None:
             self.monitoring_period = options.monitoring
+        if options.workers is not None:
+            self.workers = options.workers
+        if options.parallel is not None:
+            self.parallel = options.parallel
+        if options.ready_file is not None:
+            self.ready_file = os.path.abspath(options.ready_file)
+        if options.compilers is not None:
+            self.compilers = options.compilers
+        if options.metrics is not None:
+            self.metrics_address = options.metrics
+        if options.control is not None:
+            self.control_path = os.path.abspath(options.control)
 
     def run(self):
 
@@ -75,8 +114,26 @@ class AgentCluster:
             for directory in confdir.data:
                 logger.info ( '  o %s', os.path.abspath(directory) );
 
-            self.watchdog = Watchdog(self.monitoring_period)
+            if self.workers:
+                logger.info ( 'Agents will be hosted by %d worker processes', self.workers );
+            logger.info ( 'Agents will be started %d at a time', self.parallel );
+            if self.compilers:
+                logger.info ( 'Snapshots will be compiled by %d processes', self.compilers );
+            if self.ready_file is not None and os.path.exists(self.ready_file):
+                os.remove(self.ready_file)
+            if Metrics.queue is not None:
+                # Metrics not received during 3 periods are those of stopped agents.
+                # Collected without being served when only the control socket uses them
+                self.metrics = MetricsServer(self.metrics_address, Metrics.queue, 3*self.monitoring_period)
+                self.metrics.start()
+            self.watchdog = Watchdog(self.monitoring_period, self.workers, self.parallel, self.ready_file, self.compilers)
+            self.watchdog.metrics = self.metrics
             self.watchdog.start()
+            # SIGUSR1 switches profiling of all the agents on and off
+            signal.signal(signal.SIGUSR1, self.profile)
+            if self.control_path is not None:
+                self.control = ControlServer(self.control_path, self.watchdog)
+                self.control.start()
 
             # Generates a deadlock to enter in sleep mode
             # Only an external signal can break this deadlock
@@ -91,17 +148,30 @@ class AgentCluster:
             logger.error ( 'Exception catched in main process: %s', sys.exc_info()[1] );
             logger.debug ( "", exc_info=True );
         finally:
+            if self.control is not None:
+                self.control.stop()
             # First stop the monitoring to avoid restarting killed agents
             if self.watchdog is not None:
                 self.watchdog.shutdown = True
                 self.watchdog.join()
+            if self.metrics is not None:
+                self.metrics.stop()
+            if self.ready_file is not None and os.path.exists(self.ready_file):
+                os.remove(self.ready_file)
             logger.info ( 'Agent cluster server end' );
             logging.shutdown()
 
+    def profile(self, signum, frame):
+        """ Forwards the profiling switch to the agent and worker processes """
+        # Inherited by the children until they set their own handler
+        if os.getpid() != self.pid:
+            return
+        self.watchdog.profile()
+
 class Watchdog(threading.Thread):
     """ Daemon thread that check the status of each child and restart it if necessary """
 
-    def __init__(self, monitoring_period):
+    def __init__(self, monitoring_period, workers=0, parallel=1, ready_file=None, compilers=0):
         threading.Thread.__init__(self)
         self.period   = timedelta ( seconds = monitoring_period )
         self.daemon   = True
@@ -109,8 +179,32 @@ class Watchdog(threading.Thread):
         self.shutdown = False
         # List of instantiated agents indexed by their conf file full path
         self.agents = {};
-        # This tokens will be used to wait for child Agents configuration
-        self.tokens_start = JoinableQueue()
+        # Max number of worker processes hosting the agents, 0 for one process per agent
+        self.workers_max = workers
+        self.workers = [];
+        self.workers_started = 0;
+        # Max number of agents configuring at the same time
+        self.parallel = max(1, parallel)
+        # Agents report the end of their configuration in this queue: tuple (conf file, started)
+        self.readiness = Queue()
+        # Agents being configured: start date indexed by their conf file full path
+        self.starting = {};
+        # File created when all the agents have been started for the first time
+        self.ready_file = ready_file
+        self.ready = False
+        self.created = datetime.now()
+        # Compiles the snapshots before agents use them
+        self.compiler = None
+        if compilers:
+            self.compiler = SnapshotCompiler(compilers)
+        # Notifies changes of agent confs and snapshots
+        self.watcher = FileWatcher()
+        # Serves the metrics of the agents, None if they are not served
+        self.metrics = None
+        # Agents stopped by a control command, not restarted by checks
+        self.disabled = set()
+        # Control commands waiting to be run by this thread
+        self.commands = deque()
 
     def parse_confs(self,conf_dir):
         try:
@@ -118,7 +212,7 @@ class Watchdog(threading.Thread):
             for conf in searchFiles(conf_dir, lambda _,ext: ext=='agent'):
                 conf = os.path.abspath(conf)
                 # Records this new agent placeholder
-                agents[conf] = Any( **{"sum":0, "current_sum":md5sum(conf), "handle":None} );
+                agents[conf] = Any( **{"sum":0, "current_sum":Database.checksums.md5sum(conf), "handle":None, "name":None, "ready":False, "snapshots":set()} );
         except Exception:
             logger.error ( 'Exception parsing conf %s', sys.exc_info()[1] );
             logger.debug ( "", exc_info=True );
@@ -128,34 +222,129 @@ class Watchdog(threading.Thread):
     def agent_stop(self, conf):
         try:
             agent = self.agents[conf].handle
+            self.starting.pop(conf, None)
             # Kill a previous agent if any
             if agent!=None:
                 logger.info ( 'Agent "%s" stopped: %s', agent.name, conf );
                 agent.terminate()
                 agent.join(1)
                 self.agents[conf].handle = None
+                if self.metrics is not None:
+                    self.metrics.forget(agent=agent.name)
         except Exception:
             logger.error ( 'Exception while killing agent: %s', sys.exc_info()[1] );
             logger.debug ( "", exc_info=True );
             return;
 
+    def processes(self):
+        """ Process ids of the running agents and workers """
+        pids = set( [ worker.pid for worker in list(self.workers) if worker.is_alive() ] )
+        for infos in list(self.agents.values()):
+            agent = infos.handle
+            if isinstance(agent, ReplicatedAgent):
+                pids.update(agent.pids())
+            elif agent is not None and not isinstance(agent, HostedAgent) and agent.is_alive():
+                pids.add(agent.pid)
+        return pids
+
+    def worker_select(self):
+        """ Returns the worker that will host a new agent, starts a new worker if the pool is not full """
+        # Dead workers are replaced, their agents are restarted as they are seen dead too
+        self.workers = [ worker for worker in self.workers if worker.is_alive() ]
+        if len(self.workers) < self.workers_max:
+            self.workers_started += 1
+            worker = AgentWorker(self.workers_started, self.readiness, os.getpid(), self.period.seconds);
+            worker.start()
+            self.workers.append(worker)
+            logger.info ( 'Worker %d started', worker.workerId );
+            return worker
+        return min(self.workers, key=lambda worker: len(worker.confs))
+
     def agent_start(self, conf, conf_sum):
+        # Agents are configured in parallel, but not too many at a time
+        while len(self.starting) >= self.parallel and not self.shutdown:
+            self.agents_wait(1)
+        if self.shutdown:
+            return;
         try:
             # Instantiate a new agent from this conf file and record it
-            agent = Agent(conf, self.tokens_start, os.getpid(), self.period.seconds);
+            agent = Agent(conf, self.readiness, os.getpid(), self.period.seconds);
+            self.agents[conf].snapshots = agent.snapshots()
+            for snapshot in self.agents[conf].snapshots:
+                self.watcher.watchFile(snapshot)
+            # Replicas run in their own processes to use several cores
+            replicas = agent.replicaCount()
+            if replicas > 1:
+                agent = ReplicatedAgent(agent, replicas, self.readiness, os.getpid(), self.period.seconds)
+            elif self.workers_max:
+                agent = HostedAgent(agent, self.worker_select())
             self.agents[conf].handle = agent
+            self.agents[conf].name   = agent.name
             self.agents[conf].sum    = conf_sum
-            # In order to sequence child start: give one token and wait till the child is started
-            # This is easier to read logs
+            self.agents[conf].ready  = False
+            self.starting[conf] = datetime.now()
             agent.start()
-            self.tokens_start.put(object())
-            self.tokens_start.join()
-            logger.info ( 'Agent "%s" started: %s', agent.name, conf );
+            logger.debug ( 'Agent "%s" starting: %s', agent.name, conf );
         except Exception:
+            self.starting.pop(conf, None)
             logger.error ( 'Exception launching agent: %s', sys.exc_info()[1] );
             logger.debug ( "", exc_info=True );
             return;
 
+    def agent_ready(self, conf, started):
+        """ Records the readiness reported by an agent """
+        start = self.starting.pop(conf, None)
+        infos = self.agents.get(conf)
+        # Report from an agent stopped in the meantime
+        if start is None or infos is None or infos.handle is None:
+            return;
+        # A replicated agent is ready when all its replicas are
+        if isinstance(infos.handle, ReplicatedAgent) and not infos.handle.reported(started):
+            self.starting[conf] = start
+            return;
+        elapsed = (datetime.now()-start).total_seconds()
+        if started:
+            infos.ready = True
+            logger.info ( 'Agent "%s" started in %.2f seconds: %s', infos.handle.name, elapsed, conf );
+        else:
+            logger.error ( 'Agent "%s" failed to start: %s', infos.handle.name, conf );
+
+    def agents_wait(self, timeout):
+        """ Waits at most timeout seconds for agents readiness reports """
+        try:
+            report = self.readiness.get(True, timeout)
+            while True:
+                self.agent_ready(*report)
+                report = self.readiness.get_nowait()
+        except Empty:
+            pass;
+        # Issue #3: An agent killed before its report must not be waited for ever
+        for conf in self.starting.keys():
+            infos = self.agents.get(conf)
+            if infos is None or infos.handle is None or not infos.handle.is_alive():
+                self.agent_ready(conf, False)
+
+    def cluster_ready(self):
+        """ Signals that all the agents have been configured once: logs it and creates the ready file """
+        self.ready = True
+        started = len( [ infos for infos in self.agents.values() if infos.ready ] )
+        elapsed = (datetime.now()-self.created).total_seconds()
+        logger.info ( 'Cluster ready: %d/%d agents started in %.2f seconds', started, len(self.agents), elapsed );
+        if self.ready_file is None:
+            return;
+        try:
+            # Created atomically so that a reader never sees a partial file
+            tmp_file = '%s.%d.tmp' % (self.ready_file, os.getpid())
+            out = open(tmp_file, 'w')
+            try:
+                out.write( 'pid: %d\nagents: %d\nstarted: %d\nseconds: %.2f\n' % (os.getpid(), len(self.agents), started, elapsed) )
+            finally:
+                out.close()
+            os.rename(tmp_file, self.ready_file)
+        except Exception:
+            logger.error ( 'Cannot create ready file %s: %s', self.ready_file, sys.exc_info()[1] );
+            logger.debug ( "", exc_info=True );
+
     def agents_check(self):
         """ Check that every agent is running and launch them if necessary """
 
@@ -167,10 +356,9 @@ class Watchdog(threading.Thread):
             if conf not in required_agents:
                 self.agent_stop(conf)
                 del self.agents[conf]
+                self.disabled.discard(conf)
 
         # Fills ref list with new data
-        if not required_agents:
-            return;
         for (conf,infos) in required_agents.items():
             if conf not in self.agents:
                 self.agents[conf] = infos
@@ -179,42 +367,307 @@ class Watchdog(threading.Thread):
 
         # Finally start those missing or
         #         restart those whose configuration has changed
+        restart = []
         for (conf,infos) in self.agents.items():
-            need_restart=False
+            if conf in self.disabled:
+                continue
             if infos.handle is None: 
                 logger.debug ( 'Agent need to be started: %s', conf );
-                need_restart=True
+                restart.append(conf)
             elif not infos.handle.is_alive():
                 logger.debug ( 'Agent "%s" has been killed: %s', infos.handle.name, conf );
-                need_restart=True
+                restart.append(conf)
             elif infos.current_sum!=infos.sum:
                 logger.debug ( 'Agent "%s" configuration has been changed: %s', infos.handle.name, conf );
-                need_restart=True
-            if need_restart:
-                self.agent_stop(conf);
-                self.agent_start(conf,infos.current_sum);
+                restart.append(conf)
+
+        self.snapshots_compile(restart)
+        self.passwords_hash(restart)
+
+        for conf in restart:
+            self.agent_stop(conf);
+            self.agent_start(conf,self.agents[conf].current_sum);
+
+        # Wait for the agents still configuring
+        while self.starting and not self.shutdown:
+            self.agents_wait(1)
+        if not self.ready and not self.shutdown:
+            self.cluster_ready()
+
+    def snapshots_compile(self, restart, force=False):
+        """
+            Compiles the new or modified snapshots of running agents and of the agents to (re)start, returns the number compiled.
+            Lazy snapshots are compiled by the agents on their first use, unless forced.
+        """
+        if self.compiler is None or (SnmpConfHelperBase.lazy and not force):
+            return 0;
+        snapshots = set()
+        for (conf,infos) in self.agents.items():
+            if conf not in restart:
+                snapshots.update(infos.snapshots)
+                continue
+            try:
+                snapshots.update( Agent(conf, None, None, 0).snapshots() )
+            except Exception:
+                # Reported when the agent is started
+                pass;
+        try:
+            return self.compiler.compile(snapshots)
+        except Exception:
+            logger.error ( 'Exception compiling snapshots: %s', sys.exc_info()[1] );
+            logger.debug ( "", exc_info=True );
+            return 0;
+
+    def passwords_hash(self, restart):
+        """ Hashes the SNMPv3 passwords of the agents to (re)start that are not cached yet, returns the number hashed """
+        if self.compiler is None:
+            return 0;
+        entries = []
+        for conf in restart:
+            try:
+                entries.extend( Agent(conf, None, None, 0).passwords() )
+            except Exception:
+                # Reported when the agent is started
+                pass;
+        try:
+            return UsmKeyCache().prepare(entries, self.compiler.processes)
+        except Exception:
+            logger.error ( 'Exception hashing SNMPv3 passwords: %s', sys.exc_info()[1] );
+            logger.debug ( "", exc_info=True );
+            return 0;
+
+    def is_own_file(self, path):
+        """ True for the files written by the cluster itself, their changes must not trigger checks """
+        cache = os.path.abspath(confdir.cache)
+        if path == cache or path.startswith(cache + os.path.sep):
+            return True
+        return self.ready_file is not None and path.startswith(self.ready_file)
+
+    def agents_configured(self):
+        """ Agents of all the confs, running or not, to know the files they use. Confs in error are skipped """
+        agents = []
+        for conf in (self.parse_confs(confdir.data) or {}):
+            try:
+                agents.append( Agent(conf, None, None, 0) )
+            except Exception:
+                # Reported when the agent is started
+                pass;
+        return agents
 
     def database_gc(self):
-        """ Remove database that are not up to date """
+        """ Remove database that are not up to date, and hashed passwords that no user references any more """
+        agents = self.agents_configured()
         try:
+            passwords = []
+            for agent in agents:
+                passwords.extend( agent.passwords() )
+            removed = UsmKeyCache().clean(passwords)
+            if removed:
+                logger.info ( 'Cleaned %d obsolete hashed passwords', removed );
+        except Exception:
+            logger.warning ( 'Hashed passwords cannot be cleaned %s', sys.exc_info()[1] );
+        try:
+            # Indexes are shared by all the snapshots with the same content: an index is kept while any of them has its content.
+            # The last index of a snapshot is kept as well, its next index is updated from it
+            sourceSums = set()
+            lastFiles  = set()
+            for agent in agents:
+                for snapshot in agent.snapshots():
+                    try:
+                        sourceSums.add( Database.checksums.md5sum(snapshot) )
+                        last = open(Database.lastFileFor(snapshot))
+                        try:
+                            lastFiles.add( os.path.abspath(last.read()) )
+                        finally:
+                            last.close()
+                    except (IOError, OSError):
+                        # Reported when the agent is started, or never indexed
+                        pass;
             # We try, if we cannot this is maybe because the db is loaded and will be refreshed by its owner
-            for conf in searchFiles(confdir.cache, lambda _,ext: ext in ['db', 'dbm'] ):
-                if not Database.isDbUpToDate ( conf ):
+            for conf in searchFiles(confdir.cache, lambda _,ext: ext in ['db', 'dbm', 'idx'] ):
+                sourceSum = os.path.basename(conf).split(os.path.extsep)[0]
+                if conf in lastFiles and Database.isDbUpToDate ( conf, sourceSum ):
+                    continue
+                if sourceSum not in sourceSums or not Database.isDbUpToDate ( conf, sourceSum ):
                     logger.info ( 'Cleaning obsolete database %s', conf );
                     os.remove(conf)
                     continue
+            # No agent is running yet: lock and temporary files are leftovers
+            for conf in searchFiles(confdir.cache, lambda _,ext: ext in ['lock', 'tmp'] ):
+                os.remove(conf)
+            # Last index of a source, used to update it, must not point to a removed index
+            for conf in searchFiles(confdir.cache, lambda _,ext: ext=='last' ):
+                last = open(conf)
+                try:
+                    dbFile = last.read()
+                finally:
+                    last.close()
+                if not os.path.exists(dbFile):
+                    os.remove(conf)
         except:
             logger.warning ( 'Database cannot be cleaned %s', sys.exc_info()[1] );
 
+    def profile(self):
+        """ Switches profiling of all the agents on or off, returns the number of processes signaled """
+        logger.info ( 'Switching profiling of the agents' );
+        signaled = 0
+        for pid in self.processes():
+            try:
+                os.kill(pid, signal.SIGUSR1)
+                signaled += 1
+            except OSError:
+                pass;
+        return signaled
+
+    def control(self, words):
+        """ Runs a control command in this thread, returns the lines to answer. Called by the control socket """
+        if not words or not hasattr(self, 'control_' + words[0]):
+            raise ClusterException('unknown command "%s", see command help' % ' '.join(words))
+        command = Any( **{"words":words, "done":threading.Event(), "lines":None, "error":None} )
+        self.commands.append(command)
+        while not command.done.wait(1):
+            if self.shutdown:
+                raise ClusterException('daemon stopping')
+        if command.error is not None:
+            raise ClusterException(command.error)
+        return command.lines
+
+    def commands_run(self):
+        """ Runs the control commands received """
+        while self.commands:
+            command = self.commands.popleft()
+            try:
+                command.lines = getattr(self, 'control_' + command.words[0])(*command.words[1:])
+            except Exception:
+                command.error = str(sys.exc_info()[1])
+                logger.debug ( "", exc_info=True );
+            command.done.set()
+
+    def agent_conf(self, name):
+        """ Conf file of an agent given by its name or its conf file """
+        if name is None:
+            raise ClusterException('agent name or conf file expected')
+        if os.path.abspath(name) in self.agents:
+            return os.path.abspath(name)
+        for (conf,infos) in self.agents.items():
+            if infos.name == name:
+                return conf
+        raise ClusterException('unknown agent: %s' % name)
+
+    def agent_status(self, conf, infos):
+        if conf in self.disabled:
+            return 'stopped'
+        if conf in self.starting:
+            return 'starting'
+        if infos.handle is None or not infos.handle.is_alive():
+            return 'dead'
+        return infos.ready and 'running' or 'failed'
+
+    def agent_restart(self, conf):
+        """ (Re)starts an agent now with its current conf, waits until it is configured """
+        infos = self.agents[conf]
+        self.disabled.discard(conf)
+        infos.current_sum = Database.checksums.md5sum(conf)
+        self.snapshots_compile([conf])
+        self.passwords_hash([conf])
+        self.agent_stop(conf)
+        self.agent_start(conf, infos.current_sum)
+        while conf in self.starting and not self.shutdown:
+            self.agents_wait(1)
+        if not infos.ready:
+            raise ClusterException('agent failed to start: %s' % conf)
+        return infos.name
+
+    def control_help(self):
+        return [
+            'list            agents with their status, pid, rss in kB of their process and requests per second',
+            'start <agent>   starts an agent stopped by command stop, or dead',
+            'stop <agent>    stops an agent until command start or reload, whatever its conf',
+            'reload <agent>  restarts an agent with its current conf',
+            'check           checks the configuration now: confs, snapshots and agents',
+            'compile         compiles the new or modified snapshots now',
+            'stats           cache statistics of the agent processes',
+            'profile         switches profiling of all the agents on or off',
+            'Agents are given by name or by conf file'
+        ]
+
+    def control_list(self):
+        lines = [ '%-32s %-8s %7s %9s %9s %s' % ('name', 'status', 'pid', 'rss', 'req/s', 'conf') ]
+        for (conf,infos) in sorted(self.agents.items()):
+            name   = infos.name or os.path.basename(conf)
+            status = self.agent_status(conf, infos)
+            pid    = rss = rate = None
+            if status in ('running', 'starting'):
+                pid  = infos.handle.ident
+                rss  = rssOf(pid)
+                # Replicas are listed under the pid of the first one, with the memory of all of them
+                if isinstance(infos.handle, ReplicatedAgent):
+                    rss = sum( [ rssOf(replica) or 0 for replica in infos.handle.pids() ] ) or None
+                rate = self.metrics and self.metrics.rate(agent=name)
+            lines.append( '%-32s %-8s %7s %9s %9s %s' % (
+                name, status, pid or '-', rss or '-', rate is not None and '%.1f' % rate or '-', conf) )
+        return lines
+
+    def control_start(self, name=None):
+        conf = self.agent_conf(name)
+        if conf not in self.disabled and self.agent_status(conf, self.agents[conf]) == 'running':
+            return [ 'already running: %s' % self.agents[conf].name ]
+        return [ 'started: %s' % self.agent_restart(conf) ]
+
+    def control_stop(self, name=None):
+        conf = self.agent_conf(name)
+        self.disabled.add(conf)
+        self.agent_stop(conf)
+        return [ 'stopped: %s' % (self.agents[conf].name or conf) ]
+
+    def control_reload(self, name=None):
+        return [ 'reloaded: %s' % self.agent_restart(self.agent_conf(name)) ]
+
+    def control_check(self):
+        start = datetime.now()
+        self.agents_check()
+        running = len( [ conf for (conf,infos) in self.agents.items() if self.agent_status(conf, infos) == 'running' ] )
+        return [ 'checked in %.2f seconds: %d/%d agents running' % ((datetime.now()-start).total_seconds(), running, len(self.agents)) ]
+
+    def control_compile(self):
+        if self.compiler is None:
+            raise ClusterException('snapshots are compiled by the agents, see option --compilers')
+        return [ 'compiled: %d snapshots' % self.snapshots_compile([], True) ]
+
+    def control_stats(self):
+        lines = []
+        for labels, counters, _ in sorted(self.metrics and self.metrics.current() or []):
+            values = dict( [ (name, value) for (name, own), value in counters.items() if not own ] )
+            if 'agentcluster_open_snapshots' not in values:
+                continue
+            values['process'] = dict(labels).get('process')
+            lines.append( ( '%(process)s: opened snapshots %(agentcluster_open_snapshots)d/%(agentcluster_open_snapshots_max)d, '
+                            'hits %(agentcluster_snapshot_hits_total)d, misses %(agentcluster_snapshot_misses_total)d, '
+                            'evictions %(agentcluster_snapshot_evictions_total)d; '
+                            'cached responses %(agentcluster_cached_responses)d/%(agentcluster_cached_responses_max)d, '
+                            'hits %(agentcluster_response_hits_total)d, misses %(agentcluster_response_misses_total)d' ) % values )
+        indexes = [ index for index in searchFiles(confdir.cache, lambda _,ext: ext=='idx') ]
+        size = sum( [ os.path.getsize(index) for index in indexes ] )
+        lines.append( 'cache %s: %d indexes, %d kB' % (os.path.abspath(confdir.cache), len(indexes), size // 1024) )
+        return lines
+
+    def control_profile(self):
+        return [ 'profiling switched for %d processes' % self.profile() ]
+
     def run(self):
         logger.info ( 'Master watchdog started' );
         # Issue #2: Clean databases only on start
         self.database_gc()
+        for directory in confdir.data:
+            self.watcher.watchTree(directory)
         period_start = datetime.now()-self.period
+        changed = set()
         while True:
-            if (datetime.now()-period_start) >= self.period:
+            if changed is None or changed or (datetime.now()-period_start) >= self.period:
                 try:
+                    start = datetime.now()
                     self.agents_check()
+                    processMetrics().observe('agentcluster_watchdog_check_seconds', (datetime.now()-start).total_seconds())
                     # Issue #2: Calling database_gc here cause agent crash in this case:
                     #   - Someone changes a source snapshot file
                     #   - This GC runs and remove the obsolete database
@@ -227,14 +680,26 @@ class Watchdog(threading.Thread):
                     logger.debug ( 'Exception in master watchdog %s', sys.exc_info()[1] );
                 # Start a new period
                 period_start = datetime.now()
-            # Polling for shutdown must be fast
-            time.sleep(1)
+            # Polling for shutdown must be fast, file changes stop waiting
+            changed = self.watcher.wait(1)
+            self.commands_run()
+            Database.checksums.forget(changed)
+            if changed:
+                changed = set( [ path for path in changed if not self.is_own_file(path) ] )
+            if changed:
+                logger.debug ( 'Files changed: %s', ', '.join(sorted(changed)) );
             if self.shutdown:
                 logger.info ( 'Master watchdog end' );
                 for _,infos in self.agents.items():
+                    if infos.handle is None:
+                        continue
                     logger.debug ( 'Killing agent %d', infos.handle.ident );
                     infos.handle.terminate()
                     infos.handle.join(1)
+                for worker in self.workers:
+                    logger.debug ( 'Killing worker %d', worker.ident );
+                    worker.terminate()
+                    worker.join(1)
                 return
 
 if __name__ == "__main__":
@@ -246,6 +711,13 @@ if __name__ == "__main__":
             raise argparse.ArgumentTypeError(msg)
         return string
     
+    def address_type (string):
+        host, _, port = string.rpartition(':')
+        try:
+            return (host or '127.0.0.1', int(port))
+        except ValueError:
+            raise argparse.ArgumentTypeError("%s is not a valid [<address>:]<port>"%string)
+
     def file_type_r (string):
         inode = os.lstat(string)
         if not stat.S_ISREG(inode.st_mode):
@@ -267,6 +739,18 @@ if __name__ == "__main__":
     parser.add_argument( '-a', '--agent-dir',  metavar='<root-dir>', type=dir_type, nargs='+', help='Path to root directories that will be scanned for *.agent files. See below for default values if not set.' )
     parser.add_argument( '-c', '--cache-dir',  metavar='<cache-dir>', default=confdir.cache, help='Path to a directory that contain application cache. default: %(default)s' )
     parser.add_argument( '-m', '--monitoring', metavar='<delay>', type=int, choices=range(2,3600), default=30, help='Time in second between 2 configuration check' )
+    parser.add_argument( '-w', '--workers',    metavar='<nb>', type=int, default=0, help='Number of worker processes hosting the agents, for example one per core. default: %(default)s, one process per agent' )
+    parser.add_argument( '-p', '--parallel',   metavar='<nb>', type=int, default=cpu_count(), help='Max number of agents configuring at the same time. default: %(default)s' )
+    parser.add_argument( '-j', '--compilers',  metavar='<nb>', type=int, default=cpu_count(), help='Number of processes compiling snapshots, 0 to let each agent compile its snapshots. default: %(default)s' )
+    parser.add_argument( '-o', '--open-snapshots', metavar='<nb>', type=int, default=SnapshotFile.handles.maxEntries, help='Max number of snapshots kept opened by each agent process, the least recently used are closed first. The attribute "openSnapshots" of an agent overrides it. default: %(default)s' )
+    parser.add_argument( '-z', '--lazy-snapshots', action='store_true', help='Snapshots are checked, compiled and opened on their first request instead of when the agents start' )
+    parser.add_argument( '-i', '--idle-snapshots', metavar='<seconds>', type=int, default=SnapshotFile.handles.idle, help='Snapshots not used for this time are closed, 0 to keep them opened until evicted by --open-snapshots. default: %(default)s' )
+    parser.add_argument( '-e', '--cached-responses', metavar='<nb>', type=int, default=SnapshotFileController.responses.maxEntries, help='Max number of responses to get, get-next and get-bulk requests kept by each agent process, 0 to disable. default: %(default)s' )
+    parser.add_argument( '-d', '--dispatcher', choices=sorted(SocketHelper.dispatchers.keys()), default=SocketHelper.defaultDispatcher, help='Transport dispatcher of the workers and of the agents that do not choose one, epoll scales with the number of endpoints. default: %(default)s' )
+    parser.add_argument( '-b', '--batch-size', metavar='<nb>', type=int, default=BatchedDgramMixin.batchSize, help='Max number of datagrams read at once from an udp endpoint, the responses are then sent together. default: %(default)s' )
+    parser.add_argument( '-M', '--metrics', metavar='[<address>:]<port>', type=address_type, help='Serves the metrics of the agents on http://<address>:<port>/metrics in Prometheus text format. default address: 127.0.0.1, not served if not set' )
+    parser.add_argument( '-s', '--control',    metavar='<socket>', help='Unix socket where the daemon accepts control commands, see agentclusterctl.py. Not controlled if not set' )
+    parser.add_argument( '-r', '--ready-file', metavar='<file>', help='File created when all the agents have been started once, removed on startup' )
     # parser.add_argument( '-m', '--variation-modules-dir', metavar='<path/to/variations>', help='Path to a directory containing variation classes', type=dir_type )
     options = parser.parse_args()
 
@@ -286,6 +770,15 @@ if __name__ == "__main__":
             confdir.data.append(ddir)
     if options.cache_dir:
         confdir.cache = options.cache_dir;
+    # Inherited by agents and workers
+    SnapshotFile.handles.resize(options.open_snapshots)
+    SnapshotFile.handles.idle = options.idle_snapshots
+    SnmpConfHelperBase.lazy = options.lazy_snapshots
+    SnapshotFileController.responses.maxEntries = options.cached_responses
+    SocketHelper.defaultDispatcher = options.dispatcher
+    BatchedDgramMixin.batchSize = max(1, options.batch_size)
+    if options.metrics is not None or options.control is not None:
+        Metrics.queue = Queue()
     if pysnmplogger.isEnabledFor(logging.DEBUG):
         debug.setLogger(debug.Debug("all"))
 
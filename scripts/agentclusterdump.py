@@ -35,6 +35,6 @@ if options.cache_dir:
 
 # Browses databases:
 db = Database( "", None )
-for dbfile in searchFiles( [confdir.cache] ):
+for dbfile in searchFiles( [confdir.cache], lambda _,ext: ext=='idx' ):
     db.dump_from_file(dbfile)
 
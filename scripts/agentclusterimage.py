@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014, Gilles Bouissac <agentcluster@gmail.com>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+#   * Redistributions of source code must retain the above copyright notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Description:  Compile snapshots into images that agents serve without parsing them
+#
+#   Snapshots in any supported text format are compiled into a snapshot image (extension .acimg added to the name of the snapshot): a binary
+#   file holding the sorted OID table and the BER encoded values. Agents referencing an image serve it as
+#   it is: no parsing, no checksum and no index in the cache. Images can then be built once and shipped.
+#
+#   Install new images by renaming them over the old ones, agents switch to the new content at once:
+#   an image overwritten in place may be read while it is partially written.
+#
+from agentcluster import __version__, confdir
+from agentcluster.database import Database
+from agentcluster.image import IMAGE_VERSION
+from agentcluster.record.image import ImageRecord
+from agentcluster.snmpsetup import SnmpConfHelperBase
+from datetime import datetime
+import os
+import sys
+import argparse
+import agentcluster
+import logging.config
+
+logger = logging.getLogger('agentcluster.image')
+default_log_file = os.path.join ( agentcluster.__path__[0], "agentcluster-log-console.conf")
+logging.config.fileConfig( default_log_file )
+
+parser = argparse.ArgumentParser(description='SNMP Cluster of agents, by Gilles Bouissac. version %s, image format %s'%(__version__, IMAGE_VERSION), formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument( 'snapshots',          metavar='<snapshot>', nargs='+', help='Snapshot files to compile' )
+parser.add_argument( '-o', '--output-dir', metavar='<output-dir>', default=None, help='Directory where images are written. default: next to their snapshot' )
+parser.add_argument( '-c', '--cache-dir',  metavar='<cache-dir>', default=confdir.cache, help='Path to a directory that contain application cache. default: %(default)s' )
+options = parser.parse_args()
+
+if options.cache_dir:
+    confdir.cache = options.cache_dir;
+
+failed = 0
+for snapshot in options.snapshots:
+    textParser = SnmpConfHelperBase.recordSet.get(os.path.splitext(snapshot)[1][1:])
+    if textParser is None or textParser.precompiled:
+        logger.error ( 'Unsupported snapshot file extension, snapshot ignored: %s', snapshot );
+        failed += 1
+        continue
+    # The extension of the snapshot is kept: snapshots of the same name in different formats get different images
+    imageFile = snapshot + os.path.extsep + ImageRecord.ext
+    if options.output_dir:
+        imageFile = os.path.join(options.output_dir, os.path.basename(imageFile))
+    start = datetime.now()
+    try:
+        count = Database(snapshot, textParser).exportImage(imageFile)
+    except Exception:
+        logger.error ( 'Cannot compile snapshot %s: %s', snapshot, sys.exc_info()[1] );
+        logger.debug ( "", exc_info=True );
+        failed += 1
+        continue
+    logger.info ( 'Image %s: %d records in %.2f seconds', imageFile, count, (datetime.now()-start).total_seconds() );
+
+sys.exit(failed and 1 or 0)
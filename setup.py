@@ -89,7 +89,7 @@ params.update( {
     'license': 'BSD',
     'platforms': ['any'],
     'classifiers': [ x for x in classifiers.split('\n') if x ],
-    'scripts':  [ 'scripts/agentclusterd.py', 'scripts/agentclusterdump.py' ],
+    'scripts':  [ 'scripts/agentclusterd.py', 'scripts/agentclusterdump.py', 'scripts/agentclusterimage.py', 'scripts/agentclusterctl.py', 'scripts/agentclusterbench.py' ],
     'packages': [ 'agentcluster', 'agentcluster.grammar', 'agentcluster.record' ]
 } )
 
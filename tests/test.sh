@@ -2,12 +2,24 @@
 
 set -u
 
+READY_FILE=/tmp/agentcluster-test.$$.ready
+
 echo "Start agentcluster in background"
-../scripts/agentclusterd.py -a ./ -m 10 &
+../scripts/agentclusterd.py -a ./ -m 10 -r $READY_FILE &
 AGPID=$!
 
-echo "Wait 2 secs for agentcluster readiness"
-sleep 2
+echo "Wait for agentcluster readiness"
+for i in $(seq 1 120); do
+    [ -f $READY_FILE ] && break
+    sleep 0.5
+done
+if [ ! -f $READY_FILE ]; then
+    echo ""
+    echo "TEST ERROR: agentcluster not ready after 60 secs"
+    echo ""
+    kill -9 $AGPID
+    exit 1
+fi
 
 exec_test(){
     eval $1 | {
@@ -19,6 +31,7 @@ exec_test(){
             echo "TEST ERROR"
             echo ""
             kill -9 $AGPID
+            rm -f $READY_FILE
             exit 1
     }
 }
@@ -127,4 +140,5 @@ exec_test "snmpbulkget -ObentU -n Windows-sapwalk -v 3 -l authPriv -u usr-snmp -
 
 echo "Stop agentcluster"
 kill -15 $AGPID >/dev/null 2>&1
+rm -f $READY_FILE
 